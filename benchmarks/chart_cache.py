@@ -0,0 +1,44 @@
+"""
+Повторные запросы /stats за месяц из разных чатов: первый запрос отрисовывает
+и загружает график, остальные должны отправлять его по file_id. Печатает время
+ответа, число загрузок PNG и метрики кэша графиков.
+
+    python3 benchmarks/chart_cache.py --requests 100
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+
+from common import fake_telegram, main, percentile, report, temp_database
+from stats_latency import stats_flow
+
+
+async def run(requests):
+    update_ids = itertools.count(1)
+    # Ограничение скорости в один чат (1 сообщение/с) скрывало бы время отрисовки
+    async with fake_telegram(chat_rate=1000, chat_burst=1000) as api:
+        cold = await stats_flow(api, update_ids, 1, 'sales', 'month')
+        warm = [await stats_flow(api, update_ids, chat_id, 'sales', 'month') for chat_id in range(2, requests + 1)]
+        uploads = sum(1 for data in api.sent('sendPhoto') if data['photo'].startswith('attach://'))
+
+    metrics = main.chart_cache.metrics()
+    report(f"{requests} запросов /stats за месяц", [
+        ('первый запрос', f"{cold * 1000:.0f} мс"),
+        ('повторные p50', f"{percentile(warm, 50) * 1000:.0f} мс"),
+        ('повторные p99', f"{percentile(warm, 99) * 1000:.0f} мс"),
+        ('загрузок PNG', uploads),
+        ('отправок по file_id', metrics['file_id_hits']),
+        ('доля попаданий кэша', f"{metrics['hit_rate']:.1%}"),
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=100, help="запросов /stats из разных чатов")
+    parser.add_argument('--sales-rows', type=int, default=200000, help="строк тестовых продаж")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    with temp_database():
+        main.generate_test_data(sales=args.sales_rows, days=365, users=50, activity=0)
+        asyncio.run(run(args.requests))
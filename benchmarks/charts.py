@@ -0,0 +1,56 @@
+"""
+Скорость отрисовки графиков продаж и активности: графиков в секунду в одном
+потоке и в пуле процессов (как в JobExecutor).
+
+    python3 benchmarks/charts.py --charts 200 --processes 4 --profile default
+"""
+import argparse
+import logging
+from concurrent.futures import ProcessPoolExecutor
+
+from common import main, measure, report, temp_database
+
+
+def load_frames():
+    start_date, end_date = main.get_date_range('month')
+    sales = main.get_sales_data(start_date, end_date)
+    activity = main.get_user_activity_data(start_date, end_date)
+    return [('sales', sales), ('activity', activity)]
+
+
+def render(kind, df, profile):
+    return len(main.CHART_RENDERERS[kind](df, 'месяц', profile))
+
+
+def render_serial(tasks):
+    return [render(*task) for task in tasks]
+
+
+def render_pool(tasks, processes):
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        # Первая отрисовка в процессе создает шаблон фигуры и настраивает шрифты
+        list(pool.map(render, *zip(*tasks[:processes])))
+        return measure(lambda: list(pool.map(render, *zip(*tasks))))[1]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--charts', type=int, default=200, help="графиков в замере")
+    parser.add_argument('--processes', type=int, default=4, help="процессов в пуле")
+    parser.add_argument('--profile', default=main.CHART_PROFILE, choices=sorted(main.CHART_PROFILES))
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with temp_database():
+        main.generate_test_data(sales=50000, days=60, users=50, activity=20000)
+        frames = load_frames()
+    tasks = [(kind, df, args.profile) for kind, df in frames] * (args.charts // 2)
+
+    render_serial(tasks[:2])
+    sizes, serial = measure(render_serial, tasks)
+    pooled = render_pool(tasks, args.processes)
+
+    report(f"Отрисовка {len(tasks)} графиков, профиль '{args.profile}' (средний PNG {sum(sizes) // len(sizes) // 1024} КБ)", [
+        ('один поток', f"{len(tasks) / serial:.1f} графиков/с"),
+        (f'пул из {args.processes} процессов', f"{len(tasks) / pooled:.1f} графиков/с"),
+    ])
@@ -0,0 +1,97 @@
+"""
+Общие функции нагрузочных тестов: импорт бота, временная база данных
+и поддельный сервер Bot API (tests/fakes.py).
+
+Скрипты запускаются из папки бота, например: python3 benchmarks/pool.py
+"""
+import contextlib
+import math
+import os
+import sys
+import tempfile
+import time
+
+# Бот создается при импорте модуля: токен должен иметь правильный формат
+os.environ.setdefault('API_TOKEN', '123456789:BENCHMARK-TOKEN')
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tests'))
+
+import main  # noqa: E402
+from fakes import FakeBotAPI, callback, message  # noqa: E402,F401
+
+
+@contextlib.contextmanager
+def temp_database():
+    """
+    Подменяет базу данных бота временной базой со всеми миграциями.
+
+    Yields:
+        str: Временная папка, в которой лежит база
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        main.db_pool = main.DatabasePool(os.path.join(directory, 'analytics.db'))
+        main.query_cache = main.QueryResultCache()
+        main.known_users = main.KnownUsers()
+        main.today_counters = main.TodayCounters(enabled=False)
+        for dimension in (main.products, main.action_types):
+            dimension.reset()
+            main.db_pool.rollback_callbacks.append(dimension.reset)
+        main.init_db()
+        try:
+            yield directory
+        finally:
+            main.db_pool.close_all()
+
+
+def measure(func, *args, **kwargs):
+    """
+    Выполняет функцию и возвращает ее результат и время выполнения в секундах.
+    """
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - started
+
+
+def report(title, rows):
+    """
+    Печатает таблицу результатов: строки - кортежи (название, значение).
+    """
+    print(title)
+    width = max(len(name) for name, _ in rows)
+    for name, value in rows:
+        print(f"  {name.ljust(width)}  {value}")
+
+
+def percentile(values, q):
+    """
+    Возвращает перцентиль q (0-100) списка значений.
+    """
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))]
+
+
+@contextlib.asynccontextmanager
+async def fake_telegram(delay=0.0, **outbox_settings):
+    """
+    Направляет запросы бота к поддельному серверу Bot API и запускает
+    очередь отправки и пул фоновых задач.
+
+    Args:
+        delay (float): Задержка каждого ответа сервера в секундах
+        **outbox_settings: Параметры очереди отправки (TelegramOutbox)
+
+    Yields:
+        FakeBotAPI: Сервер с записанными запросами
+    """
+    api = await FakeBotAPI(delay=delay).start()
+    bot = main.bot = api.bot()
+    main.outbox = main.TelegramOutbox(**outbox_settings)
+    main.job_executor.start()
+    try:
+        yield api
+    finally:
+        await main.outbox.stop()
+        main.job_executor.shutdown()
+        await bot.session.close()
+        await api.stop()
@@ -0,0 +1,62 @@
+"""
+Память и время выгрузки отчета об активности за год: потоковая выгрузка
+порциями из базы против выгрузки загруженного целиком DataFrame.
+
+    python3 benchmarks/export.py --actions 5000000 --users 20000
+"""
+import argparse
+import datetime
+import logging
+import tracemalloc
+
+from common import main, measure, report, temp_database
+
+
+def export_loaded(start_date, end_date):
+    return main.export_report(main.get_user_activity_data(start_date, end_date), 'activity', 'csv_gz')
+
+
+def export_streamed(start_date, end_date):
+    return main.stream_report('activity', start_date, end_date, 'activity', 'csv')
+
+
+def profile(func, *args):
+    """
+    Возвращает время выполнения, пик памяти Python и размер выгрузки.
+    """
+    buffer, elapsed = measure(func, *args)
+    size = buffer.size
+    buffer.discard()
+    main.query_cache.invalidate('activity')
+
+    tracemalloc.start()
+    try:
+        func(*args).discard()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    main.query_cache.invalidate('activity')
+    return elapsed, peak, size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--actions', type=int, default=5000000, help="строк журнала активности")
+    parser.add_argument('--users', type=int, default=20000, help="тестовых пользователей")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    today = datetime.date.today()
+    start_date, end_date = str(today - datetime.timedelta(days=365)), str(today)
+    with temp_database():
+        main.generate_test_data(sales=0, days=365, users=args.users, activity=args.actions)
+        rows = main.estimate_report_rows('activity', start_date, end_date)
+        results = {name: profile(func, start_date, end_date)
+                   for name, func in (('потоковая', export_streamed), ('целиком', export_loaded))}
+
+    report(f"Выгрузка активности: {args.actions} действий, {rows} строк отчета", [
+        (f'{name}: {label}', value)
+        for name, (elapsed, peak, size) in results.items()
+        for label, value in (('время', f"{elapsed:.1f} с"), ('пик памяти', f"{peak / 2 ** 20:.0f} МБ"),
+                             ('размер файла', f"{size / 2 ** 20:.1f} МБ"))
+    ])
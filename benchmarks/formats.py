@@ -0,0 +1,53 @@
+"""
+Размер файла и время кодирования отчетов за год в каждом доступном формате
+выгрузки (get_available_exporters).
+
+    python3 benchmarks/formats.py --sales-rows 1000000 --activity-rows 500000
+"""
+import argparse
+import logging
+
+from common import main, measure, report, temp_database
+
+
+def encode(df, export_format, repeats):
+    """
+    Возвращает размер выгрузки в байтах и лучшее время кодирования в секундах.
+    """
+    best = None
+    for _ in range(repeats):
+        buffer, elapsed = measure(main.export_report, df, 'report', export_format)
+        size = buffer.size
+        buffer.discard()
+        best = elapsed if best is None else min(best, elapsed)
+    return size, best
+
+
+def main_benchmark(sales_rows, activity_rows, repeats):
+    with temp_database():
+        main.generate_test_data(sales=sales_rows, days=365, users=200, activity=activity_rows)
+        start_date, end_date = main.get_date_range('year')
+        frames = {
+            'продажи': main.get_sales_data(start_date, end_date),
+            'активность': main.get_user_activity_data(start_date, end_date),
+        }
+
+    exporters = main.get_available_exporters()
+    for title, df in frames.items():
+        results = []
+        baseline = None
+        for name, exporter in exporters.items():
+            size, elapsed = encode(df, name, repeats)
+            baseline = baseline or size
+            results.append((exporter['label'], f"{size / 1024:,.0f} КБ ({size / baseline:.0%} от CSV), {elapsed * 1000:.0f} мс"))
+        report(f"Отчет '{title}' за год: {len(df)} строк", results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sales-rows', type=int, default=1000000, help="строк тестовых продаж")
+    parser.add_argument('--activity-rows', type=int, default=500000, help="строк журнала активности")
+    parser.add_argument('--repeats', type=int, default=3, help="повторов кодирования (берется лучший)")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    main_benchmark(args.sales_rows, args.activity_rows, args.repeats)
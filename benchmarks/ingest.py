@@ -0,0 +1,64 @@
+"""
+Сравнивает массовую загрузку продаж из файла (ingest_sales) с записью
+по одной строке в отдельной транзакции, как при добавлении продаж по одной.
+
+    python3 benchmarks/ingest.py --rows 50000
+"""
+import argparse
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from common import main, measure, report, temp_database
+
+
+def write_sales_file(path, rows, seed=1):
+    rng = np.random.default_rng(seed)
+    products = np.array([product[1] for product in main.TEST_PRODUCTS])
+    pd.DataFrame({
+        'product_id': rng.integers(1, len(products) + 1, rows),
+        'product_name': products[rng.integers(0, len(products), rows)],
+        'amount': (rng.random(rows) * 1000).round(2),
+        'date': (pd.Timestamp('2024-01-01') + pd.to_timedelta(rng.integers(0, 365, rows), unit='D')).strftime('%Y-%m-%d'),
+        'user_id': rng.integers(100000, 999999, rows),
+    }).to_csv(path, index=False)
+
+
+def insert_per_row(path):
+    rows, _ = main.prepare_sales_chunk(pd.read_csv(path, dtype=str))
+    for row in rows:
+        with main.db_pool.writer() as conn:
+            main.insert_sales_rows(conn, [row])
+    return len(rows)
+
+
+def main_benchmark(rows, per_row_rows):
+    results = []
+    with temp_database() as directory:
+        path = os.path.join(directory, 'sales.csv')
+        write_sales_file(path, per_row_rows)
+        inserted, elapsed = measure(insert_per_row, path)
+        results.append(('по одной строке', f"{inserted / elapsed:,.0f} строк/с ({inserted} строк)"))
+    per_row_rate = inserted / elapsed
+
+    for rebuild_indexes in (False, True):
+        with temp_database() as directory:
+            path = os.path.join(directory, 'sales.csv')
+            write_sales_file(path, rows)
+            result, elapsed = measure(main.ingest_sales, path, rebuild_indexes=rebuild_indexes)
+            rate = result['inserted'] / elapsed
+            name = 'ingest_sales' + (' --rebuild-indexes' if rebuild_indexes else '')
+            results.append((name, f"{rate:,.0f} строк/с ({result['inserted']} строк), x{rate / per_row_rate:.1f}"))
+
+    report("Загрузка продаж", results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200000, help="строк для массовой загрузки")
+    parser.add_argument('--per-row-rows', type=int, default=5000, help="строк для записи по одной")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    main_benchmark(args.rows, args.per_row_rows)
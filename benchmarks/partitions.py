@@ -0,0 +1,59 @@
+"""
+Время запроса журнала активности за текущий месяц при двух годах истории:
+помесячные секции против одной таблицы со всеми строками (прежняя схема).
+
+    python3 benchmarks/partitions.py --actions 5000000
+"""
+import argparse
+import logging
+
+from common import main, measure, report, temp_database
+
+SINGLE_TABLE = 'user_activity_single'
+
+
+def create_single_table(conn):
+    # Одна таблица с тем же индексом, что и у секций
+    conn.execute(main.ACTIVITY_PARTITION_TABLE.format(name=SINGLE_TABLE))
+    # id у каждой секции свой, в общей таблице он назначается заново
+    columns = 'user_id, action_key, action_ts, additional_data'
+    conn.execute(f"INSERT INTO {SINGLE_TABLE} ({columns}) SELECT {columns} FROM user_activity ORDER BY action_ts")
+    conn.execute(main.ACTIVITY_PARTITION_OBJECTS[0].format(name=SINGLE_TABLE))
+    conn.execute(f"ANALYZE {SINGLE_TABLE}")
+
+
+def query_month(source, params):
+    with main.db_pool.reader() as conn:
+        return len(conn.execute(main.USER_ACTIVITY_DATA_QUERY.format(activity=source), params).fetchall())
+
+
+def best_time(repeats, func, *args):
+    return min(measure(func, *args)[1] for _ in range(repeats))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--actions', type=int, default=2000000, help="строк журнала активности за два года")
+    parser.add_argument('--users', type=int, default=1000, help="тестовых пользователей")
+    parser.add_argument('--repeats', type=int, default=5, help="повторов замера (берется лучший)")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    start_date, end_date = main.get_date_range('month')
+    params = main.period_seconds(start_date, end_date)
+    with temp_database():
+        main.generate_test_data(sales=0, days=730, users=args.users, activity=args.actions)
+        with main.db_pool.writer() as conn:
+            create_single_table(conn)
+            partitions = len(main.activity_partition_names(conn))
+            source = main.activity_source(conn, start_date, end_date)
+
+        rows = query_month(source, params)
+        assert rows == query_month(SINGLE_TABLE, params)
+        partitioned = best_time(args.repeats, query_month, source, params)
+        single = best_time(args.repeats, query_month, SINGLE_TABLE, params)
+
+    report(f"Журнал за текущий месяц: {args.actions} действий в {partitions} секциях, {rows} строк отчета", [
+        ('секция месяца', f"{partitioned * 1000:.1f} мс"),
+        ('одна таблица', f"{single * 1000:.1f} мс"),
+    ])
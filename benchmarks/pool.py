@@ -0,0 +1,98 @@
+"""
+Сравнивает открытие соединения SQLite на каждый запрос (как до пула
+соединений) с долгоживущими соединениями DatabasePool на пути записи
+команды /start и на чтении данных отчета.
+
+    python3 benchmarks/pool.py --calls 2000
+"""
+import argparse
+import contextlib
+import logging
+import sqlite3
+import time
+
+from common import main, percentile, report, temp_database
+
+
+class ConnectPerCall:
+    """
+    Пул с интерфейсом DatabasePool, который, как прежний код, открывает
+    новое соединение без WAL на каждый вызов и закрывает его после.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        conn = sqlite3.connect(path)
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.close()
+
+    @contextlib.contextmanager
+    def reader(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    @contextlib.contextmanager
+    def writer(self):
+        conn = sqlite3.connect(self.path)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def close_all(self):
+        pass
+
+
+def start_command(user_id):
+    # Запись, которую выполняет обработчик /start
+    main.register_user(user_id, f'user{user_id}', 'Имя', None)
+    main.log_user_activity(user_id, 'start')
+
+
+def report_read(_call):
+    # Чтение, с которого начинается отчет по продажам и активности за месяц, мимо кэша запросов
+    main.query_cache.invalidate('sales')
+    main.query_cache.invalidate('activity')
+    end = main.datetime.date.today()
+    start = end - main.datetime.timedelta(days=30)
+    main.get_sales_data(start.isoformat(), end.isoformat())
+    main.get_user_activity_data(start.isoformat(), end.isoformat())
+
+
+def timings(func, calls):
+    values = []
+    for index in range(calls):
+        started = time.perf_counter()
+        func(index)
+        values.append((time.perf_counter() - started) * 1000)
+    return values
+
+
+def describe(values):
+    return f"p50 {percentile(values, 50):.3f} мс, p99 {percentile(values, 99):.3f} мс, {len(values) / (sum(values) / 1000):,.0f} вызовов/с"
+
+
+def main_benchmark(calls):
+    results = []
+    for name, make_pool in (('sqlite3.connect на вызов', ConnectPerCall), ('db_pool', None)):
+        with temp_database() as directory:
+            if make_pool is not None:
+                main.db_pool.close_all()
+                main.db_pool = make_pool(main.db_pool.path)
+            main.generate_test_data()
+            results.append((f"{name}: /start", describe(timings(start_command, calls))))
+            results.append((f"{name}: отчет", describe(timings(report_read, calls // 10 or 1))))
+
+    report("Соединения с базой данных", results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--calls', type=int, default=2000, help="вызовов /start (чтений отчета в 10 раз меньше)")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    main_benchmark(args.calls)
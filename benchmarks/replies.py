@@ -0,0 +1,60 @@
+"""
+Число запросов к Bot API и время ответа на /stats и /report при задержке
+сети до Telegram (поддельный сервер отвечает с задержкой --delay).
+
+    python3 benchmarks/replies.py --delay 0.05 --runs 20
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import time
+
+from common import callback, fake_telegram, main, message, percentile, report, temp_database
+
+FLOWS = {
+    '/stats продажи': ['/stats', 'report_sales', 'period_month'],
+    '/stats активность': ['/stats', 'report_activity', 'period_month'],
+    '/report продажи CSV': ['/report', 'report_sales', 'format_csv', 'period_month'],
+}
+
+
+async def run_flow(api, update_ids, chat_id, texts):
+    """
+    Возвращает время от последнего нажатия до ответа с основной клавиатурой
+    и количество запросов к API за это время (без ответов на нажатия).
+    """
+    for text in texts:
+        mark = len(api.calls)
+        started = time.perf_counter()
+        update = message if text.startswith('/') else callback
+        await main.dp.feed_update(main.bot, update(next(update_ids), chat_id, text))
+    while not any('keyboard' in data.get('reply_markup', '') for _, data in api.calls[mark:]):
+        await asyncio.sleep(0.002)
+    elapsed = time.perf_counter() - started
+    return elapsed, sum(1 for method, _ in api.calls[mark:] if method != 'answerCallbackQuery')
+
+
+async def run(delay, runs):
+    update_ids = itertools.count(1)
+    chat_ids = itertools.count(1)
+    rows = []
+    async with fake_telegram(delay=delay, chat_rate=1000, chat_burst=1000) as api:
+        for name, texts in FLOWS.items():
+            results = [await run_flow(api, update_ids, next(chat_ids), texts) for _ in range(runs)]
+            latencies = [elapsed for elapsed, _ in results]
+            calls = sum(count for _, count in results) / runs
+            rows.append((name, f"{calls:.1f} запросов, p50 {percentile(latencies, 50) * 1000:.0f} мс, "
+                               f"p99 {percentile(latencies, 99) * 1000:.0f} мс"))
+    report(f"Ответы при задержке Bot API {delay * 1000:.0f} мс ({runs} запусков)", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--delay', type=float, default=0.05, help="задержка ответа Bot API в секундах")
+    parser.add_argument('--runs', type=int, default=20, help="запусков каждого сценария")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    with temp_database():
+        main.generate_test_data(sales=50000, days=60, users=50, activity=20000)
+        asyncio.run(run(args.delay, args.runs))
@@ -0,0 +1,56 @@
+"""
+Время статистики за год по агрегированным по дням таблицам и по исходным
+таблицам продаж и журнала активности.
+
+    python3 benchmarks/rollups.py --sales-rows 10000000
+"""
+import argparse
+import logging
+
+from common import main, measure, report, temp_database
+
+
+def set_rollups_valid(valid):
+    with main.db_pool.writer() as conn:
+        conn.execute("UPDATE rollup_state SET valid = ?", (int(valid),))
+
+
+def yearly_stats(start_date, end_date):
+    main.query_cache.invalidate('sales')
+    main.query_cache.invalidate('activity')
+    main.build_sales_stats_text(main.get_sales_data(start_date, end_date), 'год')
+    main.get_activity_summary(start_date, end_date, 'год')
+
+
+def best_time(repeats, func, *args):
+    return min(measure(func, *args)[1] for _ in range(repeats))
+
+
+def main_benchmark(sales_rows, activity_rows, repeats):
+    with temp_database():
+        _, elapsed = measure(
+            main.generate_test_data, sales=sales_rows, days=365, users=200, activity=activity_rows
+        )
+        start_date, end_date = main.get_date_range('year')
+
+        timings = {}
+        for valid in (True, False):
+            set_rollups_valid(valid)
+            timings[valid] = best_time(repeats, yearly_stats, start_date, end_date)
+        set_rollups_valid(True)
+
+    report(f"Статистика за год: {sales_rows} продаж, {activity_rows} действий (генерация {elapsed:.0f} с)", [
+        ('по агрегированным таблицам', f"{timings[True] * 1000:.0f} мс"),
+        ('по исходным таблицам', f"{timings[False] * 1000:.0f} мс"),
+        ('ускорение', f"x{timings[False] / timings[True]:.1f}"),
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sales-rows', type=int, default=1000000, help="строк тестовых продаж")
+    parser.add_argument('--activity-rows', type=int, default=500000, help="строк журнала активности")
+    parser.add_argument('--repeats', type=int, default=3, help="повторов замера (берется лучший)")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+    main_benchmark(args.sales_rows, args.activity_rows, args.repeats)
@@ -0,0 +1,93 @@
+"""
+Нагрузочный тест диспетчера: N одновременных сценариев /stats (команда, выбор
+типа, выбор периода) и, параллельно с ними, команды /start. Печатает p50/p99
+времени до ответа - тяжелые отчеты не должны задерживать легкие команды.
+
+    python3 benchmarks/stats_latency.py --flows 50 --period year
+"""
+import argparse
+import asyncio
+import itertools
+import logging
+import time
+
+from common import callback, fake_telegram, main, message, percentile, report, temp_database
+
+
+def is_stats_reply(method, data):
+    # Статистика приходит графиком с подписью, при отсутствии данных - сообщением
+    return method == 'sendPhoto' or (method == 'sendMessage' and data['text'].startswith('Нет данных'))
+
+
+def is_start_reply(method, data):
+    return method == 'sendMessage' and data['text'].startswith('Привет')
+
+
+async def wait_reply(api, chat_id, start_index, predicate, timeout=120):
+    """
+    Ожидает первый подходящий запрос к Bot API в чат chat_id после start_index.
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for method, data in api.calls[start_index:]:
+            if int(data.get('chat_id', 0)) == chat_id and predicate(method, data):
+                return
+        await asyncio.sleep(0.005)
+    raise TimeoutError(f"Нет ответа в чат {chat_id}")
+
+
+async def stats_flow(api, update_ids, chat_id, stats_type, period):
+    started = time.perf_counter()
+    await main.dp.feed_update(main.bot, message(next(update_ids), chat_id, '/stats'))
+    await main.dp.feed_update(main.bot, callback(next(update_ids), chat_id, f'report_{stats_type}'))
+    mark = len(api.calls)
+    await main.dp.feed_update(main.bot, callback(next(update_ids), chat_id, f'period_{period}'))
+    await wait_reply(api, chat_id, mark, is_stats_reply)
+    return time.perf_counter() - started
+
+
+async def start_ping(api, update_ids, chat_id):
+    started = time.perf_counter()
+    mark = len(api.calls)
+    await main.dp.feed_update(main.bot, message(next(update_ids), chat_id, '/start'))
+    await wait_reply(api, chat_id, mark, is_start_reply)
+    return time.perf_counter() - started
+
+
+async def run(flows, period, pings):
+    update_ids = itertools.count(1)
+    async with fake_telegram() as api:
+        ping_latencies = []
+
+        async def pinger():
+            for index in range(pings):
+                ping_latencies.append(await start_ping(api, update_ids, 1_000_000 + index))
+                await asyncio.sleep(0.02)
+
+        started = time.perf_counter()
+        stats = asyncio.gather(*(
+            stats_flow(api, update_ids, chat_id, 'sales' if chat_id % 2 else 'activity', period)
+            for chat_id in range(1, flows + 1)
+        ))
+        flow_latencies, _ = await asyncio.gather(stats, pinger())
+        elapsed = time.perf_counter() - started
+
+    report(f"{flows} одновременных сценариев /stats за период '{period}' ({elapsed:.1f} с)", [
+        ('/stats p50', f"{percentile(flow_latencies, 50) * 1000:.0f} мс"),
+        ('/stats p99', f"{percentile(flow_latencies, 99) * 1000:.0f} мс"),
+        ('/start p50 под нагрузкой', f"{percentile(ping_latencies, 50) * 1000:.0f} мс"),
+        ('/start p99 под нагрузкой', f"{percentile(ping_latencies, 99) * 1000:.0f} мс"),
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--flows', type=int, default=50, help="одновременных сценариев /stats")
+    parser.add_argument('--period', default='year', choices=['day', 'week', 'month', 'year'])
+    parser.add_argument('--pings', type=int, default=50, help="команд /start во время нагрузки")
+    parser.add_argument('--sales-rows', type=int, default=200000, help="строк тестовых продаж")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    with temp_database():
+        main.generate_test_data(sales=args.sales_rows, days=365, users=50, activity=args.sales_rows // 2)
+        asyncio.run(run(args.flows, args.period, args.pings))
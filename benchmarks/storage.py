@@ -0,0 +1,141 @@
+"""
+Размер базы и время чтения отчетов до и после перехода на целочисленные даты
+и справочники (миграция 8): база заполняется в прежней схеме с датами-строками,
+замеряется, затем переводится в текущую схему и замеряется снова.
+
+    python3 benchmarks/storage.py --sales-rows 2000000 --activity-rows 2000000
+"""
+import argparse
+import logging
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from common import main, measure, report, temp_database
+
+ORIGINAL_MIGRATIONS = list(main.MIGRATIONS)
+PERIOD = ('2024-01-01', '2024-12-31')
+
+LEGACY_SALES_QUERY = """
+SELECT product_name, SUM(amount) as total_amount, COUNT(*) as sales_count, date
+FROM sales WHERE date BETWEEN ? AND ?
+GROUP BY product_name, date ORDER BY date
+"""
+
+LEGACY_ACTIVITY_QUERY = """
+SELECT user_id, action_type, action_date FROM user_activity
+WHERE action_date BETWEEN ? AND ?
+"""
+
+ACTIVITY_QUERY = """
+SELECT user_id, action_key as action_type, action_ts as action_date FROM {activity}
+WHERE action_ts BETWEEN ? AND ?
+"""
+
+
+def migrate(last_version):
+    main.MIGRATIONS = [migration for migration in ORIGINAL_MIGRATIONS if migration[0] <= last_version]
+    try:
+        with main.db_pool.writer() as conn:
+            main.run_migrations(conn)
+    finally:
+        main.MIGRATIONS = ORIGINAL_MIGRATIONS
+
+
+def fill_legacy(sales_rows, activity_rows, chunk_rows=200000):
+    """
+    Заполняет таблицы в прежней схеме: даты и время - строки, названия - текст.
+    """
+    rng = np.random.default_rng(1)
+    start = np.datetime64('2023-01-01')
+    names = np.array([product[1] for product in main.TEST_PRODUCTS])
+    actions = np.array([action for action, _ in main.TEST_ACTIONS])
+
+    with main.db_pool.writer() as conn:
+        for offset in range(0, sales_rows, chunk_rows):
+            size = min(chunk_rows, sales_rows - offset)
+            dates = (start + rng.integers(0, 730, size)).astype(str)
+            conn.executemany(
+                "INSERT INTO sales (product_id, product_name, amount, date, user_id) VALUES (?, ?, ?, ?, ?)",
+                zip(rng.integers(1, 5, size).tolist(), names[rng.integers(0, 4, size)].tolist(),
+                    (rng.random(size) * 50000).round(2).tolist(), dates.tolist(), rng.integers(1, 1000, size).tolist())
+            )
+        for offset in range(0, activity_rows, chunk_rows):
+            size = min(chunk_rows, activity_rows - offset)
+            times = (start.astype('datetime64[s]') + rng.integers(0, 730 * 86400, size)).astype(str)
+            conn.executemany(
+                "INSERT INTO user_activity (user_id, action_type, action_date) VALUES (?, ?, ?)",
+                zip(rng.integers(1, 1000, size).tolist(), actions[rng.integers(0, 3, size)].tolist(),
+                    np.char.replace(times, 'T', ' ').tolist())
+            )
+
+
+def database_size():
+    # Размер после VACUUM, без журнала WAL
+    main.db_pool.close_all()
+    conn = sqlite3.connect(main.db_pool.path)
+    conn.execute("VACUUM")
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    return os.path.getsize(main.db_pool.path)
+
+
+def read_legacy():
+    with main.db_pool.reader() as conn:
+        sales = pd.read_sql_query(LEGACY_SALES_QUERY, conn, params=PERIOD)
+        sales['date'] = pd.to_datetime(sales['date'])
+        activity = pd.read_sql_query(LEGACY_ACTIVITY_QUERY, conn, params=(PERIOD[0], f"{PERIOD[1]} 23:59:59"))
+        activity['action_date'] = pd.to_datetime(activity['action_date'])
+    return len(sales), len(activity)
+
+
+def read_encoded():
+    with main.db_pool.reader() as conn:
+        sales = main.read_frame(conn, main.SALES_DATA_QUERY, main.period_days(*PERIOD))
+        activity = main.read_frame(
+            conn,
+            ACTIVITY_QUERY.format(activity=main.activity_source(conn, *PERIOD)),
+            main.period_seconds(*PERIOD),
+            columns={'action_type': 'action_type', 'action_date': 'second'}
+        )
+    return len(sales), len(activity)
+
+
+def best_time(repeats, func):
+    return min(measure(func)[1] for _ in range(repeats))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sales-rows', type=int, default=1000000, help="строк продаж за два года")
+    parser.add_argument('--activity-rows', type=int, default=1000000, help="строк журнала активности за два года")
+    parser.add_argument('--repeats', type=int, default=3, help="повторов замера (берется лучший)")
+    args = parser.parse_args()
+    logging.disable(logging.INFO)
+
+    with temp_database() as directory:
+        # Отдельная база: temp_database уже применила все миграции к своей
+        main.db_pool.close_all()
+        main.db_pool = main.DatabasePool(os.path.join(directory, 'legacy.db'))
+        migrate(2)
+        fill_legacy(args.sales_rows, args.activity_rows)
+        migrate(7)
+        legacy_size = database_size()
+        legacy_rows = read_legacy()
+        legacy_time = best_time(args.repeats, read_legacy)
+
+        _, migration_time = measure(migrate, len(ORIGINAL_MIGRATIONS))
+        encoded_size = database_size()
+        assert read_encoded() == legacy_rows
+        encoded_time = best_time(args.repeats, read_encoded)
+        main.db_pool.close_all()
+
+    report(f"{args.sales_rows} продаж и {args.activity_rows} действий, чтение за {PERIOD[0][:4]} год", [
+        ('размер базы: строки', f"{legacy_size / 2 ** 20:.1f} МБ"),
+        ('размер базы: целые числа', f"{encoded_size / 2 ** 20:.1f} МБ"),
+        ('запрос и разбор: строки', f"{legacy_time * 1000:.0f} мс"),
+        ('запрос и разбор: целые числа', f"{encoded_time * 1000:.0f} мс"),
+        ('миграция', f"{migration_time:.1f} с"),
+    ])
@@ -0,0 +1,102 @@
+"""
+Пропускная способность приема обновлений: вебхук (POST обновлений на сервер
+aiohttp) против long polling (getUpdates у поддельного Bot API). Замеряется
+время от первого обновления до ответов на все N команд /start.
+
+    python3 benchmarks/webhook.py --updates 2000 --batch 100
+"""
+import argparse
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from common import fake_telegram, main, message, report, temp_database
+
+PORT = 8099
+SECRET = 'benchmark-secret'
+
+
+def recorded_updates(count, first_update_id):
+    return [
+        json.loads(message(update_id, update_id, '/start').model_dump_json(exclude_none=True))
+        for update_id in range(first_update_id, first_update_id + count)
+    ]
+
+
+async def wait_replies(api, count, mark):
+    while len([1 for method, _ in api.calls[mark:] if method == 'sendMessage']) < count:
+        await asyncio.sleep(0.005)
+
+
+async def run_webhook(api, updates, concurrency):
+    server = main.WebhookServer(main.dp, main.bot, secret=SECRET)
+    await server.start(host='127.0.0.1', port=PORT, url='')
+    url = f'http://127.0.0.1:{PORT}{server.path}'
+    headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+    pending = iter(updates)
+    mark = len(api.calls)
+
+    async def sender(session):
+        # Telegram повторяет доставку, если сервер ответил не 200
+        for update in pending:
+            while True:
+                async with session.post(url, json=update, headers=headers) as response:
+                    if response.status == 200:
+                        break
+                await asyncio.sleep(0.05)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(sender(session) for _ in range(concurrency)))
+    await wait_replies(api, len(updates), mark)
+    elapsed = time.perf_counter() - started
+    await server.stop(delete_webhook=False)
+    return elapsed
+
+
+async def run_polling(api, updates, batch):
+    pending = list(updates)
+
+    def get_updates(data):
+        offset = int(data.get('offset', 0))
+        while pending and pending[0]['update_id'] < offset:
+            pending.pop(0)
+        return {'ok': True, 'result': pending[:batch]}
+
+    api.handlers['getUpdates'] = get_updates
+    mark = len(api.calls)
+    started = time.perf_counter()
+    polling = asyncio.create_task(main.dp.start_polling(main.bot, handle_signals=False, close_bot_session=False))
+    await wait_replies(api, len(updates), mark)
+    elapsed = time.perf_counter() - started
+    await main.dp.stop_polling()
+    await polling
+    return elapsed
+
+
+async def run(count, batch, concurrency):
+    # Ограничения скорости отправки сняты: замеряется прием и обработка обновлений
+    async with fake_telegram(global_rate=100000, chat_rate=1000, chat_burst=1000) as api:
+        main.activity_writer.start()
+        webhook = await run_webhook(api, recorded_updates(count, 1), concurrency)
+        polling = await run_polling(api, recorded_updates(count, count + 1), batch)
+        await main.activity_writer.stop()
+
+    report(f"Прием {count} команд /start", [
+        (f'вебхук ({concurrency} соединений)', f"{count / webhook:.0f} обновлений/с"),
+        (f'long polling (по {batch})', f"{count / polling:.0f} обновлений/с"),
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--updates', type=int, default=2000, help="обновлений в каждом режиме")
+    parser.add_argument('--batch', type=int, default=100, help="обновлений в ответе getUpdates")
+    parser.add_argument('--concurrency', type=int, default=20, help="одновременных запросов к вебхуку")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+    with temp_database():
+        asyncio.run(run(args.updates, args.batch, args.concurrency))
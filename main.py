@@ -1,38 +1,76 @@
 import logging
 import sqlite3
 import pandas as pd
-import matplotlib.pyplot as plt
+import numpy as np
+import matplotlib
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 import io
 import datetime
 from aiogram import Bot, Dispatcher, F
-from aiogram.types import Message, CallbackQuery, FSInputFile, BufferedInputFile
-from aiogram.filters import Command
+from aiogram.types import Message, CallbackQuery, FSInputFile, BufferedInputFile, Update
+from aiogram.filters import Command, CommandObject
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton, 
     InlineKeyboardMarkup, InlineKeyboardButton
 )
 from aiogram.client.session.aiohttp import AiohttpSession
-from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError
+from aiogram.client.telegram import TelegramAPIServer, PRODUCTION
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError, TelegramForbiddenError
 import calendar
 import os
 import asyncio
 import aiohttp
+from aiohttp import web
 import time
 import random
+import threading
+import contextlib
+import functools
+import argparse
+import hashlib
+import hmac
+import secrets
+import tempfile
+import gzip
+import json
+import multiprocessing
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Необязательные зависимости для дополнительных форматов выгрузки
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
 
+# Адрес собственного сервера Bot API (например, локального telegram-bot-api),
+# по умолчанию запросы идут на api.telegram.org
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL')
+
 # Настройка сессии с таймаутами
-session = AiohttpSession()
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else PRODUCTION)
 session.api_timeout = 60
 session.api_retries = 5
 
 # Инициализация бота и диспетчера
-API_TOKEN = 'ВАШ_ТОКЕН_API'  # Замените на свой токен от BotFather
+API_TOKEN = os.getenv('API_TOKEN', 'ВАШ_ТОКЕН_API')  # Замените на свой токен от BotFather
 bot = Bot(token=API_TOKEN, session=session)
 storage = MemoryStorage()
 dp = Dispatcher(storage=storage)
@@ -40,6 +78,7 @@ dp = Dispatcher(storage=storage)
 # Класс для хранения состояний при формировании отчета
 class ReportStates(StatesGroup):
     waiting_for_report_type = State()
+    waiting_for_format = State()
     waiting_for_period = State()
     waiting_for_date_range = State()
 
@@ -49,422 +88,4772 @@ class StatsStates(StatesGroup):
     waiting_for_period = State()
     waiting_for_date_range = State()
 
-# Инициализация базы данных
-def init_db():
-    """
-    Инициализирует базу данных SQLite и создает необходимые таблицы,
-    если они еще не существуют.
+# Настройки базы данных
+DB_PATH = 'analytics.db'
+DB_MAX_READERS = int(os.getenv('DB_MAX_READERS', '8'))
+DB_CACHED_STATEMENTS = 256
+
+# Пул долгоживущих соединений с базой данных
+class DatabasePool:
     """
-    conn = sqlite3.connect('analytics.db')
-    cursor = conn.cursor()
-    
-    # Создание таблицы продаж
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS sales (
-        id INTEGER PRIMARY KEY,
-        product_id INTEGER,
-        product_name TEXT,
-        amount REAL,
-        date TEXT,
-        user_id INTEGER
-    )
-    ''')
+    Хранит долгоживущие соединения с SQLite: отдельное соединение для чтения
+    в каждом потоке и одно выделенное соединение для записи.
     
-    # Создание таблицы пользователей
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY,
-        user_id INTEGER UNIQUE,
-        username TEXT,
-        first_name TEXT,
-        last_name TEXT,
-        registration_date TEXT,
-        last_activity TEXT
-    )
-    ''')
+    Соединения открываются в режиме WAL, поэтому чтение не блокируется записью.
+    Количество одновременных читателей ограничено семафором, а подготовленные
+    запросы переиспользуются через кэш выражений модуля sqlite3.
+    """
     
-    # Создание таблицы действий пользователей
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS user_activity (
-        id INTEGER PRIMARY KEY,
-        user_id INTEGER,
-        action_type TEXT,
-        action_date TEXT,
-        additional_data TEXT
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        "PRAGMA cache_size=-20000",
+        "PRAGMA mmap_size=268435456",
+        "PRAGMA temp_store=MEMORY",
+        "PRAGMA busy_timeout=5000",
     )
-    ''')
     
-    conn.commit()
-    conn.close()
+    def __init__(self, path, max_readers=DB_MAX_READERS):
+        """
+        Args:
+            path (str): Путь к файлу базы данных
+            max_readers (int): Максимальное количество одновременных читателей
+        """
+        self.path = path
+        self.max_readers = max_readers
+        # Вызываются после отката транзакции записи (сброс кэшей, заполненных внутри нее)
+        self.rollback_callbacks = []
+        self._reset()
     
-    logging.info("База данных инициализирована")
-
-# Функция для добавления нового пользователя или обновления данных существующего
-def register_user(user_id, username, first_name, last_name):
-    """
-    Регистрирует нового пользователя в базе данных или обновляет информацию
-    о существующем пользователе.
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._readers_limit = threading.BoundedSemaphore(self.max_readers)
+        self._readers = []
+        self._readers_lock = threading.Lock()
+        self._writer = None
+        self._writer_lock = threading.RLock()
     
-    Args:
-        user_id (int): ID пользователя в Telegram
-        username (str): Имя пользователя
-        first_name (str): Имя
-        last_name (str): Фамилия
-    """
-    conn = sqlite3.connect('analytics.db')
-    cursor = conn.cursor()
+    def _check_pid(self):
+        # После fork унаследованные соединения использовать нельзя
+        if self._pid != os.getpid():
+            self._reset()
     
-    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    def _connect(self):
+        conn = sqlite3.connect(
+            self.path,
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=DB_CACHED_STATEMENTS
+        )
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
     
-    cursor.execute(
-        "SELECT * FROM users WHERE user_id = ?", 
-        (user_id,)
-    )
-    user = cursor.fetchone()
+    @contextlib.contextmanager
+    def reader(self):
+        """
+        Выдает соединение для чтения, закрепленное за текущим потоком.
+        
+        Yields:
+            sqlite3.Connection: Соединение в режиме автокоммита
+        """
+        self._check_pid()
+        local = self._local
+        if getattr(local, 'conn', None) is None:
+            local.conn = self._connect()
+            local.depth = 0
+            with self._readers_lock:
+                self._readers.append(local.conn)
+        
+        # Вложенные вызовы в том же потоке не занимают семафор повторно
+        if local.depth:
+            local.depth += 1
+            try:
+                yield local.conn
+            finally:
+                local.depth -= 1
+            return
+        
+        with self._readers_limit:
+            local.depth = 1
+            try:
+                yield local.conn
+            finally:
+                local.depth = 0
     
-    if user is None:
-        # Добавляем нового пользователя
-        cursor.execute(
-            "INSERT INTO users (user_id, username, first_name, last_name, registration_date, last_activity) VALUES (?, ?, ?, ?, ?, ?)",
-            (user_id, username, first_name, last_name, now, now)
-        )
-    else:
-        # Обновляем информацию о существующем пользователе
-        cursor.execute(
-            "UPDATE users SET username = ?, first_name = ?, last_name = ?, last_activity = ? WHERE user_id = ?",
-            (username, first_name, last_name, now, user_id)
-        )
+    @contextlib.contextmanager
+    def writer(self):
+        """
+        Выдает единственное соединение для записи внутри транзакции.
+        Транзакция фиксируется при успешном выходе и откатывается при ошибке.
+        
+        Yields:
+            sqlite3.Connection: Соединение для записи
+        """
+        self._check_pid()
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = self._connect()
+            conn = self._writer
+            
+            # Вложенная запись выполняется в рамках внешней транзакции
+            if conn.in_transaction:
+                yield conn
+                return
+            
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                for callback in self.rollback_callbacks:
+                    callback()
+                raise
+            else:
+                conn.execute("COMMIT")
     
-    conn.commit()
-    conn.close()
+    def close_all(self):
+        """
+        Закрывает все открытые соединения пула.
+        """
+        with self._readers_lock:
+            readers, self._readers = self._readers, []
+        for conn in readers:
+            try:
+                conn.close()
+            except Exception as e:
+                logging.error(f"Ошибка при закрытии соединения: {e}")
+        self._local = threading.local()
+        
+        with self._writer_lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
 
-# Функция для логирования действий пользователя
-def log_user_activity(user_id, action_type, additional_data=None):
+db_pool = DatabasePool(DB_PATH)
+
+# Даты хранятся в базе целыми числами: номер дня и секунды от 1970-01-01
+# (время локальное, без часового пояса)
+EPOCH_DATE = datetime.date(1970, 1, 1)
+SECONDS_PER_DAY = 86400
+
+def epoch_day(value):
     """
-    Записывает действие пользователя в журнал активности.
+    Возвращает номер дня от 1970-01-01.
     
     Args:
-        user_id (int): ID пользователя в Telegram
-        action_type (str): Тип действия (например, 'start', 'report', 'stats')
-        additional_data (str, optional): Дополнительные данные о действии
+        value (str или datetime.date): Дата в формате 'YYYY-MM-DD' (время после даты не учитывается)
+        
+    Returns:
+        int: Номер дня
     """
-    conn = sqlite3.connect('analytics.db')
-    cursor = conn.cursor()
-    
-    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    cursor.execute(
-        "INSERT INTO user_activity (user_id, action_type, action_date, additional_data) VALUES (?, ?, ?, ?)",
-        (user_id, action_type, now, additional_data)
-    )
-    
-    # Обновляем время последней активности пользователя
-    cursor.execute(
-        "UPDATE users SET last_activity = ? WHERE user_id = ?",
-        (now, user_id)
-    )
-    
-    conn.commit()
-    conn.close()
+    if isinstance(value, str):
+        value = datetime.date.fromisoformat(value[:10])
+    elif isinstance(value, datetime.datetime):
+        value = value.date()
+    return value.toordinal() - EPOCH_DATE.toordinal()
 
-# Функция для получения данных продаж за период
-def get_sales_data(start_date, end_date):
+def epoch_seconds(value):
     """
-    Получает данные о продажах из базы данных за указанный период.
+    Возвращает количество секунд от 1970-01-01 00:00:00.
     
     Args:
-        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
-        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        value (str или datetime.datetime): Время в формате 'YYYY-MM-DD HH:MM:SS'
         
     Returns:
-        pandas.DataFrame: DataFrame с данными о продажах
-    """
-    conn = sqlite3.connect('analytics.db')
-    
-    query = f"""
-    SELECT 
-        product_name,
-        SUM(amount) as total_amount,
-        date
-    FROM 
-        sales
-    WHERE 
-        date BETWEEN '{start_date}' AND '{end_date}'
-    GROUP BY 
-        product_name, date
-    ORDER BY 
-        date
+        int: Количество секунд
     """
-    # Примечание: сумма (total_amount) уже в гривнах
-    
-    df = pd.read_sql_query(query, conn)
-    conn.close()
-    
-    return df
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value)
+    return calendar.timegm(value.timetuple())
 
-# Функция для получения данных об активности пользователей за период
-def get_user_activity_data(start_date, end_date):
+def period_days(start_date, end_date):
     """
-    Получает данные об активности пользователей из базы данных за указанный период.
+    Возвращает границы периода в номерах дней.
     
     Args:
         start_date (str): Начальная дата в формате 'YYYY-MM-DD'
         end_date (str): Конечная дата в формате 'YYYY-MM-DD'
         
     Returns:
-        pandas.DataFrame: DataFrame с данными об активности пользователей
+        tuple: (первый день, последний день)
     """
-    conn = sqlite3.connect('analytics.db')
-    
-    query = f"""
-    SELECT 
-        ua.user_id,
-        u.username,
-        ua.action_type,
-        COUNT(*) as action_count,
-        ua.action_date
-    FROM 
-        user_activity ua
-    JOIN 
-        users u ON ua.user_id = u.user_id
-    WHERE 
-        ua.action_date BETWEEN '{start_date} 00:00:00' AND '{end_date} 23:59:59'
-    GROUP BY 
-        ua.user_id, ua.action_type, SUBSTR(ua.action_date, 1, 10)
-    ORDER BY 
-        ua.action_date
-    """
-    
-    df = pd.read_sql_query(query, conn)
-    conn.close()
-    
-    return df
+    return epoch_day(start_date), epoch_day(end_date)
 
-# Функция для генерации графика продаж
-def generate_sales_chart(df, period_name, temp_dir='temp_charts'):
+def period_seconds(start_date, end_date):
     """
-    Генерирует график продаж на основе данных DataFrame и сохраняет его во временный файл.
+    Возвращает границы периода в секундах.
     
     Args:
-        df (pandas.DataFrame): DataFrame с данными о продажах
-        period_name (str): Название периода для заголовка графика
-        temp_dir (str): Директория для временных файлов
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
         
     Returns:
-        str: Путь к сохраненному файлу графика
+        tuple: (первая секунда первого дня, последняя секунда последнего дня)
     """
-    # Создаем временную директорию, если она не существует
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    # Генерируем уникальное имя файла
-    timestamp = int(time.time())
-    random_suffix = random.randint(1000, 9999)
-    filename = f"{temp_dir}/sales_chart_{timestamp}_{random_suffix}.png"
+    first, last = period_days(start_date, end_date)
+    return first * SECONDS_PER_DAY, (last + 1) * SECONDS_PER_DAY - 1
+
+# Справочник названий с целочисленными ключами
+class Dimension:
+    """
+    Справочник названий (товаров, типов действий): строки продаж и журнала
+    активности хранят короткий целочисленный ключ вместо повторяющейся строки.
     
-    plt.figure(figsize=(10, 6))
+    Ключ выдается названию один раз и больше не меняется, поэтому соответствия
+    кэшируются в памяти процесса. Новые названия добавляются в транзакции записи;
+    при ее откате кэш сбрасывается, чтобы не запомнить ключ, которого нет в базе.
+    """
     
-    # Преобразуем дату в формат datetime
-    df['date'] = pd.to_datetime(df['date'])
+    def __init__(self, table, key_column, name_column):
+        """
+        Args:
+            table (str): Таблица справочника
+            key_column (str): Столбец ключа
+            name_column (str): Столбец названия
+        """
+        self.table = table
+        self.key_column = key_column
+        self.name_column = name_column
+        self._keys = {}        # название -> ключ
+        self._decoder = None   # (массив ключ -> код категории, категории)
+        self._lock = threading.Lock()
+        db_pool.rollback_callbacks.append(self.reset)
     
-    # Агрегируем данные по дате
-    daily_sales = df.groupby(['date', 'product_name'])['total_amount'].sum().unstack()
+    def reset(self):
+        """
+        Сбрасывает кэш соответствий.
+        """
+        with self._lock:
+            self._keys = {}
+            self._decoder = None
     
-    # Строим график
-    ax = daily_sales.plot(kind='line', marker='o')
-    plt.title(f'Продажи по товарам за {period_name}')
-    plt.xlabel('Дата')
-    plt.ylabel('Сумма продаж (грн)')
-    plt.grid(True)
-    plt.tight_layout()
+    def _load(self, conn):
+        rows = conn.execute(f"SELECT {self.key_column}, {self.name_column} FROM {self.table}").fetchall()
+        # Категории - по алфавиту, как при сортировке названий
+        names = sorted(name for _, name in rows)
+        codes = {name: code for code, name in enumerate(names)}
+        lookup = np.full(max((key for key, _ in rows), default=0) + 1, -1, dtype=np.int64)
+        for key, name in rows:
+            lookup[key] = codes[name]
+        
+        decoder = (lookup, pd.Index(names, dtype=object))
+        with self._lock:
+            self._keys = {name: key for key, name in rows}
+            self._decoder = decoder
+        return decoder
     
-    # Сохраняем график в файл
-    plt.savefig(filename, format='png', dpi=100)
-    plt.close()
+    def keys(self, conn, names):
+        """
+        Возвращает ключи названий; недостающие названия добавляются в справочник.
+        
+        Args:
+            conn (sqlite3.Connection): Соединение внутри транзакции записи
+            names (iterable): Названия
+            
+        Returns:
+            dict: {название: ключ}
+        """
+        names = set(names)
+        with self._lock:
+            keys = {name: self._keys.get(name) for name in names}
+        
+        if None in keys.values():
+            conn.executemany(
+                f"INSERT OR IGNORE INTO {self.table} ({self.name_column}) VALUES (?)",
+                [(name,) for name, key in keys.items() if key is None]
+            )
+            self._load(conn)
+            with self._lock:
+                keys = {name: self._keys[name] for name in names}
+        return keys
     
-    return filename
+    def categorical(self, conn, keys):
+        """
+        Преобразует столбец ключей в категориальный столбец названий. Категориями
+        служат все названия справочника, поэтому они одинаковы во всех результатах
+        и во всех порциях потоковой выгрузки.
+        
+        Args:
+            conn (sqlite3.Connection): Соединение для чтения
+            keys (pandas.Series): Ключи (пустые значения становятся NaN)
+            
+        Returns:
+            pandas.Categorical: Названия
+        """
+        values = np.asarray(pd.to_numeric(keys), dtype=float)
+        missing = np.isnan(values)
+        values = np.where(missing, 0, values).astype(np.int64)
+        
+        decoder = self._decoder
+        if decoder is None or (len(values) and values.max() >= len(decoder[0])):
+            decoder = self._load(conn)
+        codes = decoder[0][values]
+        if (codes[~missing] < 0).any():
+            # Ключ выдан после загрузки справочника (например, другим процессом)
+            decoder = self._load(conn)
+            codes = decoder[0][values]
+        codes[missing] = -1
+        return pd.Categorical.from_codes(codes, decoder[1])
 
-# Функция для генерации графика активности пользователей
-def generate_activity_chart(df, period_name, temp_dir='temp_charts'):
+products = Dimension('products', 'product_key', 'product_name')
+action_types = Dimension('action_types', 'action_key', 'action_type')
+
+# Закодированные столбцы результатов запросов и способ их раскодирования.
+# Запросы возвращают ключи товаров и типов действий под именами product_name и action_type
+FRAME_COLUMNS = {
+    'date': 'day',
+    'action_date': 'day',
+    'product_name': 'product',
+    'action_type': 'action_type',
+}
+
+FRAME_DECODERS = {
+    'day': lambda conn, values: pd.to_datetime(values, unit='D'),
+    'second': lambda conn, values: pd.to_datetime(values, unit='s'),
+    'product': lambda conn, values: products.categorical(conn, values),
+    'action_type': lambda conn, values: action_types.categorical(conn, values),
+}
+
+def decode_frame(conn, df, columns=None):
     """
-    Генерирует график активности пользователей на основе данных DataFrame и сохраняет его во временный файл.
+    Раскодирует столбцы результата запроса: номера дней и секунды - в datetime64,
+    ключи справочников - в категориальные столбцы названий.
     
     Args:
-        df (pandas.DataFrame): DataFrame с данными об активности пользователей
-        period_name (str): Название периода для заголовка графика
-        temp_dir (str): Директория для временных файлов
+        conn (sqlite3.Connection): Соединение, через которое читались данные
+        df (pandas.DataFrame): Результат запроса
+        columns (dict, optional): {столбец: способ из FRAME_DECODERS}, по умолчанию FRAME_COLUMNS
         
     Returns:
-        str: Путь к сохраненному файлу графика
+        pandas.DataFrame: Тот же DataFrame с раскодированными столбцами
     """
-    # Создаем временную директорию, если она не существует
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    # Генерируем уникальное имя файла
-    timestamp = int(time.time())
-    random_suffix = random.randint(1000, 9999)
-    filename = f"{temp_dir}/activity_chart_{timestamp}_{random_suffix}.png"
-    
-    plt.figure(figsize=(10, 6))
-    
-    # Преобразуем дату в формат datetime и извлекаем только дату
-    df['action_date'] = pd.to_datetime(df['action_date']).dt.date
-    
-    # Агрегируем данные по дате и типу действия
-    activity_by_date = df.groupby(['action_date', 'action_type'])['action_count'].sum().unstack()
-    
-    # Строим график
-    ax = activity_by_date.plot(kind='line', marker='o')
-    plt.title(f'Активность пользователей за {period_name}')
-    plt.xlabel('Дата')
-    plt.ylabel('Количество действий')
-    plt.grid(True)
-    plt.tight_layout()
-    
-    # Сохраняем график в файл
-    plt.savefig(filename, format='png', dpi=100)
-    plt.close()
-    
-    return filename
+    for column, kind in (columns or FRAME_COLUMNS).items():
+        if column in df:
+            df[column] = FRAME_DECODERS[kind](conn, df[column])
+    return df
 
-# Функция для экспорта данных в CSV
-def export_to_csv(df, filename):
+def read_frame(conn, query, params=(), chunksize=None, columns=None):
     """
-    Экспортирует данные из DataFrame в файл CSV.
+    Выполняет запрос и возвращает результат с раскодированными столбцами (см. decode_frame).
     
     Args:
-        df (pandas.DataFrame): DataFrame с данными для экспорта
-        filename (str): Имя файла CSV
+        conn (sqlite3.Connection): Соединение для чтения
+        query (str): Текст запроса
+        params (tuple): Параметры запроса
+        chunksize (int, optional): Размер порции; если задан, возвращается итератор порций
+        columns (dict, optional): {столбец: способ из FRAME_DECODERS}, по умолчанию FRAME_COLUMNS
         
     Returns:
-        str: Путь к созданному файлу CSV
+        pandas.DataFrame или iterator: Результат запроса
     """
-    file_path = f"{filename}.csv"
-    df.to_csv(file_path, index=False, encoding='utf-8')
-    return file_path
+    if chunksize is None:
+        return decode_frame(conn, pd.read_sql_query(query, conn, params=params), columns)
+    return (
+        decode_frame(conn, chunk, columns)
+        for chunk in pd.read_sql_query(query, conn, params=params, chunksize=chunksize)
+    )
 
-# Функция для вычисления дат начала и конца периода
-def get_date_range(period_type):
+def insert_sales_rows(conn, rows):
     """
-    Вычисляет даты начала и конца периода на основе типа периода.
+    Записывает продажи: названия товаров заменяются ключами справочника, даты - номерами дней.
     
     Args:
-        period_type (str): Тип периода ('day', 'week', 'month', 'year')
-        
-    Returns:
-        tuple: Кортеж с начальной и конечной датами в формате 'YYYY-MM-DD'
+        conn (sqlite3.Connection): Соединение внутри транзакции записи
+        rows (list): Кортежи (product_id, product_name, amount, date, user_id)
     """
-    today = datetime.date.today()
-    
-    if period_type == 'day':
-        start_date = today
-        end_date = today
-    elif period_type == 'week':
-        start_date = today - datetime.timedelta(days=today.weekday())
-        end_date = start_date + datetime.timedelta(days=6)
-    elif period_type == 'month':
-        start_date = today.replace(day=1)
-        last_day = calendar.monthrange(today.year, today.month)[1]
-        end_date = today.replace(day=last_day)
-    elif period_type == 'year':
-        start_date = today.replace(month=1, day=1)
-        end_date = today.replace(month=12, day=31)
-    else:
-        # По умолчанию возвращаем текущий месяц
-        start_date = today.replace(day=1)
-        last_day = calendar.monthrange(today.year, today.month)[1]
-        end_date = today.replace(day=last_day)
-    
-    return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+    if not rows:
+        return
+    keys = products.keys(conn, {row[1] for row in rows})
+    days = np.array([row[3] for row in rows], dtype='datetime64[D]').astype(np.int64).tolist()
+    conn.executemany(
+        "INSERT INTO sales (product_id, product_key, amount, day, user_id) VALUES (?, ?, ?, ?, ?)",
+        [
+            (product_id, keys[product_name], amount, day, user_id)
+            for (product_id, product_name, amount, _, user_id), day in zip(rows, days)
+        ]
+    )
 
-# Функция для генерации тестовых данных (для демонстрации)
-def generate_test_data():
+# Настройки фонового выполнения задач
+DB_THREADS = int(os.getenv('DB_THREADS', '4'))
+CPU_PROCESSES = int(os.getenv('CPU_PROCESSES', str(max(1, (os.cpu_count() or 2) - 1))))
+MAX_CONCURRENT_JOBS = int(os.getenv('MAX_CONCURRENT_JOBS', '4'))
+JOB_TIMEOUT = float(os.getenv('JOB_TIMEOUT', '120'))
+
+# Выполнение блокирующих операций вне цикла событий
+class JobExecutor:
     """
-    Генерирует тестовые данные продаж для демонстрации возможностей бота.
+    Выносит блокирующую работу из цикла событий aiogram: запросы к SQLite
+    выполняются в пуле потоков, построение графиков и агрегация pandas -
+    в пуле процессов.
+    
+    Тяжелые задачи пользователей (отчеты и статистика) запускаются через spawn():
+    одновременно выполняется не более max_jobs задач, каждая ограничена таймаутом
+    и отменяется, если пользователь сбрасывает состояние FSM.
     """
-    conn = sqlite3.connect('analytics.db')
-    cursor = conn.cursor()
     
-    # Очищаем таблицу продаж
-    cursor.execute("DELETE FROM sales")
+    def __init__(self, io_workers=DB_THREADS, cpu_workers=CPU_PROCESSES,
+                 max_jobs=MAX_CONCURRENT_JOBS, job_timeout=JOB_TIMEOUT):
+        """
+        Args:
+            io_workers (int): Количество потоков для операций с базой данных
+            cpu_workers (int): Количество процессов для вычислений (0 - использовать потоки)
+            max_jobs (int): Максимальное количество одновременно выполняемых задач
+            job_timeout (float): Таймаут одной задачи в секундах
+        """
+        self.io_workers = io_workers
+        self.cpu_workers = cpu_workers
+        self.max_jobs = max_jobs
+        self.job_timeout = job_timeout
+        self._io_pool = None
+        self._cpu_pool = None
+        self._semaphore = None
+        self._user_jobs = {}
     
-    # Продукты для тестовых данных (цены в гривнах)
-    products = [
-        {"id": 1, "name": "Смартфон", "price_range": (15000, 40000)},
-        {"id": 2, "name": "Ноутбук", "price_range": (25000, 85000)},
-        {"id": 3, "name": "Наушники", "price_range": (1500, 9000)},
-        {"id": 4, "name": "Планшет", "price_range": (8000, 30000)},
-    ]
+    def start(self):
+        """
+        Создает пулы потоков и процессов.
+        """
+        if self._io_pool is None:
+            self._io_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='db')
+        if self._cpu_pool is None:
+            if self.cpu_workers > 0:
+                self._cpu_pool = ProcessPoolExecutor(max_workers=self.cpu_workers)
+            else:
+                self._cpu_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix='cpu')
+    
+    def shutdown(self):
+        """
+        Отменяет задачи пользователей и останавливает пулы.
+        """
+        for task in list(self._user_jobs.values()):
+            task.cancel()
+        self._user_jobs.clear()
+        
+        for pool in (self._io_pool, self._cpu_pool):
+            if pool is not None:
+                pool.shutdown(wait=False)
+        self._io_pool = None
+        self._cpu_pool = None
     
-    # Генерируем данные за последние 30 дней
-    import random
-    end_date = datetime.date.today()
-    start_date = end_date - datetime.timedelta(days=30)
+    async def _run(self, pool, func, args, kwargs, timeout):
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))
+        return await asyncio.wait_for(future, timeout or self.job_timeout)
     
-    date_range = [start_date + datetime.timedelta(days=x) for x in range(31)]
+    async def run_io(self, func, *args, timeout=None, **kwargs):
+        """
+        Выполняет функцию работы с базой данных в пуле потоков.
+        
+        Args:
+            func (callable): Блокирующая функция
+            timeout (float, optional): Таймаут в секундах
+            
+        Returns:
+            Результат функции
+        """
+        self.start()
+        return await self._run(self._io_pool, func, args, kwargs, timeout)
     
-    for date in date_range:
-        # Генерируем от 5 до 15 продаж в день
-        for _ in range(random.randint(5, 15)):
-            product = random.choice(products)
-            price = random.uniform(product["price_range"][0], product["price_range"][1])
-            user_id = random.randint(100000, 999999)
+    async def run_cpu(self, func, *args, timeout=None, **kwargs):
+        """
+        Выполняет вычислительную функцию в пуле процессов.
+        Функция и ее аргументы должны сериализоваться через pickle.
+        
+        Args:
+            func (callable): Функция уровня модуля
+            timeout (float, optional): Таймаут в секундах
             
-            cursor.execute(
-                "INSERT INTO sales (product_id, product_name, amount, date, user_id) VALUES (?, ?, ?, ?, ?)",
-                (product["id"], product["name"], round(price, 2), date.strftime("%Y-%m-%d"), user_id)
-            )
+        Returns:
+            Результат функции
+        """
+        self.start()
+        return await self._run(self._cpu_pool, func, args, kwargs, timeout)
     
-    conn.commit()
-    conn.close()
+    def spawn(self, user_id, coro):
+        """
+        Запускает задачу пользователя в фоне, отменяя его предыдущую задачу.
+        
+        Args:
+            user_id (int): ID пользователя в Telegram
+            coro (coroutine): Корутина формирования отчета или статистики
+            
+        Returns:
+            asyncio.Task: Запущенная задача
+        """
+        self.cancel_user_jobs(user_id)
+        task = asyncio.create_task(self._guarded(user_id, coro))
+        self._user_jobs[user_id] = task
+        task.add_done_callback(functools.partial(self._forget, user_id))
+        # Корутина могла не стартовать, если задачу отменили до запуска или пока она ждала семафор
+        task.add_done_callback(lambda _: coro.close())
+        return task
+    
+    async def _guarded(self, user_id, coro):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_jobs)
+        
+        try:
+            async with self._semaphore:
+                return await asyncio.wait_for(coro, self.job_timeout)
+        except asyncio.TimeoutError:
+            logging.error(f"Задача пользователя {user_id} превысила таймаут {self.job_timeout} с")
+            try:
+                await outbox.send_message(user_id, "Превышено время ожидания. Попробуйте выбрать период поменьше.")
+            except Exception as send_error:
+                logging.error(f"Не удалось отправить сообщение об ошибке: {send_error}")
+        except asyncio.CancelledError:
+            logging.info(f"Задача пользователя {user_id} отменена")
+            raise
     
-    logging.info("Тестовые данные сгенерированы")
+    def _forget(self, user_id, task):
+        if self._user_jobs.get(user_id) is task:
+            del self._user_jobs[user_id]
+    
+    def cancel_user_jobs(self, user_id):
+        """
+        Отменяет выполняющуюся задачу пользователя, если она есть.
+        
+        Args:
+            user_id (int): ID пользователя в Telegram
+            
+        Returns:
+            bool: True, если задача была отменена
+        """
+        task = self._user_jobs.pop(user_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            return True
+        return False
 
-# Создаем клавиатуры для меню
-def get_main_keyboard():
+job_executor = JobExecutor()
+
+# Объединение одинаковых одновременных вычислений
+class SingleFlight:
     """
-    Создает основную клавиатуру с кнопками команд бота.
+    Объединяет одновременные одинаковые вычисления: пока вычисление по ключу
+    выполняется, повторные запросы с тем же ключом не запускают его заново,
+    а дожидаются и получают тот же результат. Завершенные вычисления не
+    запоминаются - повторное использование результатов обеспечивают кэши.
     
-    Returns:
-        ReplyKeyboardMarkup: Объект клавиатуры с кнопками команд
+    Вычисление выполняется в отдельной задаче, поэтому отмена одного из
+    ожидающих (например, командой /cancel) не прерывает его для остальных.
+    Первый элемент ключа - вид вычисления, по нему ведутся метрики.
     """
-    keyboard = ReplyKeyboardMarkup(
-        keyboard=[
-            [KeyboardButton(text="/report"), KeyboardButton(text="/stats")]
-        ],
-        resize_keyboard=True
-    )
-    return keyboard
+    
+    def __init__(self):
+        self._flights = {}
+        self.calls = {}
+        self.shared = {}
+    
+    def _join(self, key, func, args, kwargs, release=None):
+        kind = key[0]
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        
+        flight = self._flights.get(key)
+        if flight is not None:
+            self.shared[kind] = self.shared.get(kind, 0) + 1
+            return flight
+        
+        flight = {
+            'task': asyncio.ensure_future(func(*args, **kwargs)),
+            'users': 0,
+            'release': release,
+            'released': False,
+        }
+        self._flights[key] = flight
+        flight['task'].add_done_callback(functools.partial(self._finish, key, flight))
+        return flight
+    
+    def _finish(self, key, flight, task):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+        if not task.cancelled():
+            # Ошибка передается ожидающим; здесь она только помечается как полученная
+            task.exception()
+        self._release(flight)
+    
+    def _release(self, flight):
+        # Результат освобождается, когда вычисление завершено и им больше никто не пользуется
+        task = flight['task']
+        if flight['release'] is None or flight['released'] or flight['users'] > 0 or not task.done():
+            return
+        if task.cancelled() or task.exception() is not None:
+            return
+        flight['released'] = True
+        try:
+            flight['release'](task.result())
+        except Exception as e:
+            logging.error(f"Ошибка при освобождении общего результата: {e}")
+    
+    async def do(self, key, func, *args, **kwargs):
+        """
+        Выполняет вычисление или присоединяется к уже выполняющемуся с тем же ключом.
+        
+        Args:
+            key (tuple): Ключ вычисления, первый элемент - вид вычисления
+            func (callable): Асинхронная функция вычисления
+            *args, **kwargs: Аргументы функции
+            
+        Returns:
+            Результат вычисления (общий для всех ожидающих, изменять его нельзя)
+        """
+        flight = self._join(key, func, args, kwargs)
+        return await asyncio.shield(flight['task'])
+    
+    @contextlib.asynccontextmanager
+    async def share(self, key, func, *args, release=None, **kwargs):
+        """
+        То же, что do, для результатов, которые нужно освободить после использования
+        (например, буферов выгрузки): release вызывается один раз, когда последний
+        участник выйдет из блока with.
+        
+        Args:
+            key (tuple): Ключ вычисления, первый элемент - вид вычисления
+            func (callable): Асинхронная функция вычисления
+            *args, **kwargs: Аргументы функции
+            release (callable, optional): Функция освобождения результата
+            
+        Yields:
+            Результат вычисления
+        """
+        flight = self._join(key, func, args, kwargs, release)
+        flight['users'] += 1
+        try:
+            yield await asyncio.shield(flight['task'])
+        finally:
+            flight['users'] -= 1
+            self._release(flight)
+    
+    def metrics(self):
+        """
+        Возвращает метрики объединения запросов.
+        
+        Returns:
+            dict: Количество выполняющихся вычислений, вызовов, присоединений к уже
+                выполняющимся вычислениям и их доля, в том числе по видам вычислений
+        """
+        calls = sum(self.calls.values())
+        shared = sum(self.shared.values())
+        return {
+            'in_flight': len(self._flights),
+            'calls': calls,
+            'shared': shared,
+            'dedup_ratio': round(shared / calls, 3) if calls else 0.0,
+            'by_kind': {
+                kind: {'calls': count, 'shared': self.shared.get(kind, 0)}
+                for kind, count in self.calls.items()
+            },
+        }
 
-def get_report_type_keyboard():
+request_flights = SingleFlight()
+
+# Инициализация базы данных
+def init_db():
     """
-    Создает клавиатуру для выбора типа отчета.
-    
-    Returns:
-        InlineKeyboardMarkup: Объект инлайн-клавиатуры с типами отчетов
+    Инициализирует базу данных SQLite: применяет недостающие миграции схемы
+    и проверяет планы выполнения отчетных запросов.
     """
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="Продажи", callback_data="report_sales")],
-            [InlineKeyboardButton(text="Активность пользователей", callback_data="report_activity")]
-        ]
-    )
-    return keyboard
+    with db_pool.writer() as conn:
+        applied = run_migrations(conn)
+        # Индексы и триггеры, снятые прерванной массовой загрузкой
+        restored = _restore_dropped_objects(conn)
+    
+    for name in restored:
+        logging.warning(f"Восстановлен объект схемы после прерванной загрузки: {name}")
+    
+    for version, description in applied:
+        logging.info(f"Применена миграция {version}: {description}")
+    
+    for problem in check_query_plans():
+        logging.warning(f"Отчетный запрос выполняется полным сканированием: {problem}")
+    
+    logging.info("База данных инициализирована")
 
-def get_period_keyboard():
+def _create_tables(conn):
     """
-    Создает клавиатуру для выбора периода отчета/статистики.
+    Создает таблицы продаж, пользователей и действий пользователей.
     
-    Returns:
-        InlineKeyboardMarkup: Объект инлайн-клавиатуры с периодами
+    Args:
+        conn (sqlite3.Connection): Соединение для записи
     """
-    keyboard = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="День", callback_data="period_day")],
-            [InlineKeyboardButton(text="Неделя", callback_data="period_week")],
-            [InlineKeyboardButton(text="Месяц", callback_data="period_month")],
-            [InlineKeyboardButton(text="Год", callback_data="period_year")],
-            [InlineKeyboardButton(text="Указать диапазон", callback_data="period_custom")]
-        ]
+    cursor = conn.cursor()
+    
+    # Создание таблицы продаж
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS sales (
+        id INTEGER PRIMARY KEY,
+        product_id INTEGER,
+        product_name TEXT,
+        amount REAL,
+        date TEXT,
+        user_id INTEGER
+    )
+    ''')
+    
+    # Создание таблицы пользователей
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER UNIQUE,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        registration_date TEXT,
+        last_activity TEXT
+    )
+    ''')
+    
+    # Создание таблицы действий пользователей
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS user_activity (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER,
+        action_type TEXT,
+        action_date TEXT,
+        additional_data TEXT
+    )
+    ''')
+
+# Текущая схема хранения: даты - целые числа (см. epoch_day), названия товаров
+# и типов действий - ключи справочников
+STORAGE_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS products (
+        product_key INTEGER PRIMARY KEY,
+        product_name TEXT NOT NULL UNIQUE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS action_types (
+        action_key INTEGER PRIMARY KEY,
+        action_type TEXT NOT NULL UNIQUE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS sales (
+        id INTEGER PRIMARY KEY,
+        product_id INTEGER,
+        product_key INTEGER,
+        amount REAL,
+        day INTEGER,
+        user_id INTEGER
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY,
+        user_id INTEGER UNIQUE,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        registration_ts INTEGER,
+        last_activity_ts INTEGER
+    )
+    ''',
+    "CREATE INDEX IF NOT EXISTS idx_sales_day_product_amount ON sales(day, product_key, amount)",
+    '''
+    CREATE TABLE IF NOT EXISTS activity_partitions (
+        month TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'active',
+        row_count INTEGER,
+        created_at TEXT,
+        compacted_at TEXT,
+        archive_path TEXT
+    ) WITHOUT ROWID
+    ''',
+)
+
+# Агрегированные по дням таблицы и триггеры продаж, поддерживающие их при вставке и удалении строк
+# (триггеры журнала активности создаются для каждой секции)
+ROLLUP_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS sales_daily (
+        day INTEGER,
+        product_key INTEGER,
+        total_amount REAL,
+        sales_count INTEGER,
+        PRIMARY KEY (day, product_key)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS activity_daily (
+        day INTEGER,
+        user_id INTEGER,
+        action_key INTEGER,
+        action_count INTEGER,
+        PRIMARY KEY (day, user_id, action_key)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        name TEXT PRIMARY KEY,
+        valid INTEGER,
+        built_at TEXT
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_sales_daily_insert AFTER INSERT ON sales
+    BEGIN
+        INSERT INTO sales_daily (day, product_key, total_amount, sales_count)
+        VALUES (NEW.day, NEW.product_key, NEW.amount, 1)
+        ON CONFLICT (day, product_key) DO UPDATE SET
+            total_amount = total_amount + excluded.total_amount,
+            sales_count = sales_count + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_sales_daily_delete AFTER DELETE ON sales
+    BEGIN
+        UPDATE sales_daily
+        SET total_amount = total_amount - OLD.amount, sales_count = sales_count - 1
+        WHERE day = OLD.day AND product_key = OLD.product_key;
+        DELETE FROM sales_daily
+        WHERE day = OLD.day AND product_key = OLD.product_key AND sales_count <= 0;
+    END
+    ''',
+)
+
+def _backfill_rollups(conn, names=('sales_daily', 'activity_daily')):
+    """
+    Полностью пересчитывает агрегированные таблицы по исходным данным.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение для записи внутри транзакции
+        names (tuple): Имена пересчитываемых таблиц
+    """
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    if 'sales_daily' in names:
+        conn.execute("DELETE FROM sales_daily")
+        conn.execute('''
+        INSERT INTO sales_daily (day, product_key, total_amount, sales_count)
+        SELECT day, product_key, SUM(amount), COUNT(*)
+        FROM sales
+        GROUP BY day, product_key
+        ''')
+    
+    if 'activity_daily' in names:
+        # Итоги сжатых месяцев пересчитать не из чего: исходных строк уже нет
+        ranges = [_month_days(month) for month in _compacted_activity_months(conn)]
+        conn.execute(
+            "DELETE FROM activity_daily"
+            + (f" WHERE NOT ({' OR '.join(['(day >= ? AND day < ?)'] * len(ranges))})" if ranges else ""),
+            [day for day_range in ranges for day in day_range]
+        )
+        conn.execute('''
+        INSERT INTO activity_daily (day, user_id, action_key, action_count)
+        SELECT action_ts / 86400, user_id, action_key, COUNT(*)
+        FROM user_activity
+        GROUP BY action_ts / 86400, user_id, action_key
+        ''')
+    
+    conn.executemany(
+        "INSERT OR REPLACE INTO rollup_state (name, valid, built_at) VALUES (?, 1, ?)",
+        [(name, now) for name in names]
+    )
+
+# Функция для пересборки агрегированных таблиц
+def rebuild_rollups():
+    """
+    Пересобирает агрегированные по дням таблицы продаж и активности.
+    Пересборка выполняется одной транзакцией, поэтому читатели не видят частичных данных.
+    """
+    started = time.perf_counter()
+    with db_pool.writer() as conn:
+        _backfill_rollups(conn)
+    logging.info(f"Агрегированные таблицы пересобраны за {time.perf_counter() - started:.2f} с")
+
+# Функция для проверки актуальности агрегированной таблицы
+def rollup_is_valid(conn, name):
+    """
+    Проверяет, что агрегированная таблица построена и покрывает все исходные данные.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        name (str): Имя агрегированной таблицы
+        
+    Returns:
+        bool: True, если запросы можно выполнять по агрегированной таблице
+    """
+    row = conn.execute("SELECT valid FROM rollup_state WHERE name = ?", (name,)).fetchone()
+    return bool(row and row[0])
+
+# Секционирование журнала активности: отдельная таблица на каждый месяц
+ACTIVITY_PARTITION_PREFIX = 'user_activity_'
+ACTIVITY_COLUMNS = 'id, user_id, action_key, action_ts, additional_data'
+
+# Таблица секции, индекс и триггеры агрегированной таблицы activity_daily
+ACTIVITY_PARTITION_TABLE = '''
+CREATE TABLE IF NOT EXISTS {name} (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    action_key INTEGER,
+    action_ts INTEGER,
+    additional_data TEXT
+)
+'''
+
+ACTIVITY_PARTITION_OBJECTS = (
+    "CREATE INDEX IF NOT EXISTS idx_{name}_ts_user_action ON {name}(action_ts, user_id, action_key)",
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_{name}_rollup_insert AFTER INSERT ON {name}
+    BEGIN
+        INSERT INTO activity_daily (day, user_id, action_key, action_count)
+        VALUES (NEW.action_ts / 86400, NEW.user_id, NEW.action_key, 1)
+        ON CONFLICT (day, user_id, action_key) DO UPDATE SET
+            action_count = action_count + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_{name}_rollup_delete AFTER DELETE ON {name}
+    BEGIN
+        UPDATE activity_daily
+        SET action_count = action_count - 1
+        WHERE day = OLD.action_ts / 86400 AND user_id = OLD.user_id AND action_key = OLD.action_key;
+        DELETE FROM activity_daily
+        WHERE day = OLD.action_ts / 86400 AND user_id = OLD.user_id AND action_key = OLD.action_key
+            AND action_count <= 0;
+    END
+    ''',
+)
+
+def activity_partition_name(month):
+    """
+    Возвращает имя таблицы секции журнала активности.
+    
+    Args:
+        month (str): Месяц в формате 'YYYY-MM'
+        
+    Returns:
+        str: Имя таблицы, например 'user_activity_202401'
+    """
+    return ACTIVITY_PARTITION_PREFIX + month.replace('-', '')
+
+def _next_month(month):
+    year, number = int(month[:4]), int(month[5:7])
+    return f"{year + number // 12:04d}-{number % 12 + 1:02d}"
+
+def _month_days(month):
+    # Номера первого дня месяца и первого дня следующего месяца
+    return epoch_day(f"{month}-01"), epoch_day(f"{_next_month(month)}-01")
+
+def activity_partition_names(conn):
+    """
+    Возвращает имена таблиц действующих (не сжатых) секций.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        
+    Returns:
+        list: Имена таблиц в порядке месяцев
+    """
+    return [name for (name,) in conn.execute(
+        "SELECT name FROM activity_partitions WHERE state = 'active' ORDER BY month"
+    )]
+
+def _activity_select(names):
+    # Без секций - пустая выборка с теми же столбцами
+    if not names:
+        return "SELECT NULL AS id, NULL AS user_id, NULL AS action_key, NULL AS action_ts, NULL AS additional_data WHERE 0"
+    return " UNION ALL ".join(f"SELECT {ACTIVITY_COLUMNS} FROM {name}" for name in names)
+
+def _rebuild_activity_view(conn):
+    """
+    Пересоздает представление user_activity - объединение всех действующих секций.
+    Оно сохраняет совместимость для чтения всего журнала, а запросы за период
+    читают только нужные секции через activity_source.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение внутри транзакции записи
+    """
+    conn.execute("DROP VIEW IF EXISTS user_activity")
+    conn.execute(f"CREATE VIEW user_activity AS {_activity_select(activity_partition_names(conn))}")
+
+def _create_activity_partition(conn, month, with_objects=True):
+    name = activity_partition_name(month)
+    conn.execute(ACTIVITY_PARTITION_TABLE.format(name=name))
+    if with_objects:
+        for statement in ACTIVITY_PARTITION_OBJECTS:
+            conn.execute(statement.format(name=name))
+    conn.execute(
+        "INSERT OR IGNORE INTO activity_partitions (month, name, state, created_at) VALUES (?, ?, 'active', ?)",
+        (month, name, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+    )
+    return name
+
+def ensure_activity_partitions(conn, months):
+    """
+    Создает недостающие секции для указанных месяцев.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение внутри транзакции записи
+        months (iterable): Месяцы в формате 'YYYY-MM'
+        
+    Returns:
+        dict: {месяц: состояние секции ('active' или 'compacted')}
+    """
+    months = sorted(set(months))
+    placeholders = ', '.join('?' * len(months))
+    states = dict(conn.execute(
+        f"SELECT month, state FROM activity_partitions WHERE month IN ({placeholders})",
+        months
+    ).fetchall())
+    
+    missing = [month for month in months if month not in states]
+    for month in missing:
+        _create_activity_partition(conn, month)
+        states[month] = 'active'
+    if missing:
+        _rebuild_activity_view(conn)
+        logging.info(f"Созданы секции журнала активности: {', '.join(missing)}")
+    return states
+
+def insert_activity_rows(conn, rows):
+    """
+    Записывает действия пользователей в секции по месяцу действия: типы действий
+    заменяются ключами справочника, время - секундами от 1970-01-01.
+    Действия за уже сжатые месяцы учитываются только в дневных итогах activity_daily.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение внутри транзакции записи
+        rows (list): Кортежи (user_id, action_type, action_date, additional_data)
+    """
+    if not rows:
+        return
+    keys = action_types.keys(conn, {row[1] for row in rows})
+    timestamps = np.array([row[2] for row in rows], dtype='datetime64[s]').astype(np.int64).tolist()
+    
+    by_month = {}
+    for (user_id, action_type, action_date, additional_data), timestamp in zip(rows, timestamps):
+        by_month.setdefault(action_date[:7], []).append((user_id, keys[action_type], timestamp, additional_data))
+    
+    states = ensure_activity_partitions(conn, by_month)
+    for month, month_rows in by_month.items():
+        if states[month] == 'compacted':
+            conn.executemany(
+                '''
+                INSERT INTO activity_daily (day, user_id, action_key, action_count)
+                VALUES (? / 86400, ?, ?, 1)
+                ON CONFLICT (day, user_id, action_key) DO UPDATE SET action_count = action_count + 1
+                ''',
+                [(timestamp, user_id, action_key) for user_id, action_key, timestamp, _ in month_rows]
+            )
+        else:
+            conn.executemany(
+                f"INSERT INTO {activity_partition_name(month)} (user_id, action_key, action_ts, additional_data) "
+                "VALUES (?, ?, ?, ?)",
+                month_rows
+            )
+
+def delete_activity_rows(conn, condition, params=()):
+    """
+    Удаляет действия пользователей из всех действующих секций.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение внутри транзакции записи
+        condition (str): Условие WHERE
+        params (tuple): Параметры условия
+        
+    Returns:
+        int: Количество удаленных строк
+    """
+    return sum(
+        conn.execute(f"DELETE FROM {name} WHERE {condition}", params).rowcount
+        for name in activity_partition_names(conn)
+    )
+
+def activity_source(conn, start_date, end_date):
+    """
+    Возвращает источник строк журнала активности за период для подстановки
+    в FROM: таблицу единственной секции или объединение нужных секций.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение с базой данных
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        
+    Returns:
+        str: Имя таблицы или подзапрос в скобках
+    """
+    names = [name for (name,) in conn.execute(
+        "SELECT name FROM activity_partitions WHERE state = 'active' AND month BETWEEN ? AND ? ORDER BY month",
+        (start_date[:7], end_date[:7])
+    )]
+    if len(names) == 1:
+        return names[0]
+    return f"({_activity_select(names)})"
+
+def _compacted_activity_months(conn):
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'activity_partitions'").fetchone() is None:
+        return []
+    return [month for (month,) in conn.execute("SELECT month FROM activity_partitions WHERE state = 'compacted'")]
+
+# Агрегированные таблицы и секции журнала в схеме до миграции 8 (даты - строки,
+# названия - текст). Используются только миграциями 3 и 7 и не меняются
+LEGACY_ROLLUP_SCHEMA = (
+    '''
+    CREATE TABLE IF NOT EXISTS sales_daily (
+        date TEXT,
+        product_name TEXT,
+        total_amount REAL,
+        sales_count INTEGER,
+        PRIMARY KEY (date, product_name)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS activity_daily (
+        date TEXT,
+        user_id INTEGER,
+        action_type TEXT,
+        action_count INTEGER,
+        PRIMARY KEY (date, user_id, action_type)
+    ) WITHOUT ROWID
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        name TEXT PRIMARY KEY,
+        valid INTEGER,
+        built_at TEXT
+    )
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_sales_daily_insert AFTER INSERT ON sales
+    BEGIN
+        INSERT INTO sales_daily (date, product_name, total_amount, sales_count)
+        VALUES (NEW.date, NEW.product_name, NEW.amount, 1)
+        ON CONFLICT (date, product_name) DO UPDATE SET
+            total_amount = total_amount + excluded.total_amount,
+            sales_count = sales_count + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_sales_daily_delete AFTER DELETE ON sales
+    BEGIN
+        UPDATE sales_daily
+        SET total_amount = total_amount - OLD.amount, sales_count = sales_count - 1
+        WHERE date = OLD.date AND product_name = OLD.product_name;
+        DELETE FROM sales_daily
+        WHERE date = OLD.date AND product_name = OLD.product_name AND sales_count <= 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_activity_daily_insert AFTER INSERT ON user_activity
+    BEGIN
+        INSERT INTO activity_daily (date, user_id, action_type, action_count)
+        VALUES (SUBSTR(NEW.action_date, 1, 10), NEW.user_id, NEW.action_type, 1)
+        ON CONFLICT (date, user_id, action_type) DO UPDATE SET
+            action_count = action_count + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_activity_daily_delete AFTER DELETE ON user_activity
+    BEGIN
+        UPDATE activity_daily
+        SET action_count = action_count - 1
+        WHERE date = SUBSTR(OLD.action_date, 1, 10) AND user_id = OLD.user_id AND action_type = OLD.action_type;
+        DELETE FROM activity_daily
+        WHERE date = SUBSTR(OLD.action_date, 1, 10) AND user_id = OLD.user_id AND action_type = OLD.action_type
+            AND action_count <= 0;
+    END
+    ''',
+)
+
+LEGACY_ACTIVITY_COLUMNS = 'id, user_id, action_type, action_date, additional_data'
+
+LEGACY_ACTIVITY_PARTITION_TABLE = '''
+CREATE TABLE IF NOT EXISTS {name} (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER,
+    action_type TEXT,
+    action_date TEXT,
+    additional_data TEXT
+)
+'''
+
+LEGACY_ACTIVITY_PARTITION_OBJECTS = (
+    "CREATE INDEX IF NOT EXISTS idx_{name}_date_user_action ON {name}(action_date, user_id, action_type)",
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_{name}_rollup_insert AFTER INSERT ON {name}
+    BEGIN
+        INSERT INTO activity_daily (date, user_id, action_type, action_count)
+        VALUES (SUBSTR(NEW.action_date, 1, 10), NEW.user_id, NEW.action_type, 1)
+        ON CONFLICT (date, user_id, action_type) DO UPDATE SET
+            action_count = action_count + 1;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_{name}_rollup_delete AFTER DELETE ON {name}
+    BEGIN
+        UPDATE activity_daily
+        SET action_count = action_count - 1
+        WHERE date = SUBSTR(OLD.action_date, 1, 10) AND user_id = OLD.user_id AND action_type = OLD.action_type;
+        DELETE FROM activity_daily
+        WHERE date = SUBSTR(OLD.action_date, 1, 10) AND user_id = OLD.user_id AND action_type = OLD.action_type
+            AND action_count <= 0;
+    END
+    ''',
+)
+
+def _backfill_legacy_rollups(conn, names=('sales_daily', 'activity_daily')):
+    """
+    Пересчитывает агрегированные таблицы в схеме до миграции 8.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение для записи внутри транзакции
+        names (tuple): Имена пересчитываемых таблиц
+    """
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    if 'sales_daily' in names:
+        conn.execute("DELETE FROM sales_daily")
+        conn.execute('''
+        INSERT INTO sales_daily (date, product_name, total_amount, sales_count)
+        SELECT date, product_name, SUM(amount), COUNT(*)
+        FROM sales
+        GROUP BY date, product_name
+        ''')
+    
+    if 'activity_daily' in names:
+        # Итоги сжатых месяцев пересчитать не из чего: исходных строк уже нет
+        compacted = _compacted_activity_months(conn)
+        conn.execute(
+            f"DELETE FROM activity_daily WHERE SUBSTR(date, 1, 7) NOT IN ({', '.join('?' * len(compacted))})",
+            compacted
+        )
+        conn.execute('''
+        INSERT INTO activity_daily (date, user_id, action_type, action_count)
+        SELECT SUBSTR(action_date, 1, 10), user_id, action_type, COUNT(*)
+        FROM user_activity
+        GROUP BY SUBSTR(action_date, 1, 10), user_id, action_type
+        ''')
+    
+    conn.executemany(
+        "INSERT OR REPLACE INTO rollup_state (name, valid, built_at) VALUES (?, 1, ?)",
+        [(name, now) for name in names]
+    )
+
+def _create_rollups(conn):
+    """
+    Создает агрегированные таблицы с триггерами и заполняет их существующими данными.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение для записи
+    """
+    for statement in LEGACY_ROLLUP_SCHEMA:
+        conn.execute(statement)
+    _backfill_legacy_rollups(conn)
+
+def _partition_user_activity(conn):
+    """
+    Переносит журнал активности из единой таблицы в помесячные секции
+    и заменяет таблицу представлением.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение для записи
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS activity_partitions (
+        month TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        state TEXT NOT NULL DEFAULT 'active',
+        row_count INTEGER,
+        created_at TEXT,
+        compacted_at TEXT,
+        archive_path TEXT
+    ) WITHOUT ROWID
+    ''')
+    
+    legacy = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_activity'").fetchone()
+    if legacy is not None:
+        months = [month for (month,) in conn.execute(
+            "SELECT DISTINCT SUBSTR(action_date, 1, 7) FROM user_activity WHERE action_date IS NOT NULL"
+        )]
+        # Строки копируются до создания триггеров: дневные итоги уже посчитаны
+        for month in months:
+            name = activity_partition_name(month)
+            conn.execute(LEGACY_ACTIVITY_PARTITION_TABLE.format(name=name))
+            conn.execute(
+                "INSERT INTO activity_partitions (month, name, state, created_at) VALUES (?, ?, 'active', ?)",
+                (month, name, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            )
+            conn.execute(
+                f"INSERT INTO {name} ({LEGACY_ACTIVITY_COLUMNS}) SELECT {LEGACY_ACTIVITY_COLUMNS} FROM user_activity "
+                "WHERE action_date >= ? AND action_date < ?",
+                (month, _next_month(month))
+            )
+        conn.execute("DROP TABLE user_activity")
+        for month in months:
+            for statement in LEGACY_ACTIVITY_PARTITION_OBJECTS:
+                conn.execute(statement.format(name=activity_partition_name(month)))
+        
+        # Индекс и триггеры старой таблицы, снятые прерванной загрузкой, больше не нужны
+        conn.execute(
+            "DELETE FROM ingest_dropped_objects WHERE name IN (?, ?, ?)",
+            ('idx_user_activity_date_user_action', 'trg_activity_daily_insert', 'trg_activity_daily_delete')
+        )
+    
+    names = activity_partition_names(conn)
+    conn.execute("DROP VIEW IF EXISTS user_activity")
+    if names:
+        select = " UNION ALL ".join(f"SELECT {LEGACY_ACTIVITY_COLUMNS} FROM {name}" for name in names)
+    else:
+        select = ("SELECT NULL AS id, NULL AS user_id, NULL AS action_type, NULL AS action_date, "
+                  "NULL AS additional_data WHERE 0")
+    conn.execute(f"CREATE VIEW user_activity AS {select}")
+    if not rollup_is_valid(conn, 'activity_daily'):
+        _backfill_legacy_rollups(conn, ('activity_daily',))
+
+def _encode_storage(conn):
+    """
+    Переводит базу, построенную миграциями 1-7 (или прерванной на любой из них
+    версией), в текущую схему (STORAGE_SCHEMA): даты - в номера дней
+    и секунды от 1970-01-01, названия товаров и типов действий - в ключи справочников,
+    журнал активности - в помесячные секции. Таблицы пересоздаются с переносом строк,
+    агрегированные таблицы пересчитываются, итоги сжатых месяцев журнала переносятся как есть.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение для записи
+    """
+    def exists(name):
+        return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+    
+    # Сначала все прежние таблицы переименовываются: триггеры между ними остаются согласованными
+    compacted = _compacted_activity_months(conn)
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'view' AND name = 'user_activity'").fetchone():
+        conn.execute("DROP VIEW user_activity")
+    sources = {}  # месяц -> (таблица, условие, параметры)
+    if exists('user_activity'):
+        conn.execute("ALTER TABLE user_activity RENAME TO user_activity_legacy")
+        for (month,) in conn.execute(
+            "SELECT DISTINCT SUBSTR(action_date, 1, 7) FROM user_activity_legacy WHERE action_date IS NOT NULL"
+        ).fetchall():
+            sources[month] = ('user_activity_legacy', "action_date >= ? AND action_date < ?", (month, _next_month(month)))
+    elif exists('activity_partitions'):
+        for month, name in conn.execute("SELECT month, name FROM activity_partitions WHERE state = 'active'").fetchall():
+            conn.execute(f"ALTER TABLE {name} RENAME TO {name}_legacy")
+            sources[month] = (f"{name}_legacy", "1", ())
+    legacy_tables = [name for name in ('sales', 'users', 'sales_daily', 'activity_daily') if exists(name)]
+    for name in legacy_tables:
+        conn.execute(f"ALTER TABLE {name} RENAME TO {name}_legacy")
+    
+    for statement in STORAGE_SCHEMA:
+        conn.execute(statement)
+    
+    conn.execute('''
+    INSERT OR IGNORE INTO products (product_name)
+    SELECT DISTINCT product_name FROM sales_legacy WHERE product_name IS NOT NULL ORDER BY 1
+    ''')
+    conn.execute('''
+    INSERT INTO sales (id, product_id, product_key, amount, day, user_id)
+    SELECT s.id, s.product_id, p.product_key, s.amount, CAST(strftime('%s', s.date) AS INTEGER) / 86400, s.user_id
+    FROM sales_legacy s LEFT JOIN products p ON p.product_name = s.product_name
+    ''')
+    conn.execute('''
+    INSERT INTO users (id, user_id, username, first_name, last_name, registration_ts, last_activity_ts)
+    SELECT id, user_id, username, first_name, last_name,
+        CAST(strftime('%s', registration_date) AS INTEGER), CAST(strftime('%s', last_activity) AS INTEGER)
+    FROM users_legacy
+    ''')
+    
+    for month, (table, condition, params) in sorted(sources.items()):
+        conn.execute(
+            f"INSERT OR IGNORE INTO action_types (action_type) SELECT DISTINCT action_type FROM {table} "
+            f"WHERE {condition} AND action_type IS NOT NULL",
+            params
+        )
+        # Триггеры секции создаются после переноса: итоги пересчитываются ниже целиком
+        name = _create_activity_partition(conn, month, with_objects=False)
+        conn.execute(
+            f'''
+            INSERT INTO {name} ({ACTIVITY_COLUMNS})
+            SELECT t.id, t.user_id, a.action_key, CAST(strftime('%s', t.action_date) AS INTEGER), t.additional_data
+            FROM {table} t LEFT JOIN action_types a ON a.action_type = t.action_type
+            WHERE {condition}
+            ''',
+            params
+        )
+    
+    for table in sorted({table for table, _, _ in sources.values()}) + [f"{name}_legacy" for name in legacy_tables]:
+        if table != 'activity_daily_legacy':
+            conn.execute(f"DROP TABLE {table}")
+    
+    for statement in ROLLUP_SCHEMA:
+        conn.execute(statement)
+    if 'activity_daily' in legacy_tables:
+        conn.execute('''
+        INSERT OR IGNORE INTO action_types (action_type)
+        SELECT DISTINCT action_type FROM activity_daily_legacy WHERE action_type IS NOT NULL
+        ''')
+        for month in compacted:
+            conn.execute(
+                '''
+                INSERT INTO activity_daily (day, user_id, action_key, action_count)
+                SELECT CAST(strftime('%s', l.date) AS INTEGER) / 86400, l.user_id, a.action_key, l.action_count
+                FROM activity_daily_legacy l JOIN action_types a ON a.action_type = l.action_type
+                WHERE l.date >= ? AND l.date < ?
+                ''',
+                (month, _next_month(month))
+            )
+        conn.execute("DROP TABLE activity_daily_legacy")
+    
+    for name in activity_partition_names(conn):
+        for statement in ACTIVITY_PARTITION_OBJECTS:
+            conn.execute(statement.format(name=name))
+    _rebuild_activity_view(conn)
+    _backfill_rollups(conn)
+    
+    # Снятые прерванной загрузкой объекты и готовые выгрузки относятся к прежней схеме
+    conn.execute("DELETE FROM ingest_dropped_objects")
+    conn.execute("DELETE FROM report_artifacts")
+
+# Миграции схемы базы данных: (версия, описание, функция или список SQL-выражений).
+# Новые миграции добавляются только в конец списка с увеличением версии.
+MIGRATIONS = [
+    (1, "Таблицы продаж, пользователей и действий", _create_tables),
+    (2, "Покрывающие индексы для отчетных запросов", (
+        "CREATE INDEX IF NOT EXISTS idx_sales_date_product_amount ON sales(date, product_name, amount)",
+        "CREATE INDEX IF NOT EXISTS idx_user_activity_date_user_action ON user_activity(action_date, user_id, action_type)",
+    )),
+    (3, "Агрегированные по дням таблицы продаж и активности", _create_rollups),
+    (4, "Общее хранилище состояний FSM", (
+        '''
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            bot_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            thread_id INTEGER NOT NULL DEFAULT 0,
+            destiny TEXT NOT NULL,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}',
+            updated_at TEXT,
+            PRIMARY KEY (bot_id, chat_id, user_id, thread_id, destiny)
+        ) WITHOUT ROWID
+        ''',
+    )),
+    (5, "Контрольные точки массовой загрузки продаж", (
+        '''
+        CREATE TABLE IF NOT EXISTS ingest_checkpoints (
+            source TEXT PRIMARY KEY,
+            fingerprint TEXT,
+            rows_done INTEGER,
+            inserted INTEGER,
+            rejected INTEGER,
+            updated_at TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS ingest_dropped_objects (
+            name TEXT PRIMARY KEY,
+            sql TEXT
+        )
+        ''',
+    )),
+    (6, "Готовые выгрузки отчетов, подписки и отметки планировщика", (
+        '''
+        CREATE TABLE IF NOT EXISTS report_artifacts (
+            report_type TEXT NOT NULL,
+            start_date TEXT NOT NULL,
+            end_date TEXT NOT NULL,
+            export_format TEXT NOT NULL,
+            fingerprint TEXT,
+            filename TEXT,
+            label TEXT,
+            content BLOB,
+            created_at TEXT,
+            PRIMARY KEY (report_type, start_date, end_date, export_format)
+        ) WITHOUT ROWID
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            user_id INTEGER NOT NULL,
+            report_type TEXT NOT NULL,
+            period_type TEXT NOT NULL,
+            export_format TEXT NOT NULL DEFAULT 'csv',
+            created_at TEXT,
+            PRIMARY KEY (user_id, report_type, period_type)
+        ) WITHOUT ROWID
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_period ON subscriptions(period_type)",
+        '''
+        CREATE TABLE IF NOT EXISTS scheduler_runs (
+            job TEXT PRIMARY KEY,
+            last_run TEXT
+        )
+        ''',
+    )),
+    (7, "Помесячные секции журнала активности", _partition_user_activity),
+    (8, "Целочисленные даты и справочники товаров и типов действий", _encode_storage),
+    (9, "Поколения данных для сброса кэшей отчетов в других процессах", (
+        '''
+        CREATE TABLE IF NOT EXISTS data_generations (
+            kind TEXT PRIMARY KEY,
+            generation INTEGER NOT NULL
+        ) WITHOUT ROWID
+        ''',
+        "INSERT OR IGNORE INTO data_generations (kind, generation) VALUES ('sales', 0), ('activity', 0)",
+    )),
+]
+
+def run_migrations(conn):
+    """
+    Применяет миграции, версия которых больше текущей версии схемы.
+    Повторный запуск безопасен: уже примененные миграции пропускаются.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение для записи внутри транзакции
+        
+    Returns:
+        list: Список кортежей (версия, описание) примененных миграций
+    """
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at TEXT
+    )
+    ''')
+    current = conn.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+    
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if version <= current:
+            continue
+        
+        if callable(step):
+            step(conn)
+        else:
+            for statement in step:
+                conn.execute(statement)
+        
+        conn.execute(
+            "INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+            (version, description, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+        applied.append((version, description))
+    
+    return applied
+
+# Хранилище состояний FSM в базе данных
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище состояний и данных FSM в таблице fsm_storage.
+    
+    В отличие от MemoryStorage, состояние видно всем процессам, работающим
+    с одной базой, и переживает перезапуск бота. Запросы к базе выполняются
+    в пуле потоков, чтобы не блокировать цикл событий.
+    """
+    
+    @staticmethod
+    def _key(key):
+        return (key.bot_id, key.chat_id, key.user_id, key.thread_id or 0, key.destiny)
+    
+    def _read(self, key, column):
+        with db_pool.reader() as conn:
+            row = conn.execute(
+                f"""
+                SELECT {column} FROM fsm_storage
+                WHERE bot_id = ? AND chat_id = ? AND user_id = ? AND thread_id = ? AND destiny = ?
+                """,
+                self._key(key)
+            ).fetchone()
+        return row[0] if row else None
+    
+    def _write(self, key, column, value):
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with db_pool.writer() as conn:
+            conn.execute(
+                f"""
+                INSERT INTO fsm_storage (bot_id, chat_id, user_id, thread_id, destiny, {column}, updated_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(bot_id, chat_id, user_id, thread_id, destiny)
+                DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at
+                """,
+                self._key(key) + (value, now)
+            )
+            # Пустые записи (без состояния и данных) не храним
+            conn.execute(
+                """
+                DELETE FROM fsm_storage
+                WHERE bot_id = ? AND chat_id = ? AND user_id = ? AND thread_id = ? AND destiny = ?
+                AND state IS NULL AND data = '{}'
+                """,
+                self._key(key)
+            )
+    
+    async def set_state(self, key, state=None):
+        """
+        Устанавливает состояние для ключа.
+        
+        Args:
+            key (StorageKey): Ключ хранилища
+            state (State | str | None): Новое состояние
+        """
+        state = state.state if isinstance(state, State) else state
+        await job_executor.run_io(self._write, key, 'state', state)
+    
+    async def get_state(self, key):
+        """
+        Возвращает текущее состояние для ключа.
+        
+        Args:
+            key (StorageKey): Ключ хранилища
+            
+        Returns:
+            str: Состояние или None
+        """
+        return await job_executor.run_io(self._read, key, 'state')
+    
+    async def set_data(self, key, data):
+        """
+        Заменяет данные для ключа.
+        
+        Args:
+            key (StorageKey): Ключ хранилища
+            data (dict): Новые данные (должны сериализоваться в JSON)
+        """
+        await job_executor.run_io(self._write, key, 'data', json.dumps(data, ensure_ascii=False))
+    
+    async def get_data(self, key):
+        """
+        Возвращает данные для ключа.
+        
+        Args:
+            key (StorageKey): Ключ хранилища
+            
+        Returns:
+            dict: Данные (пустой словарь, если их нет)
+        """
+        raw = await job_executor.run_io(self._read, key, 'data')
+        return json.loads(raw) if raw else {}
+    
+    async def close(self):
+        # Соединения принадлежат общему пулу и закрываются вместе с ним
+        pass
+
+# Хранилище состояний FSM: 'memory' (в памяти процесса) или 'sqlite' (общее для процессов)
+FSM_STORAGE = os.getenv('FSM_STORAGE', 'memory')
+
+FSM_STORAGES = {
+    'memory': MemoryStorage,
+    'sqlite': SQLiteStorage,
+}
+
+def configure_fsm_storage(kind=FSM_STORAGE):
+    """
+    Подключает к диспетчеру хранилище состояний FSM выбранного типа.
+    
+    Args:
+        kind (str): Тип хранилища ('memory' или 'sqlite')
+        
+    Returns:
+        BaseStorage: Подключенное хранилище
+    """
+    global storage
+    storage = FSM_STORAGES[kind]()
+    dp.fsm.storage = storage
+    return storage
+
+# Настройки кэша результатов запросов
+QUERY_CACHE_MAX_BYTES = int(os.getenv('QUERY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+QUERY_CACHE_OPEN_TTL = float(os.getenv('QUERY_CACHE_OPEN_TTL', '30'))
+
+# Кэш результатов отчетных запросов
+class QueryResultCache:
+    """
+    LRU-кэш DataFrame с результатами отчетных запросов, ключ - (вид запроса, начало, конец).
+    
+    Закрытые периоды (конец раньше сегодняшнего дня) хранятся без ограничения по времени,
+    периоды, включающие сегодняшний день, - не дольше open_ttl секунд. Записи удаляются,
+    когда запись в базу затрагивает дату внутри их диапазона, а при превышении
+    бюджета памяти вытесняются давно не использованные записи.
+    
+    Изменения, сделанные другими процессами (рабочими процессами бота, загрузкой
+    из командной строки), определяются по поколению данных в таблице data_generations:
+    каждая запись увеличивает его (record_write), а перед чтением кэша оно сверяется
+    с последним известным (sync). В этом случае удаляются все записи вида.
+    """
+    
+    def __init__(self, max_bytes=QUERY_CACHE_MAX_BYTES, open_ttl=QUERY_CACHE_OPEN_TTL):
+        """
+        Args:
+            max_bytes (int): Бюджет памяти кэша в байтах
+            open_ttl (float): Время жизни записей для периодов, включающих сегодня, в секундах
+        """
+        self.max_bytes = max_bytes
+        self.open_ttl = open_ttl
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._synced = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        
+        # Метрики
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+    
+    def generation(self, kind):
+        """
+        Возвращает номер поколения данных вида kind. Номер увеличивается при каждой
+        инвалидации, что позволяет не сохранять результат запроса, начатого до записи.
+        
+        Args:
+            kind (str): Вид запроса ('sales' или 'activity')
+            
+        Returns:
+            int: Номер поколения
+        """
+        with self._lock:
+            return self._generations.get(kind, 0)
+    
+    def sync(self, conn, kind):
+        """
+        Сверяет поколение данных вида kind в базе с последним известным и удаляет
+        все записи вида, если с тех пор данные изменил другой процесс.
+        
+        Args:
+            conn (sqlite3.Connection): Соединение для чтения
+            kind (str): Вид запроса ('sales' или 'activity')
+        """
+        row = conn.execute("SELECT generation FROM data_generations WHERE kind = ?", (kind,)).fetchone()
+        stored = row[0] if row else 0
+        
+        with self._lock:
+            if self._synced.get(kind) == stored:
+                return
+            self._synced[kind] = stored
+            self._invalidate(kind, None)
+    
+    @staticmethod
+    def record_write(conn, kind):
+        """
+        Увеличивает поколение данных вида kind в базе, чтобы кэши других процессов
+        удалили записи этого вида. Вызывается внутри транзакции записи.
+        
+        Args:
+            conn (sqlite3.Connection): Соединение для записи
+            kind (str): Вид запроса ('sales' или 'activity')
+            
+        Returns:
+            int: Новое поколение; передается в invalidate после фиксации транзакции
+        """
+        conn.execute("UPDATE data_generations SET generation = generation + 1 WHERE kind = ?", (kind,))
+        return conn.execute("SELECT generation FROM data_generations WHERE kind = ?", (kind,)).fetchone()[0]
+    
+    def get(self, key):
+        """
+        Возвращает копию закэшированного DataFrame.
+        
+        Args:
+            key (tuple): Ключ (вид запроса, начальная дата, конечная дата)
+            
+        Returns:
+            pandas.DataFrame: Копия результата или None, если записи нет
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[2] is not None and entry[2] < time.monotonic():
+                self._drop(key)
+                entry = None
+            
+            if entry is None:
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            df = entry[0]
+        
+        return df.copy()
+    
+    def put(self, key, df, generation):
+        """
+        Сохраняет копию DataFrame, если с начала запроса данные не менялись.
+        
+        Args:
+            key (tuple): Ключ (вид запроса, начальная дата, конечная дата)
+            df (pandas.DataFrame): Результат запроса
+            generation (int): Поколение данных, полученное до выполнения запроса
+        """
+        size = int(df.memory_usage(deep=True).sum())
+        if size > self.max_bytes:
+            return
+        
+        kind, _, end_date = key
+        today = datetime.date.today().strftime("%Y-%m-%d")
+        expires_at = None if end_date < today else time.monotonic() + self.open_ttl
+        df = df.copy()
+        
+        with self._lock:
+            if self._generations.get(kind, 0) != generation:
+                return
+            
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (df, size, expires_at)
+            self._bytes += size
+            
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+    
+    def _drop(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+    
+    def invalidate(self, kind, dates=None, written=None):
+        """
+        Удаляет записи, диапазон которых содержит хотя бы одну из измененных дат.
+        
+        Args:
+            kind (str): Вид запроса ('sales' или 'activity')
+            dates (iterable, optional): Измененные даты в формате 'YYYY-MM-DD'; None - все записи вида
+            written (int, optional): Поколение, полученное от record_write: собственная
+                запись процесса не должна удалять при сверке все записи вида
+        """
+        dates = None if dates is None else sorted(set(dates))
+        
+        with self._lock:
+            # Если между сверкой и этой записью данные менял другой процесс, поколение
+            # не принимается: следующая сверка удалит все записи вида
+            if written is not None and self._synced.get(kind) == written - 1:
+                self._synced[kind] = written
+            self._invalidate(kind, dates)
+    
+    def _invalidate(self, kind, dates):
+        self._generations[kind] = self._generations.get(kind, 0) + 1
+        
+        for key in list(self._entries):
+            key_kind, start_date, end_date = key
+            if key_kind != kind:
+                continue
+            if dates is None or any(start_date <= date <= end_date for date in dates):
+                self._drop(key)
+                self.invalidations += 1
+    
+    def metrics(self):
+        """
+        Возвращает метрики кэша.
+        
+        Returns:
+            dict: Попадания, промахи, вытеснения, инвалидации и занятый объем
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+query_cache = QueryResultCache()
+
+# Настройки кэша известных пользователей
+KNOWN_USERS_MAX = int(os.getenv('KNOWN_USERS_MAX', '100000'))
+
+# Кэш пользователей, профиль которых уже записан в базу
+class KnownUsers:
+    """
+    Ограниченный LRU-кэш ID пользователя -> (хэш профиля, username).
+    Если профиль пользователя не изменился с последней записи, повторная
+    регистрация не обращается к базе данных.
+    """
+    
+    def __init__(self, max_entries=KNOWN_USERS_MAX):
+        """
+        Args:
+            max_entries (int): Максимальное количество пользователей в кэше
+        """
+        self.max_entries = max_entries
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.writes = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def profile_hash(username, first_name, last_name):
+        return hash((username, first_name, last_name))
+    
+    def get(self, user_id, profile_hash=None):
+        """
+        Возвращает запомненный профиль пользователя. Совпадение с profile_hash
+        учитывается как пропущенная запись.
+        
+        Args:
+            user_id (int): ID пользователя в Telegram
+            profile_hash (int, optional): Хэш текущего профиля пользователя
+            
+        Returns:
+            tuple: (хэш профиля, username) или None, если пользователь неизвестен
+        """
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is not None:
+                self._users.move_to_end(user_id)
+                if entry[0] == profile_hash:
+                    self.hits += 1
+            return entry
+    
+    def put(self, user_id, profile_hash, username):
+        """
+        Запоминает профиль пользователя, записанный в базу.
+        
+        Args:
+            user_id (int): ID пользователя в Telegram
+            profile_hash (int): Хэш профиля
+            username (str): Имя пользователя
+        """
+        with self._lock:
+            self._users[user_id] = (profile_hash, username)
+            self._users.move_to_end(user_id)
+            self.writes += 1
+            while len(self._users) > self.max_entries:
+                self._users.popitem(last=False)
+                self.evictions += 1
+    
+    def metrics(self):
+        """
+        Возвращает метрики кэша.
+        
+        Returns:
+            dict: Размер, пропущенные и выполненные записи, вытеснения
+        """
+        with self._lock:
+            return {
+                'users': len(self._users),
+                'skipped_writes': self.hits,
+                'writes': self.writes,
+                'evictions': self.evictions,
+            }
+
+known_users = KnownUsers()
+
+# Новый пользователь добавляется, у существующего обновляется профиль, только если он изменился.
+# Время последней активности существующих пользователей обновляет журнал активности.
+UPSERT_USER_QUERY = """
+    INSERT INTO users (user_id, username, first_name, last_name, registration_ts, last_activity_ts)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT (user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name
+    WHERE username IS NOT excluded.username
+        OR first_name IS NOT excluded.first_name
+        OR last_name IS NOT excluded.last_name
+"""
+
+# Функция для добавления нового пользователя или обновления данных существующего
+def register_user(user_id, username, first_name, last_name):
+    """
+    Регистрирует нового пользователя в базе данных или обновляет информацию
+    о существующем пользователе. Если профиль не изменился с последней
+    регистрации в этом процессе, запись в базу пропускается.
+    
+    Args:
+        user_id (int): ID пользователя в Telegram
+        username (str): Имя пользователя
+        first_name (str): Имя
+        last_name (str): Фамилия
+    """
+    profile_hash = KnownUsers.profile_hash(username, first_name, last_name)
+    known = known_users.get(user_id, profile_hash)
+    today_counters.remember_username(user_id, username)
+    if known is not None and known[0] == profile_hash:
+        return
+    
+    # Имя пользователя входит в отчеты об активности за все периоды. Если прежнее имя
+    # неизвестно, кэш сбрасывается при любой записи (новый пользователь или новый профиль)
+    now = epoch_seconds(datetime.datetime.now())
+    written = None
+    with db_pool.writer() as conn:
+        changed = conn.execute(
+            UPSERT_USER_QUERY,
+            (user_id, username, first_name, last_name, now, now)
+        ).rowcount > 0
+        if changed and (known is None or known[1] != username):
+            written = query_cache.record_write(conn, 'activity')
+    known_users.put(user_id, profile_hash, username)
+    
+    if written is not None:
+        query_cache.invalidate('activity', written=written)
+
+# Функция для логирования действий пользователя
+def log_user_activity(user_id, action_type, additional_data=None):
+    """
+    Записывает действие пользователя в журнал активности.
+    
+    Если запущен фоновый писатель журнала, событие ставится в очередь и будет
+    записано пакетом, иначе записывается в базу данных сразу.
+    
+    Args:
+        user_id (int): ID пользователя в Telegram
+        action_type (str): Тип действия (например, 'start', 'report', 'stats')
+        additional_data (str, optional): Дополнительные данные о действии
+    """
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    event = (user_id, action_type, now, additional_data)
+    
+    if not activity_writer.submit(event):
+        write_activity_batch([event])
+
+# Функция для пакетной записи действий пользователей
+def write_activity_batch(events):
+    """
+    Записывает пакет действий пользователей одной транзакцией.
+    Обновления времени последней активности объединяются: по одному UPDATE на пользователя.
+    
+    Args:
+        events (list): Список кортежей (user_id, action_type, action_date, additional_data)
+    """
+    last_activity = {}
+    for user_id, _, action_date, _ in events:
+        if action_date > last_activity.get(user_id, ''):
+            last_activity[user_id] = action_date
+    
+    with db_pool.writer() as conn:
+        insert_activity_rows(conn, events)
+        
+        # Обновляем время последней активности пользователей
+        conn.executemany(
+            "UPDATE users SET last_activity_ts = ? WHERE user_id = ?",
+            [(epoch_seconds(action_date), user_id) for user_id, action_date in last_activity.items()]
+        )
+        
+        # Счетчики обновляются под блокировкой записи, чтобы не разойтись с пересинхронизацией
+        today_counters.record_activity(events)
+        written = query_cache.record_write(conn, 'activity')
+    
+    query_cache.invalidate('activity', {action_date[:10] for _, _, action_date, _ in events}, written)
+
+# Настройки пакетной записи журнала активности
+ACTIVITY_FLUSH_EVENTS = int(os.getenv('ACTIVITY_FLUSH_EVENTS', '100'))
+ACTIVITY_FLUSH_INTERVAL_MS = int(os.getenv('ACTIVITY_FLUSH_INTERVAL_MS', '500'))
+
+# Фоновый писатель журнала активности
+class ActivityLogWriter:
+    """
+    Буферизует действия пользователей в очереди asyncio и записывает их в базу
+    пакетами: каждые batch_size событий или каждые interval_ms миллисекунд.
+    """
+    
+    def __init__(self, batch_size=ACTIVITY_FLUSH_EVENTS, interval_ms=ACTIVITY_FLUSH_INTERVAL_MS):
+        """
+        Args:
+            batch_size (int): Максимальный размер пакета
+            interval_ms (int): Максимальное время ожидания пакета в миллисекундах
+        """
+        self.batch_size = batch_size
+        self.interval = interval_ms / 1000
+        self._queue = None
+        self._task = None
+        
+        # Метрики
+        self.flushed_events = 0
+        self.flush_count = 0
+        self.failed_events = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+    
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+    
+    def start(self):
+        """
+        Запускает фоновую задачу записи в текущем цикле событий.
+        """
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+    
+    def submit(self, event):
+        """
+        Ставит событие в очередь на запись.
+        
+        Args:
+            event (tuple): Кортеж (user_id, action_type, action_date, additional_data)
+            
+        Returns:
+            bool: False, если писатель не запущен и событие нужно записать напрямую
+        """
+        if not self.running:
+            return False
+        self._queue.put_nowait(event)
+        return True
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        
+        while not stopping:
+            event = await self._queue.get()
+            if event is None:
+                break
+            
+            batch = [event]
+            deadline = loop.time() + self.interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    event = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event)
+            
+            await self._flush(batch)
+    
+    async def _flush(self, batch):
+        started = time.perf_counter()
+        try:
+            await job_executor.run_io(write_activity_batch, batch)
+        except Exception as e:
+            self.failed_events += len(batch)
+            logging.error(f"Ошибка при записи журнала активности ({len(batch)} событий): {e}")
+            return
+        
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        self.flushed_events += len(batch)
+        self.flush_count += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+        self.total_flush_ms += elapsed_ms
+    
+    async def stop(self):
+        """
+        Дописывает все накопленные события и останавливает фоновую задачу.
+        """
+        if not self.running:
+            return
+        self._queue.put_nowait(None)
+        await self._task
+        self._task = None
+        
+        # События, добавленные после сигнала остановки
+        pending = []
+        while not self._queue.empty():
+            event = self._queue.get_nowait()
+            if event is not None:
+                pending.append(event)
+        if pending:
+            await self._flush(pending)
+        
+        logging.info(f"Журнал активности записан: {self.metrics()}")
+    
+    def metrics(self):
+        """
+        Возвращает метрики писателя журнала.
+        
+        Returns:
+            dict: Глубина очереди, количество записанных событий и задержки записи
+        """
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'flushed_events': self.flushed_events,
+            'failed_events': self.failed_events,
+            'flush_count': self.flush_count,
+            'last_flush_ms': round(self.last_flush_ms, 2),
+            'max_flush_ms': round(self.max_flush_ms, 2),
+            'avg_flush_ms': round(self.total_flush_ms / self.flush_count, 2) if self.flush_count else 0.0,
+        }
+
+activity_writer = ActivityLogWriter()
+
+# Настройки счетчиков за сегодняшний день
+TODAY_COUNTERS_ENABLED = os.getenv('TODAY_COUNTERS_ENABLED', '1') == '1'
+TODAY_COUNTERS_RESYNC_SECONDS = float(os.getenv('TODAY_COUNTERS_RESYNC_SECONDS', '300'))
+
+# Счетчики продаж и активности за сегодняшний день
+class TodayCounters:
+    """
+    Счетчики за сегодняшний день в памяти: выручка и количество продаж по товарам,
+    количество действий по типам и по пользователям.
+    
+    Счетчики загружаются из базы при запуске, увеличиваются при каждой записи
+    продаж и журнала активности и периодически пересинхронизируются с базой.
+    Статистика за день строится по ним без запросов к базе. Загрузка и обновление
+    выполняются под блокировкой записи в базу, поэтому событие не может быть
+    учтено дважды или пропущено. Если транзакция записи откатывается, учтенные
+    в ней события в базу не попали: счетчики считаются незагруженными до
+    следующей пересинхронизации. Счетчики видят только записи своего процесса,
+    поэтому при запуске нескольких рабочих процессов они отключаются.
+    """
+    
+    def __init__(self, enabled=TODAY_COUNTERS_ENABLED, resync_seconds=TODAY_COUNTERS_RESYNC_SECONDS):
+        """
+        Args:
+            enabled (bool): Включены ли счетчики
+            resync_seconds (float): Интервал пересинхронизации с базой в секундах
+        """
+        self.enabled = enabled
+        self.resync_seconds = resync_seconds
+        self.date = None
+        self._sales = {}      # товар -> [сумма, количество продаж]
+        self._actions = {}    # тип действия -> количество
+        self._users = {}      # user_id -> количество действий
+        self._usernames = {}  # user_id -> имя пользователя
+        self._lock = threading.Lock()
+        self._task = None
+        db_pool.rollback_callbacks.append(self.invalidate)
+        
+        # Метрики
+        self.served = 0
+        self.resyncs = 0
+    
+    @staticmethod
+    def _today():
+        return datetime.date.today().strftime("%Y-%m-%d")
+    
+    @staticmethod
+    def _load(conn, date):
+        sales = {
+            product: [amount, count]
+            for product, amount, count in conn.execute(
+                """
+                SELECT p.product_name, t.amount, t.sales_count
+                FROM (
+                    SELECT product_key, SUM(amount) as amount, COUNT(*) as sales_count
+                    FROM sales WHERE day = ? GROUP BY product_key
+                ) t
+                JOIN products p ON p.product_key = t.product_key
+                """,
+                (epoch_day(date),)
+            )
+        }
+        
+        actions, users = {}, {}
+        for user_id, action_type, count in conn.execute(
+            f"""
+            SELECT t.user_id, a.action_type, t.action_count
+            FROM (
+                SELECT user_id, action_key, COUNT(*) as action_count
+                FROM {activity_source(conn, date, date)}
+                WHERE action_ts BETWEEN ? AND ?
+                GROUP BY user_id, action_key
+            ) t
+            JOIN action_types a ON a.action_key = t.action_key
+            """,
+            period_seconds(date, date)
+        ):
+            actions[action_type] = actions.get(action_type, 0) + count
+            users[user_id] = users.get(user_id, 0) + count
+        
+        return sales, actions, users
+    
+    def available(self, start_date, end_date):
+        """
+        Проверяет, можно ли построить статистику за период по счетчикам.
+        
+        Args:
+            start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+            end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+            
+        Returns:
+            bool: True, если период - сегодняшний день и счетчики загружены
+        """
+        return self.enabled and start_date == end_date == self.date == self._today()
+    
+    def rehydrate(self, conn=None):
+        """
+        Загружает счетчики за сегодня из базы.
+        
+        Args:
+            conn (sqlite3.Connection, optional): Соединение внутри уже открытой транзакции записи
+        """
+        if not self.enabled:
+            return
+        if conn is None:
+            with db_pool.writer() as conn:
+                return self.rehydrate(conn)
+        
+        date = self._today()
+        sales, actions, users = self._load(conn, date)
+        with self._lock:
+            self.date = date
+            self._sales, self._actions, self._users = sales, actions, users
+            self.resyncs += 1
+    
+    def invalidate(self):
+        """
+        Помечает счетчики незагруженными. Вызывается при откате транзакции записи;
+        статистика за день строится запросами к базе до следующей пересинхронизации.
+        """
+        with self._lock:
+            self.date = None
+            self._sales, self._actions, self._users = {}, {}, {}
+    
+    def _roll(self, date, today):
+        # Первое событие нового дня: счетчики начинаются с нуля. Незагруженные
+        # счетчики и даты в будущем (например, из загружаемого файла) не меняют дату
+        if self.date is not None and self.date < date <= today:
+            self.date = date
+            self._sales, self._actions, self._users = {}, {}, {}
+    
+    def record_sales(self, rows):
+        """
+        Учитывает записанные продажи.
+        
+        Args:
+            rows (list): Кортежи (product_id, product_name, amount, date, user_id)
+        """
+        if not self.enabled:
+            return
+        today = self._today()
+        with self._lock:
+            for _, product_name, amount, date, _ in rows:
+                self._roll(date, today)
+                if date != self.date:
+                    continue
+                totals = self._sales.setdefault(product_name, [0.0, 0])
+                totals[0] += amount
+                totals[1] += 1
+    
+    def record_activity(self, events):
+        """
+        Учитывает записанные действия пользователей.
+        
+        Args:
+            events (list): Кортежи (user_id, action_type, action_date, additional_data)
+        """
+        if not self.enabled:
+            return
+        today = self._today()
+        with self._lock:
+            for user_id, action_type, action_date, _ in events:
+                date = action_date[:10]
+                self._roll(date, today)
+                if date != self.date:
+                    continue
+                self._actions[action_type] = self._actions.get(action_type, 0) + 1
+                self._users[user_id] = self._users.get(user_id, 0) + 1
+    
+    def remember_username(self, user_id, username):
+        """
+        Запоминает имя пользователя для рейтинга самых активных.
+        
+        Args:
+            user_id (int): ID пользователя
+            username (str): Имя пользователя
+        """
+        with self._lock:
+            self._usernames[user_id] = username
+    
+    def _resolve_usernames(self, user_ids):
+        with self._lock:
+            missing = [user_id for user_id in user_ids if user_id not in self._usernames]
+        if missing:
+            with db_pool.reader() as conn:
+                rows = conn.execute(
+                    f"SELECT user_id, username FROM users WHERE user_id IN ({', '.join('?' * len(missing))})",
+                    missing
+                ).fetchall()
+        with self._lock:
+            self._usernames.update(rows if missing else ())
+            return [self._usernames.get(user_id) for user_id in user_ids]
+    
+    def sales_frame(self):
+        """
+        Возвращает данные о продажах за сегодня в том же виде, что и get_sales_data.
+        
+        Returns:
+            pandas.DataFrame: DataFrame со столбцами product_name, total_amount, sales_count, date
+        """
+        with self._lock:
+            date = pd.Timestamp(self.date)
+            rows = [(product, amount, count, date) for product, (amount, count) in sorted(self._sales.items())]
+        return pd.DataFrame(rows, columns=['product_name', 'total_amount', 'sales_count', 'date'])
+    
+    def activity_chart_frame(self):
+        """
+        Возвращает данные графика активности за сегодня в том же виде, что и get_activity_chart_data.
+        
+        Returns:
+            pandas.DataFrame: DataFrame со столбцами action_date, action_type, action_count
+        """
+        with self._lock:
+            date = pd.Timestamp(self.date)
+            rows = [(date, action, count) for action, count in sorted(self._actions.items())]
+        return pd.DataFrame(rows, columns=['action_date', 'action_type', 'action_count'])
+    
+    def sales_summary(self, period_name, top_n=None):
+        """
+        Строит сводку продаж за сегодня по счетчикам.
+        
+        Args:
+            period_name (str): Название периода
+            top_n (int, optional): Количество товаров в рейтинге, по умолчанию STATS_TOP_PRODUCTS
+            
+        Returns:
+            SalesSummary: Сводка статистики
+        """
+        top_n = top_n or STATS_TOP_PRODUCTS
+        with self._lock:
+            date = self.date
+            products = sorted(((amount, count, product) for product, (amount, count) in self._sales.items()), reverse=True)
+        
+        self.served += 1
+        total_amount = sum(amount for amount, _, _ in products)
+        sales_count = sum(count for _, count, _ in products)
+        return SalesSummary(
+            period_name=period_name,
+            total_amount=total_amount,
+            sales_count=sales_count,
+            average_order=total_amount / sales_count if sales_count else 0.0,
+            days=1 if products else 0,
+            daily_median=total_amount,
+            daily_p90=total_amount,
+            best_day=(date, total_amount) if products else None,
+            products=[
+                (product, amount, amount / total_amount * 100 if total_amount else 0.0)
+                for amount, _, product in products[:top_n]
+            ],
+        )
+    
+    def activity_summary(self, period_name, top_n=None):
+        """
+        Строит сводку активности за сегодня по счетчикам.
+        
+        Args:
+            period_name (str): Название периода
+            top_n (int, optional): Количество пользователей в рейтинге, по умолчанию STATS_TOP_USERS
+            
+        Returns:
+            ActivitySummary: Сводка статистики
+        """
+        top_n = top_n or STATS_TOP_USERS
+        with self._lock:
+            actions = sorted(self._actions.items(), key=lambda item: item[1], reverse=True)
+            user_totals = np.fromiter(self._users.values(), dtype=float, count=len(self._users))
+            top_users = sorted(self._users.items(), key=lambda item: item[1], reverse=True)[:top_n]
+        
+        self.served += 1
+        total_actions = sum(count for _, count in actions)
+        usernames = self._resolve_usernames([user_id for user_id, _ in top_users])
+        return ActivitySummary(
+            period_name=period_name,
+            total_actions=total_actions,
+            active_users=len(user_totals),
+            per_user_median=float(np.percentile(user_totals, 50)) if len(user_totals) else 0.0,
+            per_user_p90=float(np.percentile(user_totals, 90)) if len(user_totals) else 0.0,
+            action_types=[
+                (action, count, count / total_actions * 100 if total_actions else 0.0)
+                for action, count in actions
+            ],
+            top_users=[
+                (str(username if username is not None else user_id), count)
+                for (user_id, count), username in zip(top_users, usernames)
+            ],
+        )
+    
+    def check_consistency(self):
+        """
+        Сравнивает счетчики с результатом SQL-запросов по базе.
+        
+        Returns:
+            list: Описания расхождений (пустой список, если счетчики совпадают с базой)
+        """
+        with db_pool.writer() as conn:
+            sales, actions, users = self._load(conn, self.date or self._today())
+            with self._lock:
+                current = (dict(self._sales), dict(self._actions), dict(self._users))
+        
+        problems = []
+        for product in set(sales) | set(current[0]):
+            expected = sales.get(product, [0.0, 0])
+            actual = current[0].get(product, [0.0, 0])
+            if expected[1] != actual[1] or abs(expected[0] - actual[0]) > 0.005:
+                problems.append(f"продажи '{product}': в базе {expected}, в счетчиках {actual}")
+        for name, expected_map, actual_map in (('действия', actions, current[1]), ('пользователь', users, current[2])):
+            for key in set(expected_map) | set(actual_map):
+                if expected_map.get(key, 0) != actual_map.get(key, 0):
+                    problems.append(
+                        f"{name} '{key}': в базе {expected_map.get(key, 0)}, в счетчиках {actual_map.get(key, 0)}"
+                    )
+        return problems
+    
+    def start(self):
+        """
+        Запускает периодическую пересинхронизацию в текущем цикле событий.
+        """
+        if self.enabled and self._task is None and self.resync_seconds > 0:
+            self._task = asyncio.create_task(self._resync_loop())
+    
+    async def _resync_loop(self):
+        while True:
+            await asyncio.sleep(self.resync_seconds)
+            try:
+                # После отката транзакции счетчики не загружены, сравнивать нечего
+                problems = await job_executor.run_io(self.check_consistency) if self.date is not None else []
+                if problems:
+                    logging.warning(f"Счетчики за сегодня разошлись с базой ({len(problems)} расхождений), загружаем заново")
+                await job_executor.run_io(self.rehydrate)
+            except Exception as e:
+                logging.error(f"Ошибка при пересинхронизации счетчиков за сегодня: {e}")
+    
+    async def stop(self):
+        """
+        Останавливает периодическую пересинхронизацию.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+    
+    def metrics(self):
+        """
+        Возвращает метрики счетчиков.
+        
+        Returns:
+            dict: Дата, размеры счетчиков, количество обслуженных запросов и пересинхронизаций
+        """
+        with self._lock:
+            return {
+                'date': self.date,
+                'products': len(self._sales),
+                'action_types': len(self._actions),
+                'users': len(self._users),
+                'served': self.served,
+                'resyncs': self.resyncs,
+            }
+
+today_counters = TodayCounters()
+
+# Запросы для отчетов (параметризованы, чтобы sqlite3 переиспользовал подготовленные выражения)
+SALES_DATA_QUERY = """
+SELECT 
+    product_key as product_name,
+    SUM(amount) as total_amount,
+    COUNT(*) as sales_count,
+    day as date
+FROM 
+    sales
+WHERE 
+    day BETWEEN ? AND ?
+GROUP BY 
+    product_key, day
+ORDER BY 
+    day
+"""
+
+USER_ACTIVITY_DATA_QUERY = """
+SELECT 
+    ua.user_id,
+    u.username,
+    ua.action_key as action_type,
+    COUNT(*) as action_count,
+    ua.action_ts / 86400 as action_date
+FROM 
+    {activity} ua
+JOIN 
+    users u ON ua.user_id = u.user_id
+WHERE 
+    ua.action_ts BETWEEN ? AND ?
+GROUP BY 
+    ua.user_id, ua.action_key, ua.action_ts / 86400
+ORDER BY 
+    action_date
+"""
+
+SALES_ROLLUP_QUERY = """
+SELECT 
+    product_key as product_name,
+    total_amount,
+    sales_count,
+    day as date
+FROM
+    sales_daily
+WHERE 
+    day BETWEEN ? AND ?
+ORDER BY 
+    day
+"""
+
+USER_ACTIVITY_ROLLUP_QUERY = """
+SELECT 
+    ad.user_id,
+    u.username,
+    ad.action_key as action_type,
+    ad.action_count,
+    ad.day as action_date
+FROM 
+    activity_daily ad
+JOIN 
+    users u ON ad.user_id = u.user_id
+WHERE 
+    ad.day BETWEEN ? AND ?
+ORDER BY 
+    ad.day
+"""
+
+ACTIVITY_CHART_ROLLUP_QUERY = """
+SELECT 
+    day as action_date,
+    action_key as action_type,
+    SUM(action_count) as action_count
+FROM 
+    activity_daily
+WHERE 
+    day BETWEEN ? AND ?
+GROUP BY 
+    day, action_key
+ORDER BY 
+    day
+"""
+
+ACTIVITY_CHART_DATA_QUERY = """
+SELECT 
+    action_ts / 86400 as action_date,
+    action_key as action_type,
+    COUNT(*) as action_count
+FROM 
+    {activity}
+WHERE 
+    action_ts BETWEEN ? AND ?
+GROUP BY 
+    action_ts / 86400, action_key
+ORDER BY 
+    1
+"""
+
+# Функция для выбора запроса отчета
+def select_report_query(conn, report_type, start_date, end_date):
+    """
+    Выбирает запрос отчета: по агрегированной таблице, если она актуальна,
+    иначе по исходной таблице.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение для чтения
+        report_type (str): Тип отчета ('sales' или 'activity')
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        
+    Returns:
+        tuple: (текст запроса, параметры)
+    """
+    if report_type == 'sales':
+        if rollup_is_valid(conn, 'sales_daily'):
+            return SALES_ROLLUP_QUERY, period_days(start_date, end_date)
+        return SALES_DATA_QUERY, period_days(start_date, end_date)
+    
+    if rollup_is_valid(conn, 'activity_daily'):
+        return USER_ACTIVITY_ROLLUP_QUERY, period_days(start_date, end_date)
+    return (
+        USER_ACTIVITY_DATA_QUERY.format(activity=activity_source(conn, start_date, end_date)),
+        period_seconds(start_date, end_date)
+    )
+
+# Функция для получения данных продаж за период
+def get_sales_data(start_date, end_date):
+    """
+    Получает данные о продажах из базы данных за указанный период.
+    
+    Args:
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        
+    Returns:
+        pandas.DataFrame: DataFrame с данными о продажах (date - datetime64, product_name - категории)
+    """
+    key = ('sales', start_date, end_date)
+    # Примечание: сумма (total_amount) уже в гривнах
+    with db_pool.reader() as conn:
+        query_cache.sync(conn, 'sales')
+        df = query_cache.get(key)
+        if df is not None:
+            return df
+        generation = query_cache.generation('sales')
+        
+        query, params = select_report_query(conn, 'sales', start_date, end_date)
+        df = read_frame(conn, query, params)
+    
+    query_cache.put(key, df, generation)
+    return df
+
+# Функция для получения данных об активности пользователей за период
+def get_user_activity_data(start_date, end_date):
+    """
+    Получает данные об активности пользователей из базы данных за указанный период.
+    
+    Args:
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        
+    Returns:
+        pandas.DataFrame: DataFrame с данными об активности пользователей
+            (action_date - день в datetime64, action_type - категории)
+    """
+    key = ('activity', start_date, end_date)
+    with db_pool.reader() as conn:
+        query_cache.sync(conn, 'activity')
+        df = query_cache.get(key)
+        if df is not None:
+            return df
+        generation = query_cache.generation('activity')
+        
+        query, params = select_report_query(conn, 'activity', start_date, end_date)
+        df = read_frame(conn, query, params)
+    
+    query_cache.put(key, df, generation)
+    return df
+
+# Функция для получения данных графика активности за период
+def get_activity_chart_data(start_date, end_date):
+    """
+    Получает количество действий по дням и типам действий - ровно то,
+    что нужно для графика, без детализации по пользователям.
+    
+    Args:
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        
+    Returns:
+        pandas.DataFrame: DataFrame со столбцами action_date, action_type, action_count
+    """
+    with db_pool.reader() as conn:
+        if rollup_is_valid(conn, 'activity_daily'):
+            return read_frame(conn, ACTIVITY_CHART_ROLLUP_QUERY, period_days(start_date, end_date))
+        return read_frame(
+            conn,
+            ACTIVITY_CHART_DATA_QUERY.format(activity=activity_source(conn, start_date, end_date)),
+            period_seconds(start_date, end_date)
+        )
+
+# Агрегирующие запросы для статистики активности: в Python передаются только итоги.
+# В запросы по журналу вместо {activity} подставляется источник из activity_source
+ACTIVITY_STATS_QUERIES = {
+    'rollup': {
+        'action_types': """
+            SELECT a.action_type, t.action_count
+            FROM (
+                SELECT action_key, SUM(action_count) as action_count
+                FROM activity_daily
+                WHERE day BETWEEN ? AND ?
+                GROUP BY action_key
+            ) t
+            JOIN action_types a ON a.action_key = t.action_key
+            ORDER BY t.action_count DESC
+        """,
+        'daily': """
+            SELECT day, SUM(action_count) as action_count
+            FROM activity_daily
+            WHERE day BETWEEN ? AND ?
+            GROUP BY day
+            ORDER BY day
+        """,
+        'per_user': """
+            SELECT SUM(action_count) as action_count
+            FROM activity_daily
+            WHERE day BETWEEN ? AND ?
+            GROUP BY user_id
+        """,
+        'top_users': """
+            SELECT COALESCE(u.username, CAST(t.user_id AS TEXT)), t.action_count
+            FROM (
+                SELECT user_id, SUM(action_count) as action_count
+                FROM activity_daily
+                WHERE day BETWEEN ? AND ?
+                GROUP BY user_id
+                ORDER BY action_count DESC
+                LIMIT ?
+            ) t
+            JOIN users u ON t.user_id = u.user_id
+            ORDER BY t.action_count DESC
+        """,
+    },
+    'raw': {
+        'action_types': """
+            SELECT a.action_type, t.action_count
+            FROM (
+                SELECT action_key, COUNT(*) as action_count
+                FROM {activity}
+                WHERE action_ts BETWEEN ? AND ?
+                GROUP BY action_key
+            ) t
+            JOIN action_types a ON a.action_key = t.action_key
+            ORDER BY t.action_count DESC
+        """,
+        'daily': """
+            SELECT action_ts / 86400 as day, COUNT(*) as action_count
+            FROM {activity}
+            WHERE action_ts BETWEEN ? AND ?
+            GROUP BY action_ts / 86400
+            ORDER BY 1
+        """,
+        'per_user': """
+            SELECT COUNT(*) as action_count
+            FROM {activity}
+            WHERE action_ts BETWEEN ? AND ?
+            GROUP BY user_id
+        """,
+        'top_users': """
+            SELECT COALESCE(u.username, CAST(t.user_id AS TEXT)), t.action_count
+            FROM (
+                SELECT user_id, COUNT(*) as action_count
+                FROM {activity}
+                WHERE action_ts BETWEEN ? AND ?
+                GROUP BY user_id
+                ORDER BY action_count DESC
+                LIMIT ?
+            ) t
+            JOIN users u ON t.user_id = u.user_id
+            ORDER BY t.action_count DESC
+        """,
+    },
+}
+
+# Функция для получения сводки активности за период
+def get_activity_summary(start_date, end_date, period_name, top_n=None):
+    """
+    Вычисляет статистику активности агрегирующими запросами в базе:
+    вместо детальных строк по пользователям, действиям и дням в Python
+    передаются только итоги по типам действий, дням и пользователям.
+    
+    Args:
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        period_name (str): Название периода
+        top_n (int, optional): Количество пользователей в рейтинге, по умолчанию STATS_TOP_USERS
+        
+    Returns:
+        ActivitySummary: Сводка статистики
+    """
+    top_n = top_n or STATS_TOP_USERS
+    with db_pool.reader() as conn:
+        if rollup_is_valid(conn, 'activity_daily'):
+            queries, params = ACTIVITY_STATS_QUERIES['rollup'], period_days(start_date, end_date)
+        else:
+            source = activity_source(conn, start_date, end_date)
+            queries = {name: query.format(activity=source) for name, query in ACTIVITY_STATS_QUERIES['raw'].items()}
+            params = period_seconds(start_date, end_date)
+        
+        action_types = conn.execute(queries['action_types'], params).fetchall()
+        daily_totals = np.array([row[1] for row in conn.execute(queries['daily'], params)], dtype=float)
+        user_totals = np.array([row[0] for row in conn.execute(queries['per_user'], params)], dtype=float)
+        top_users = conn.execute(queries['top_users'], params + (top_n,)).fetchall()
+    
+    total_actions = sum(count for _, count in action_types)
+    return ActivitySummary(
+        period_name=period_name,
+        total_actions=total_actions,
+        active_users=len(user_totals),
+        per_user_median=float(np.percentile(user_totals, 50)) if len(user_totals) else 0.0,
+        per_user_p90=float(np.percentile(user_totals, 90)) if len(user_totals) else 0.0,
+        day_growth=_day_growth(daily_totals),
+        action_types=[
+            (action, count, count / total_actions * 100 if total_actions else 0.0)
+            for action, count in action_types
+        ],
+        top_users=[(str(user), count) for user, count in top_users],
+    )
+
+# Функция для оценки количества строк отчета
+def estimate_report_rows(report_type, start_date, end_date):
+    """
+    Считает количество строк, которое вернет запрос отчета.
+    
+    Args:
+        report_type (str): Тип отчета ('sales' или 'activity')
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        
+    Returns:
+        int: Количество строк
+    """
+    with db_pool.reader() as conn:
+        query, params = select_report_query(conn, report_type, start_date, end_date)
+        return conn.execute(f"SELECT COUNT(*) FROM ({query})", params).fetchone()[0]
+
+# Отчетные запросы, которые должны использовать индексы, и период их проверки
+PLAN_CHECK_PERIOD = ('2024-01-01', '2024-01-31')
+
+REPORT_QUERIES = {
+    'sales': (SALES_DATA_QUERY, period_days(*PLAN_CHECK_PERIOD)),
+    'activity': (USER_ACTIVITY_DATA_QUERY, period_seconds(*PLAN_CHECK_PERIOD)),
+    'sales_rollup': (SALES_ROLLUP_QUERY, period_days(*PLAN_CHECK_PERIOD)),
+    'activity_rollup': (USER_ACTIVITY_ROLLUP_QUERY, period_days(*PLAN_CHECK_PERIOD)),
+}
+
+# Проверка планов выполнения отчетных запросов
+def check_query_plans(queries=None):
+    """
+    Выполняет EXPLAIN QUERY PLAN для отчетных запросов и находит шаги,
+    на которых таблица читается полным сканированием.
+    
+    Args:
+        queries (dict, optional): Словарь {имя: (запрос, параметры)}, по умолчанию REPORT_QUERIES
+        
+    Returns:
+        list: Описания проблемных шагов в виде 'имя: шаг плана'
+    """
+    problems = []
+    with db_pool.reader() as conn:
+        for name, (query, params) in (queries or REPORT_QUERIES).items():
+            if '{activity}' in query:
+                query = query.format(activity=activity_source(conn, *PLAN_CHECK_PERIOD))
+            # Чтение материализованного подзапроса (объединения секций) - не сканирование таблицы
+            materialized = set()
+            for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params):
+                detail = row[-1]
+                if detail.startswith(('MATERIALIZE ', 'CO-ROUTINE ')):
+                    materialized.add(detail.split(' ', 1)[1])
+                elif detail.startswith('SCAN') and 'CONSTANT ROW' not in detail and detail[5:] not in materialized:
+                    problems.append(f"{name}: {detail}")
+    return problems
+
+# Профили отрисовки графиков: размер в дюймах и разрешение
+CHART_PROFILES = {
+    'default': {'figsize': (10, 6), 'dpi': 100},
+    'compact': {'figsize': (8, 4.8), 'dpi': 80},
+    'hires': {'figsize': (12, 7.2), 'dpi': 150},
+}
+CHART_PROFILE = os.getenv('CHART_PROFILE', 'default')
+
+# Шаблоны фигур, переиспользуемые в пределах одного потока
+_chart_templates = threading.local()
+
+@functools.lru_cache(maxsize=None)
+def _setup_chart_fonts():
+    """
+    Один раз на процесс настраивает шрифты с поддержкой кириллицы.
+    """
+    matplotlib.rcParams['font.family'] = 'sans-serif'
+    matplotlib.rcParams['font.sans-serif'] = ['DejaVu Sans', 'Arial', 'Liberation Sans']
+    matplotlib.rcParams['axes.unicode_minus'] = False
+
+def _get_chart_template(profile):
+    """
+    Возвращает заранее созданные фигуру и оси для профиля в текущем потоке.
+    Используется объектный API Agg без глобального состояния pyplot.
+    
+    Args:
+        profile (str): Имя профиля из CHART_PROFILES
+        
+    Returns:
+        tuple: (Figure, Axes, dpi)
+    """
+    templates = getattr(_chart_templates, 'by_profile', None)
+    if templates is None:
+        templates = _chart_templates.by_profile = {}
+    
+    template = templates.get(profile)
+    if template is None:
+        _setup_chart_fonts()
+        settings = CHART_PROFILES[profile]
+        figure = Figure(figsize=settings['figsize'], dpi=settings['dpi'])
+        FigureCanvasAgg(figure)
+        axes = figure.add_subplot(1, 1, 1)
+        # Фиксированные поля вместо tight_layout, который пересчитывает разметку на каждом графике
+        figure.subplots_adjust(left=0.1, right=0.97, top=0.92, bottom=0.15)
+        template = templates[profile] = (figure, axes, settings['dpi'])
+    return template
+
+def _render_line_chart(table, title, ylabel, profile):
+    """
+    Рисует линейный график по сводной таблице (строки - даты, столбцы - серии).
+    
+    Args:
+        table (pandas.DataFrame): Сводная таблица значений
+        title (str): Заголовок графика
+        ylabel (str): Подпись оси Y
+        profile (str): Имя профиля из CHART_PROFILES
+        
+    Returns:
+        bytes: Содержимое PNG-файла графика
+    """
+    figure, axes, dpi = _get_chart_template(profile)
+    axes.clear()
+    
+    for column in table.columns:
+        axes.plot(table.index, table[column].to_numpy(), marker='o', label=str(column))
+    
+    axes.set_title(title)
+    axes.set_xlabel('Дата')
+    axes.set_ylabel(ylabel)
+    axes.grid(True)
+    axes.legend(title=table.columns.name, loc='upper left')
+    for label in axes.get_xticklabels():
+        label.set_rotation(30)
+        label.set_horizontalalignment('right')
+    
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format='png', dpi=dpi)
+    return buffer.getvalue()
+
+# Функция для генерации графика продаж
+def generate_sales_chart(df, period_name, profile=CHART_PROFILE):
+    """
+    Генерирует график продаж на основе данных DataFrame в памяти.
+    
+    Args:
+        df (pandas.DataFrame): DataFrame с данными о продажах
+        period_name (str): Название периода для заголовка графика
+        profile (str): Профиль размера и разрешения графика
+        
+    Returns:
+        bytes: Содержимое PNG-файла графика
+    """
+    # Агрегируем данные по дате и товару (даты уже в datetime64, разбор строк не нужен)
+    daily_sales = df['total_amount'].groupby([df['date'], df['product_name']], observed=True).sum().unstack()
+    
+    return _render_line_chart(
+        daily_sales,
+        f'Продажи по товарам за {period_name}',
+        'Сумма продаж (грн)',
+        profile
+    )
+
+# Функция для генерации графика активности пользователей
+def generate_activity_chart(df, period_name, profile=CHART_PROFILE):
+    """
+    Генерирует график активности пользователей на основе данных DataFrame в памяти.
+    
+    Args:
+        df (pandas.DataFrame): DataFrame с данными об активности пользователей
+        period_name (str): Название периода для заголовка графика
+        profile (str): Профиль размера и разрешения графика
+        
+    Returns:
+        bytes: Содержимое PNG-файла графика
+    """
+    # Агрегируем данные по дню и типу действия
+    activity_by_date = df['action_count'].groupby([df['action_date'], df['action_type']], observed=True).sum().unstack()
+    
+    return _render_line_chart(
+        activity_by_date,
+        f'Активность пользователей за {period_name}',
+        'Количество действий',
+        profile
+    )
+
+# Функции построения графиков по виду отчета
+CHART_RENDERERS = {
+    'sales': generate_sales_chart,
+    'activity': generate_activity_chart,
+}
+
+# Настройки кэша графиков
+CHART_CACHE_MAX_BYTES = int(os.getenv('CHART_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+CHART_CACHE_DIR = os.getenv('CHART_CACHE_DIR')  # Необязательный дисковый уровень кэша
+
+# Функция для вычисления отпечатка данных графика
+def chart_fingerprint(kind, df, period_name):
+    """
+    Вычисляет хеш содержимого графика: данных, заголовка и параметров отрисовки.
+    
+    Args:
+        kind (str): Вид графика ('sales' или 'activity')
+        df (pandas.DataFrame): Данные графика
+        period_name (str): Название периода для заголовка графика
+        
+    Returns:
+        str: Шестнадцатеричный отпечаток SHA-256
+    """
+    digest = hashlib.sha256()
+    digest.update(repr((kind, period_name, CHART_PROFILE, CHART_PROFILES[CHART_PROFILE], list(df.columns))).encode('utf-8'))
+    digest.update(pd.util.hash_pandas_object(df, index=False).values.tobytes())
+    return digest.hexdigest()
+
+# Кэш отрисованных графиков
+class ChartCache:
+    """
+    Кэш PNG-графиков по отпечатку данных: уровень в памяти с вытеснением по объему
+    и необязательный дисковый уровень. Дополнительно запоминает file_id, который
+    Telegram вернул после загрузки графика, чтобы повторно отправлять его без загрузки.
+    """
+    
+    def __init__(self, max_bytes=CHART_CACHE_MAX_BYTES, disk_dir=CHART_CACHE_DIR):
+        """
+        Args:
+            max_bytes (int): Бюджет памяти в байтах
+            disk_dir (str, optional): Директория дискового уровня кэша
+        """
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._memory = OrderedDict()
+        self._file_ids = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        
+        # Метрики
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.file_id_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+    
+    def _disk_path(self, fingerprint):
+        return os.path.join(self.disk_dir, f"{fingerprint}.png")
+    
+    def get(self, fingerprint):
+        """
+        Возвращает PNG-байты графика из памяти или с диска.
+        
+        Args:
+            fingerprint (str): Отпечаток графика
+            
+        Returns:
+            bytes: Содержимое PNG или None, если графика нет в кэше
+        """
+        with self._lock:
+            png = self._memory.get(fingerprint)
+            if png is not None:
+                self._memory.move_to_end(fingerprint)
+                self.memory_hits += 1
+                return png
+        
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(fingerprint), 'rb') as f:
+                    png = f.read()
+            except FileNotFoundError:
+                png = None
+            if png is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._store(fingerprint, png)
+                return png
+        
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def put(self, fingerprint, png):
+        """
+        Сохраняет PNG-байты графика.
+        
+        Args:
+            fingerprint (str): Отпечаток графика
+            png (bytes): Содержимое PNG
+        """
+        self._store(fingerprint, png)
+        
+        if self.disk_dir:
+            path = self._disk_path(fingerprint)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp_path, 'wb') as f:
+                    f.write(png)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                logging.error(f"Ошибка при записи графика в дисковый кэш: {e}")
+    
+    def _store(self, fingerprint, png):
+        if len(png) > self.max_bytes:
+            return
+        with self._lock:
+            if fingerprint in self._memory:
+                self._bytes -= len(self._memory.pop(fingerprint))
+            self._memory[fingerprint] = png
+            self._bytes += len(png)
+            
+            while self._bytes > self.max_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.evictions += 1
+    
+    def get_file_id(self, fingerprint):
+        """
+        Возвращает file_id ранее загруженного в Telegram графика.
+        
+        Args:
+            fingerprint (str): Отпечаток графика
+            
+        Returns:
+            str: file_id или None
+        """
+        with self._lock:
+            file_id = self._file_ids.get(fingerprint)
+            if file_id is not None:
+                self._file_ids.move_to_end(fingerprint)
+                self.file_id_hits += 1
+            return file_id
+    
+    def remember_file_id(self, fingerprint, file_id, max_entries=10000):
+        """
+        Запоминает file_id загруженного графика.
+        
+        Args:
+            fingerprint (str): Отпечаток графика
+            file_id (str): file_id, возвращенный Telegram
+            max_entries (int): Максимальное количество запоминаемых file_id
+        """
+        with self._lock:
+            self._file_ids[fingerprint] = file_id
+            self._file_ids.move_to_end(fingerprint)
+            while len(self._file_ids) > max_entries:
+                self._file_ids.popitem(last=False)
+    
+    def forget_file_id(self, fingerprint):
+        """
+        Забывает file_id, который Telegram больше не принимает.
+        
+        Args:
+            fingerprint (str): Отпечаток графика
+        """
+        with self._lock:
+            self._file_ids.pop(fingerprint, None)
+    
+    def metrics(self):
+        """
+        Возвращает метрики кэша графиков.
+        
+        Returns:
+            dict: Попадания по уровням, промахи, вытеснения и доля попаданий
+        """
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits + self.file_id_hits
+            total = hits + self.misses
+            return {
+                'entries': len(self._memory),
+                'bytes': self._bytes,
+                'file_ids': len(self._file_ids),
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'file_id_hits': self.file_id_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(hits / total, 3) if total else 0.0,
+            }
+
+chart_cache = ChartCache()
+
+# Функция для получения PNG-графика с использованием кэша
+async def render_chart_cached(kind, df, period_name, fingerprint=None):
+    """
+    Возвращает PNG-байты графика, отрисовывая его только при промахе кэша.
+    
+    Args:
+        kind (str): Вид графика ('sales' или 'activity')
+        df (pandas.DataFrame): Данные графика
+        period_name (str): Название периода для заголовка графика
+        fingerprint (str, optional): Заранее вычисленный отпечаток графика
+        
+    Returns:
+        bytes: Содержимое PNG
+    """
+    fingerprint = fingerprint or chart_fingerprint(kind, df, period_name)
+    png = chart_cache.get(fingerprint)
+    if png is not None:
+        return png
+    
+    # Одинаковый график, который уже отрисовывается для другого запроса, не рисуется повторно
+    return await request_flights.do(('chart', fingerprint), _render_chart, kind, df, period_name, fingerprint)
+
+async def _render_chart(kind, df, period_name, fingerprint):
+    png = await job_executor.run_cpu(CHART_RENDERERS[kind], df, period_name)
+    chart_cache.put(fingerprint, png)
+    return png
+
+# Функция для отправки графика с повторным использованием file_id
+async def send_chart(chat_id, kind, df, period_name, caption, reply_markup=None, priority=None):
+    """
+    Отправляет график пользователю. Если такой же график уже загружался в Telegram,
+    повторно отправляется его file_id, иначе PNG берется из кэша или отрисовывается.
+    
+    Args:
+        chat_id (int): ID чата назначения
+        kind (str): Вид графика ('sales' или 'activity')
+        df (pandas.DataFrame): Данные графика
+        period_name (str): Название периода для заголовка графика
+        caption (str): Подпись к графику
+        reply_markup: Опциональная клавиатура
+        priority (int, optional): Приоритет в очереди отправки (по умолчанию PRIORITY_INTERACTIVE)
+        
+    Returns:
+        Message: Отправленное сообщение
+    """
+    if priority is None:
+        priority = PRIORITY_INTERACTIVE
+    fingerprint = chart_fingerprint(kind, df, period_name)
+    
+    file_id = chart_cache.get_file_id(fingerprint)
+    if file_id is not None:
+        try:
+            return await outbox.send_photo(
+                chat_id, file_id, caption=caption, reply_markup=reply_markup, priority=priority, max_retries=1
+            )
+        except Exception as e:
+            logging.warning(f"Не удалось отправить график по file_id, загружаем заново: {e}")
+            chart_cache.forget_file_id(fingerprint)
+    
+    png = await render_chart_cached(kind, df, period_name, fingerprint)
+    message = await outbox.send_photo(
+        chat_id,
+        BufferedInputFile(png, filename=f"{kind}_chart.png"),
+        caption=caption,
+        reply_markup=reply_markup,
+        priority=priority
+    )
+    if message.photo:
+        chart_cache.remember_file_id(fingerprint, message.photo[-1].file_id)
+    return message
+
+# Порог размера файла, выше которого выгрузка переносится из памяти во временный файл
+SPILL_TO_DISK_BYTES = int(os.getenv('SPILL_TO_DISK_BYTES', str(20 * 1024 * 1024)))
+
+# Буфер выгрузки с переносом на диск
+class SpillBuffer(io.RawIOBase):
+    """
+    Бинарный буфер для выгрузок: данные хранятся в памяти, а при превышении
+    порога переносятся во временный файл, и дальнейшая запись идет на диск.
+    """
+    
+    def __init__(self, filename, threshold=None):
+        """
+        Args:
+            filename (str): Имя файла для отправки в Telegram
+            threshold (int, optional): Порог размера в байтах для переноса на диск,
+                по умолчанию SPILL_TO_DISK_BYTES
+        """
+        super().__init__()
+        self.filename = filename
+        self.threshold = SPILL_TO_DISK_BYTES if threshold is None else threshold
+        self.size = 0
+        self.path = None
+        self.label = None
+        self._memory = io.BytesIO()
+        self._file = None
+    
+    def writable(self):
+        return True
+    
+    def write(self, data):
+        if self._file is None and self.size + len(data) > self.threshold:
+            fd, self.path = tempfile.mkstemp(prefix='report_', suffix=os.path.splitext(self.filename)[1])
+            self._file = os.fdopen(fd, 'wb')
+            self._file.write(self._memory.getbuffer())
+            self._memory = None
+        
+        (self._file or self._memory).write(data)
+        self.size += len(data)
+        return len(data)
+    
+    def tell(self):
+        return self.size
+    
+    @property
+    def spilled(self):
+        return self.path is not None
+    
+    def to_input_file(self):
+        """
+        Возвращает объект файла для отправки через aiogram.
+        
+        Returns:
+            InputFile: BufferedInputFile для данных в памяти или FSInputFile для временного файла
+        """
+        if self._file is not None:
+            self._file.flush()
+            return FSInputFile(self.path, filename=self.filename)
+        return BufferedInputFile(self._memory.getvalue(), filename=self.filename)
+    
+    def getvalue(self):
+        """
+        Возвращает все содержимое буфера.
+        
+        Returns:
+            bytes: Содержимое выгрузки
+        """
+        if self._file is not None:
+            self._file.flush()
+            with open(self.path, 'rb') as f:
+                return f.read()
+        return self._memory.getvalue()
+    
+    def discard(self):
+        """
+        Освобождает память и удаляет временный файл, если он создавался.
+        """
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError as e:
+                logging.error(f"Ошибка при удалении временного файла {self.path}: {e}")
+        self._memory = None
+
+# Реестр форматов выгрузки отчетов: имя -> описание формата
+EXPORTERS = {}
+
+def register_exporter(name, label, extension, export, available=True):
+    """
+    Регистрирует формат выгрузки отчетов.
+    
+    Args:
+        name (str): Внутреннее имя формата (используется в callback_data)
+        label (str): Название формата для пользователя
+        extension (str): Расширение файла без точки
+        export (callable): Функция export(chunks, buffer), записывающая порции DataFrame в бинарный буфер
+        available (bool): Доступен ли формат (установлены ли нужные библиотеки)
+    """
+    EXPORTERS[name] = {
+        'label': label,
+        'extension': extension,
+        'export': export,
+        'available': available,
+    }
+
+def get_available_exporters():
+    """
+    Возвращает форматы выгрузки, которые можно использовать в текущем окружении.
+    
+    Returns:
+        dict: Словарь {имя: описание формата}
+    """
+    return {name: exporter for name, exporter in EXPORTERS.items() if exporter['available']}
+
+def _write_csv_chunks(chunks, binary):
+    # Заголовок пишется только для первой порции
+    text = io.TextIOWrapper(binary, encoding='utf-8', newline='')
+    for index, chunk in enumerate(chunks):
+        chunk.to_csv(text, index=False, header=(index == 0))
+    text.flush()
+    return text.detach()
+
+def _export_csv(chunks, buffer):
+    binary = io.BufferedWriter(buffer)
+    _write_csv_chunks(chunks, binary).flush()
+    binary.detach()
+
+def _export_csv_gzip(chunks, buffer):
+    with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=6) as binary:
+        _write_csv_chunks(chunks, binary)
+
+def _export_csv_zstd(chunks, buffer):
+    compressor = zstandard.ZstdCompressor(level=3)
+    with compressor.stream_writer(buffer, closefd=False) as binary:
+        _write_csv_chunks(chunks, binary)
+
+def _export_parquet(chunks, buffer):
+    writer = schema = None
+    for chunk in chunks:
+        # Схема первой порции закрепляется для всех остальных
+        table = pyarrow.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+        if writer is None:
+            schema = table.schema
+            writer = pyarrow.parquet.ParquetWriter(buffer, schema, compression='zstd')
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+
+def _export_feather(chunks, buffer):
+    writer = schema = None
+    for chunk in chunks:
+        table = pyarrow.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+        if writer is None:
+            schema = table.schema
+            options = pyarrow.ipc.IpcWriteOptions(compression='zstd')
+            writer = pyarrow.ipc.new_file(buffer, schema, options=options)
+        writer.write_table(table)
+    if writer is not None:
+        writer.close()
+
+register_exporter('csv', 'CSV', 'csv', _export_csv)
+register_exporter('csv_gz', 'CSV (gzip)', 'csv.gz', _export_csv_gzip)
+register_exporter('csv_zst', 'CSV (zstd)', 'csv.zst', _export_csv_zstd, available=zstandard is not None)
+register_exporter('parquet', 'Parquet', 'parquet', _export_parquet, available=pyarrow is not None)
+register_exporter('feather', 'Arrow IPC (Feather)', 'feather', _export_feather, available=pyarrow is not None)
+
+# Функция для выгрузки данных в выбранном формате
+def export_report(chunks, filename, export_format='csv'):
+    """
+    Выгружает данные в выбранном формате в буфер в памяти.
+    
+    Args:
+        chunks (pandas.DataFrame или iterable): DataFrame или последовательность порций DataFrame
+        filename (str): Имя файла без расширения
+        export_format (str): Имя формата из EXPORTERS
+        
+    Returns:
+        SpillBuffer: Буфер с содержимым выгрузки
+    """
+    exporter = EXPORTERS[export_format]
+    if not exporter['available']:
+        raise ValueError(f"Формат выгрузки {exporter['label']} недоступен: не установлены нужные библиотеки")
+    if isinstance(chunks, pd.DataFrame):
+        chunks = [chunks]
+    
+    buffer = SpillBuffer(f"{filename}.{exporter['extension']}")
+    buffer.label = exporter['label']
+    
+    started = time.perf_counter()
+    exporter['export'](chunks, buffer)
+    logging.info(
+        f"Выгрузка {buffer.filename} ({exporter['label']}): {buffer.size} байт "
+        f"за {(time.perf_counter() - started) * 1000:.1f} мс"
+    )
+    return buffer
+
+# Функция для экспорта данных в CSV
+def export_to_csv(df, filename):
+    """
+    Экспортирует данные из DataFrame в CSV в памяти.
+    
+    Args:
+        df (pandas.DataFrame): DataFrame с данными для экспорта
+        filename (str): Имя файла CSV без расширения
+        
+    Returns:
+        SpillBuffer: Буфер с содержимым CSV
+    """
+    return export_report(df, filename, 'csv')
+
+# Настройки потоковой выгрузки
+STREAMING_EXPORT_ROW_THRESHOLD = int(os.getenv('STREAMING_EXPORT_ROW_THRESHOLD', '200000'))
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', '10000'))
+EXPORT_GZIP_LARGE = os.getenv('EXPORT_GZIP_LARGE', '1') == '1'
+
+# Функция для потоковой выгрузки отчета
+def stream_report(report_type, start_date, end_date, filename, export_format='csv', chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Выгружает отчет постранично, читая курсор SQLite порциями по chunk_rows строк,
+    без загрузки всего результата в DataFrame. Объем памяти ограничен размером порции
+    и порогом SPILL_TO_DISK_BYTES, после которого буфер переносится на диск.
+    Несжатый CSV при EXPORT_GZIP_LARGE заменяется на CSV (gzip).
+    
+    Args:
+        report_type (str): Тип отчета ('sales' или 'activity')
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        filename (str): Имя файла без расширения
+        export_format (str): Имя формата из EXPORTERS
+        chunk_rows (int): Количество строк в одной порции
+        
+    Returns:
+        SpillBuffer: Буфер с содержимым выгрузки
+    """
+    if export_format == 'csv' and EXPORT_GZIP_LARGE:
+        export_format = 'csv_gz'
+    
+    with db_pool.reader() as conn:
+        query, params = select_report_query(conn, report_type, start_date, end_date)
+        chunks = read_frame(conn, query, params, chunksize=chunk_rows)
+        return export_report(chunks, filename, export_format)
+
+# Функция для выгрузки отчета с автоматическим выбором режима
+def build_report_export(report_type, df, start_date, end_date, filename, row_count, export_format='csv'):
+    """
+    Выгружает отчет: из готового DataFrame для небольших отчетов
+    или потоково из базы данных, если строк больше STREAMING_EXPORT_ROW_THRESHOLD.
+    
+    Args:
+        report_type (str): Тип отчета ('sales' или 'activity')
+        df (pandas.DataFrame): Данные отчета или None, если они не загружались
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        filename (str): Имя файла без расширения
+        row_count (int): Оценка количества строк отчета
+        export_format (str): Имя формата из EXPORTERS
+        
+    Returns:
+        SpillBuffer: Буфер с содержимым выгрузки
+    """
+    if df is None or row_count > STREAMING_EXPORT_ROW_THRESHOLD:
+        return stream_report(report_type, start_date, end_date, filename, export_format)
+    return export_report(df, filename, export_format)
+
+# Функции загрузки детальных данных отчета и данных его графика
+REPORT_DATA_LOADERS = {
+    'sales': get_sales_data,
+    'activity': get_user_activity_data,
+}
+
+REPORT_CHART_LOADERS = {
+    'sales': get_sales_data,
+    'activity': get_activity_chart_data,
+}
+
+# Тексты отчетов по виду отчета
+REPORT_TEXTS = {
+    'sales': {
+        'empty': "Нет данных о продажах за {period}.",
+        'chart': "График продаж за {period}",
+        'document': "Отчет о продажах за {period} в формате {label}",
+    },
+    'activity': {
+        'empty': "Нет данных об активности пользователей за {period}.",
+        'chart': "График активности пользователей за {period}",
+        'document': "Отчет об активности пользователей за {period} в формате {label}",
+    },
+}
+
+async def load_shared(loader, start_date, end_date):
+    """
+    Загружает данные за период в пуле ввода-вывода. Одновременные одинаковые
+    загрузки объединяются в один запрос к базе.
+    
+    Args:
+        loader (callable): Функция загрузки loader(start_date, end_date)
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        
+    Returns:
+        Результат загрузки (общий для всех ожидающих, изменять его нельзя)
+    """
+    key = ('data', loader.__name__, start_date, end_date)
+    return await request_flights.do(key, job_executor.run_io, loader, start_date, end_date)
+
+def report_export_filename(report_type, start_date, end_date):
+    """
+    Возвращает имя файла выгрузки отчета без расширения.
+    
+    Args:
+        report_type (str): Тип отчета ('sales' или 'activity')
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        
+    Returns:
+        str: Имя файла
+    """
+    return f"{report_type}_report_{start_date}_to_{end_date}"
+
+def build_period_export(report_type, start_date, end_date, export_format='csv', df=None):
+    """
+    Строит выгрузку отчета за период. Детальные данные загружаются в память,
+    только если отчет небольшой, иначе выгрузка идет потоково из базы.
+    
+    Args:
+        report_type (str): Тип отчета ('sales' или 'activity')
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        export_format (str): Имя формата из EXPORTERS
+        df (pandas.DataFrame, optional): Уже загруженные детальные данные отчета
+        
+    Returns:
+        SpillBuffer: Буфер с содержимым выгрузки
+    """
+    if df is not None:
+        row_count = len(df)
+    else:
+        row_count = estimate_report_rows(report_type, start_date, end_date)
+        if row_count <= STREAMING_EXPORT_ROW_THRESHOLD:
+            df = REPORT_DATA_LOADERS[report_type](start_date, end_date)
+    
+    filename = report_export_filename(report_type, start_date, end_date)
+    return build_report_export(report_type, df, start_date, end_date, filename, row_count, export_format)
+
+# Настройки готовых выгрузок отчетов
+REPORT_ARTIFACT_MAX_BYTES = int(os.getenv('REPORT_ARTIFACT_MAX_BYTES', str(20 * 1024 * 1024)))
+REPORT_ARTIFACT_KEEP_DAYS = int(os.getenv('REPORT_ARTIFACT_KEEP_DAYS', '2'))
+
+# Запросы отпечатка данных периода: результат меняется при вставке или удалении строк периода
+REPORT_FINGERPRINT_QUERIES = {
+    'rollup': {
+        'sales': """
+            SELECT COUNT(*), TOTAL(sales_count), ROUND(TOTAL(total_amount), 2)
+            FROM sales_daily
+            WHERE day BETWEEN ? AND ?
+        """,
+        'activity': """
+            SELECT COUNT(*), TOTAL(action_count)
+            FROM activity_daily
+            WHERE day BETWEEN ? AND ?
+        """,
+    },
+    'raw': {
+        'sales': """
+            SELECT COUNT(*), ROUND(TOTAL(amount), 2)
+            FROM sales
+            WHERE day BETWEEN ? AND ?
+        """,
+        'activity': """
+            SELECT COUNT(*), MAX(id)
+            FROM {activity}
+            WHERE action_ts BETWEEN ? AND ?
+        """,
+    },
+}
+
+def report_data_fingerprint(conn, report_type, start_date, end_date):
+    """
+    Вычисляет отпечаток данных отчета за период по агрегированной таблице,
+    если она актуальна, иначе по исходной таблице.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение для чтения
+        report_type (str): Тип отчета ('sales' или 'activity')
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        
+    Returns:
+        str: Отпечаток данных
+    """
+    rollup = 'sales_daily' if report_type == 'sales' else 'activity_daily'
+    if rollup_is_valid(conn, rollup):
+        source, params = 'rollup', period_days(start_date, end_date)
+    elif report_type == 'sales':
+        source, params = 'raw', period_days(start_date, end_date)
+    else:
+        source, params = 'raw', period_seconds(start_date, end_date)
+    
+    query = REPORT_FINGERPRINT_QUERIES[source][report_type]
+    if source == 'raw' and report_type == 'activity':
+        query = query.format(activity=activity_source(conn, start_date, end_date))
+    row = conn.execute(query, params).fetchone()
+    return f"{source}:{tuple(row)}"
+
+def save_report_artifact(report_type, start_date, end_date, export_format, buffer, fingerprint):
+    """
+    Сохраняет готовую выгрузку отчета в базе данных.
+    
+    Args:
+        report_type (str): Тип отчета ('sales' или 'activity')
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        export_format (str): Имя формата из EXPORTERS
+        buffer (SpillBuffer): Буфер с содержимым выгрузки
+        fingerprint (str): Отпечаток данных, по которым построена выгрузка
+        
+    Returns:
+        bool: True, если выгрузка сохранена (слишком большие выгрузки не сохраняются)
+    """
+    if buffer.size > REPORT_ARTIFACT_MAX_BYTES:
+        return False
+    
+    with db_pool.writer() as conn:
+        conn.execute(
+            '''
+            INSERT INTO report_artifacts
+                (report_type, start_date, end_date, export_format, fingerprint, filename, label, content, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (report_type, start_date, end_date, export_format) DO UPDATE SET
+                fingerprint = excluded.fingerprint,
+                filename = excluded.filename,
+                label = excluded.label,
+                content = excluded.content,
+                created_at = excluded.created_at
+            ''',
+            (
+                report_type, start_date, end_date, export_format, fingerprint,
+                buffer.filename, buffer.label, buffer.getvalue(),
+                datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            )
+        )
+    return True
+
+def load_report_artifact(report_type, start_date, end_date, export_format):
+    """
+    Загружает готовую выгрузку отчета, если данные периода с момента ее
+    построения не менялись.
+    
+    Args:
+        report_type (str): Тип отчета ('sales' или 'activity')
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        export_format (str): Имя формата из EXPORTERS
+        
+    Returns:
+        SpillBuffer: Буфер с содержимым выгрузки или None, если готовой выгрузки нет
+    """
+    with db_pool.reader() as conn:
+        row = conn.execute(
+            '''
+            SELECT fingerprint, filename, label, content FROM report_artifacts
+            WHERE report_type = ? AND start_date = ? AND end_date = ? AND export_format = ?
+            ''',
+            (report_type, start_date, end_date, export_format)
+        ).fetchone()
+        if row is None or row[0] != report_data_fingerprint(conn, report_type, start_date, end_date):
+            return None
+    
+    fingerprint, filename, label, content = row
+    buffer = SpillBuffer(filename)
+    buffer.label = label
+    buffer.write(content)
+    return buffer
+
+def precompute_report_export(report_type, start_date, end_date, export_format='csv'):
+    """
+    Строит выгрузку отчета за период и сохраняет ее для последующих запросов.
+    
+    Args:
+        report_type (str): Тип отчета ('sales' или 'activity')
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        export_format (str): Имя формата из EXPORTERS
+        
+    Returns:
+        bool: True, если выгрузка сохранена
+    """
+    # Отпечаток снимается до построения: если данные изменятся во время выгрузки,
+    # сохраненная выгрузка просто не пройдет проверку
+    with db_pool.reader() as conn:
+        fingerprint = report_data_fingerprint(conn, report_type, start_date, end_date)
+    
+    buffer = build_period_export(report_type, start_date, end_date, export_format)
+    try:
+        return save_report_artifact(report_type, start_date, end_date, export_format, buffer, fingerprint)
+    finally:
+        buffer.discard()
+
+def prune_report_artifacts(keep_days=REPORT_ARTIFACT_KEEP_DAYS):
+    """
+    Удаляет готовые выгрузки, построенные раньше чем keep_days дней назад.
+    
+    Args:
+        keep_days (int): Срок хранения в днях
+        
+    Returns:
+        int: Количество удаленных выгрузок
+    """
+    cutoff = (datetime.datetime.now() - datetime.timedelta(days=keep_days)).strftime("%Y-%m-%d %H:%M:%S")
+    with db_pool.writer() as conn:
+        return conn.execute("DELETE FROM report_artifacts WHERE created_at < ?", (cutoff,)).rowcount
+
+def get_report_export(report_type, start_date, end_date, export_format='csv', df=None):
+    """
+    Возвращает выгрузку отчета за период: заранее построенную, если она есть
+    и данные не менялись, иначе строит ее.
+    
+    Args:
+        report_type (str): Тип отчета ('sales' или 'activity')
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        export_format (str): Имя формата из EXPORTERS
+        df (pandas.DataFrame, optional): Уже загруженные детальные данные отчета
+        
+    Returns:
+        SpillBuffer: Буфер с содержимым выгрузки
+    """
+    buffer = load_report_artifact(report_type, start_date, end_date, export_format)
+    if buffer is not None:
+        logging.info(f"Выгрузка {buffer.filename} взята из заранее построенных")
+        return buffer
+    return build_period_export(report_type, start_date, end_date, export_format, df)
+
+# Настройки статистики
+STATS_TOP_PRODUCTS = int(os.getenv('STATS_TOP_PRODUCTS', '10'))
+STATS_TOP_USERS = int(os.getenv('STATS_TOP_USERS', '5'))
+
+# Сводка статистики продаж
+@dataclass
+class SalesSummary:
+    period_name: str
+    total_amount: float
+    sales_count: int
+    average_order: float
+    days: int
+    daily_median: float
+    daily_p90: float
+    best_day: Optional[Tuple[str, float]] = None
+    day_growth: Optional[float] = None  # Изменение последнего дня к предыдущему, %
+    products: List[Tuple[str, float, float]] = field(default_factory=list)  # (товар, сумма, доля %)
+
+# Сводка статистики активности
+@dataclass
+class ActivitySummary:
+    period_name: str
+    total_actions: int
+    active_users: int
+    per_user_median: float
+    per_user_p90: float
+    day_growth: Optional[float] = None  # Изменение последнего дня к предыдущему, %
+    action_types: List[Tuple[str, int, float]] = field(default_factory=list)  # (тип, количество, доля %)
+    top_users: List[Tuple[str, int]] = field(default_factory=list)  # (пользователь, количество)
+
+def _day_growth(daily_totals):
+    """
+    Возвращает изменение последнего дня к предыдущему в процентах.
+    
+    Args:
+        daily_totals (numpy.ndarray): Итоги по дням в хронологическом порядке
+        
+    Returns:
+        float: Изменение в процентах или None, если дней меньше двух или предыдущий день нулевой
+    """
+    if len(daily_totals) < 2 or daily_totals[-2] == 0:
+        return None
+    return float((daily_totals[-1] / daily_totals[-2] - 1) * 100)
+
+def _grouped_sums(keys, values):
+    """
+    Суммирует значения по ключам за один проход (factorize + bincount).
+    Строки с пустым ключом (NULL в базе) не учитываются, как при groupby.
+    
+    Args:
+        keys (pandas.Series): Ключи группировки
+        values (numpy.ndarray): Значения
+        
+    Returns:
+        tuple: (уникальные ключи в отсортированном порядке, суммы)
+    """
+    codes, uniques = pd.factorize(keys, sort=True)
+    known = codes >= 0
+    return np.asarray(uniques), np.bincount(codes[known], weights=values[known], minlength=len(uniques))
+
+# Функция для вычисления сводки продаж
+def summarize_sales(df, period_name, top_n=STATS_TOP_PRODUCTS):
+    """
+    Вычисляет все показатели статистики продаж векторными операциями:
+    итоги по дням и по товарам считаются одним проходом каждый.
+    Продажи без названия товара входят в общую сумму и итоги по дням,
+    но не в рейтинг товаров.
+    
+    Args:
+        df (pandas.DataFrame): DataFrame с данными о продажах
+        period_name (str): Название периода
+        top_n (int): Количество товаров в рейтинге
+        
+    Returns:
+        SalesSummary: Сводка статистики
+    """
+    amounts = df['total_amount'].fillna(0).to_numpy(dtype=float)
+    dates, daily_totals = _grouped_sums(df['date'], amounts)
+    products, product_totals = _grouped_sums(df['product_name'], amounts)
+    
+    total_amount = float(amounts.sum())
+    sales_count = int(df['sales_count'].sum()) if 'sales_count' in df else 0
+    
+    order = np.argsort(-product_totals, kind='stable')[:top_n]
+    best = int(np.argmax(daily_totals)) if len(daily_totals) else None
+    
+    return SalesSummary(
+        period_name=period_name,
+        total_amount=total_amount,
+        sales_count=sales_count,
+        average_order=total_amount / sales_count if sales_count else 0.0,
+        days=len(dates),
+        daily_median=float(np.percentile(daily_totals, 50)) if len(daily_totals) else 0.0,
+        daily_p90=float(np.percentile(daily_totals, 90)) if len(daily_totals) else 0.0,
+        best_day=(pd.Timestamp(dates[best]).strftime("%Y-%m-%d"), float(daily_totals[best])) if best is not None else None,
+        day_growth=_day_growth(daily_totals),
+        products=[
+            (str(products[i]), float(product_totals[i]), float(product_totals[i] / total_amount * 100) if total_amount else 0.0)
+            for i in order
+        ],
+    )
+
+# Шаблоны текста статистики
+SALES_STATS_TEMPLATE = """📊 Статистика продаж за {s.period_name}:
+
+📈 Общая сумма продаж: {s.total_amount:.2f} грн
+🧾 Количество продаж: {s.sales_count}
+💳 Средний чек: {s.average_order:.2f} грн
+📅 Продажи за день: медиана {s.daily_median:.2f} грн, 90-й перцентиль {s.daily_p90:.2f} грн
+{extra}
+🏆 Продажи по товарам:
+{products}
+"""
+
+ACTIVITY_STATS_TEMPLATE = """📊 Статистика активности за {s.period_name}:
+
+📈 Общее количество действий: {s.total_actions}
+👤 Активных пользователей: {s.active_users}
+📐 Действий на пользователя: медиана {s.per_user_median:.0f}, 90-й перцентиль {s.per_user_p90:.0f}
+{extra}
+🔍 Распределение по типам действий:
+{action_types}
+
+👥 Самые активные пользователи:
+{top_users}
+"""
+
+def _growth_line(growth):
+    if growth is None:
+        return ""
+    icon = "📉" if growth < 0 else "📈"
+    return f"{icon} Последний день к предыдущему: {growth:+.1f}%\n"
+
+def render_sales_stats(summary):
+    """
+    Формирует текст статистики продаж по шаблону.
+    
+    Args:
+        summary (SalesSummary): Сводка статистики
+        
+    Returns:
+        str: Текст статистики
+    """
+    extra = ""
+    if summary.best_day is not None:
+        extra += f"⭐ Лучший день: {summary.best_day[0]} ({summary.best_day[1]:.2f} грн)\n"
+    extra += _growth_line(summary.day_growth)
+    products = "\n".join(f"- {name}: {amount:.2f} грн ({share:.1f}%)" for name, amount, share in summary.products)
+    return SALES_STATS_TEMPLATE.format(s=summary, extra=extra, products=products)
+
+def render_activity_stats(summary):
+    """
+    Формирует текст статистики активности по шаблону.
+    
+    Args:
+        summary (ActivitySummary): Сводка статистики
+        
+    Returns:
+        str: Текст статистики
+    """
+    action_types = "\n".join(f"- {action}: {count} ({share:.1f}%)" for action, count, share in summary.action_types)
+    top_users = "\n".join(f"- {user}: {count} действий" for user, count in summary.top_users)
+    return ACTIVITY_STATS_TEMPLATE.format(
+        s=summary, extra=_growth_line(summary.day_growth), action_types=action_types, top_users=top_users
+    )
+
+# Функция для формирования текстовой статистики продаж
+def build_sales_stats_text(df, period_name):
+    """
+    Анализирует данные о продажах и формирует текст статистики.
+    
+    Args:
+        df (pandas.DataFrame): DataFrame с данными о продажах
+        period_name (str): Название периода
+        
+    Returns:
+        str: Текст статистики
+    """
+    return render_sales_stats(summarize_sales(df, period_name))
+
+# Функция для вычисления дат начала и конца периода
+def get_date_range(period_type, today=None):
+    """
+    Вычисляет даты начала и конца периода на основе типа периода.
+    
+    Args:
+        period_type (str): Тип периода ('day', 'week', 'month', 'year')
+        today (datetime.date, optional): Дата, для которой вычисляется период (по умолчанию сегодня)
+        
+    Returns:
+        tuple: Кортеж с начальной и конечной датами в формате 'YYYY-MM-DD'
+    """
+    today = today or datetime.date.today()
+    
+    if period_type == 'day':
+        start_date = today
+        end_date = today
+    elif period_type == 'week':
+        start_date = today - datetime.timedelta(days=today.weekday())
+        end_date = start_date + datetime.timedelta(days=6)
+    elif period_type == 'month':
+        start_date = today.replace(day=1)
+        last_day = calendar.monthrange(today.year, today.month)[1]
+        end_date = today.replace(day=last_day)
+    elif period_type == 'year':
+        start_date = today.replace(month=1, day=1)
+        end_date = today.replace(month=12, day=31)
+    else:
+        # По умолчанию возвращаем текущий месяц
+        start_date = today.replace(day=1)
+        last_day = calendar.monthrange(today.year, today.month)[1]
+        end_date = today.replace(day=last_day)
+    
+    return start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d")
+
+# Названия периодов в текстах отчетов и статистики
+PERIOD_NAMES = {
+    'day': 'день',
+    'week': 'неделю',
+    'month': 'месяц',
+    'year': 'год',
+}
+
+def get_period_name(period_type, start_date, end_date):
+    """
+    Возвращает название периода для текстов и заголовков графиков.
+    
+    Args:
+        period_type (str): Тип периода ('day', 'week', 'month', 'year', 'custom')
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        
+    Returns:
+        str: Название периода
+    """
+    return PERIOD_NAMES.get(period_type, f'период {start_date} - {end_date}')
+
+# Настройки массовой загрузки продаж
+INGEST_CHUNK_ROWS = int(os.getenv('INGEST_CHUNK_ROWS', '50000'))
+
+# Форматы файлов для загрузки: формат -> расширения (сжатие gzip/zip/bz2/xz определяется pandas)
+INGEST_FORMATS = {
+    'csv': ('.csv', '.csv.gz', '.csv.zip', '.csv.bz2', '.csv.xz'),
+    'jsonl': ('.jsonl', '.ndjson', '.jsonl.gz', '.ndjson.gz'),
+}
+
+SALES_REQUIRED_COLUMNS = ('product_name', 'amount', 'date')
+
+def _detect_ingest_format(path):
+    """
+    Определяет формат файла продаж по расширению.
+    
+    Args:
+        path (str): Путь к файлу
+        
+    Returns:
+        str: 'csv' или 'jsonl'
+    """
+    lower = path.lower()
+    for file_format, extensions in INGEST_FORMATS.items():
+        if lower.endswith(extensions):
+            return file_format
+    raise ValueError(f"Не удалось определить формат файла {path}, укажите его явно")
+
+def _read_sales_chunks(path, file_format, chunk_rows, skip_rows):
+    """
+    Читает файл продаж частями, пропуская уже загруженные строки.
+    
+    Args:
+        path (str): Путь к файлу
+        file_format (str): 'csv' или 'jsonl'
+        chunk_rows (int): Количество строк в части
+        skip_rows (int): Количество строк данных, которые нужно пропустить
+        
+    Yields:
+        pandas.DataFrame: Очередная часть файла
+    """
+    if file_format == 'csv':
+        yield from pd.read_csv(
+            path,
+            chunksize=chunk_rows,
+            dtype=str,
+            skiprows=range(1, skip_rows + 1) if skip_rows else None
+        )
+        return
+    
+    with pd.read_json(path, lines=True, chunksize=chunk_rows, dtype=False) as reader:
+        for chunk in reader:
+            if skip_rows >= len(chunk):
+                skip_rows -= len(chunk)
+                continue
+            yield chunk.iloc[skip_rows:]
+            skip_rows = 0
+
+def _optional_int_column(chunk, name):
+    if name not in chunk:
+        return [None] * len(chunk)
+    values = pd.to_numeric(chunk[name], errors='coerce')
+    return [None if pd.isna(value) else int(value) for value in values.tolist()]
+
+def prepare_sales_chunk(chunk):
+    """
+    Проверяет и приводит часть файла продаж к строкам таблицы sales.
+    Строки без названия товара, с некорректной суммой или датой отбрасываются.
+    
+    Args:
+        chunk (pandas.DataFrame): Часть файла
+        
+    Returns:
+        tuple: (список кортежей (product_id, product_name, amount, date, user_id), количество отброшенных строк)
+    """
+    missing = [column for column in SALES_REQUIRED_COLUMNS if column not in chunk]
+    if missing:
+        raise ValueError(f"В файле нет обязательных столбцов: {', '.join(missing)}")
+    
+    product_name = chunk['product_name'].astype('string').str.strip()
+    amount = pd.to_numeric(chunk['amount'], errors='coerce')
+    date = pd.to_datetime(chunk['date'], errors='coerce')
+    
+    valid = (product_name.fillna('') != '') & amount.notna() & (amount >= 0) & date.notna()
+    valid = valid.to_numpy()
+    
+    rows = list(zip(
+        [value for value, keep in zip(_optional_int_column(chunk, 'product_id'), valid) if keep],
+        product_name[valid].tolist(),
+        amount[valid].round(2).tolist(),
+        date[valid].dt.strftime("%Y-%m-%d").tolist(),
+        [value for value, keep in zip(_optional_int_column(chunk, 'user_id'), valid) if keep],
+    ))
+    return rows, int(len(chunk) - len(rows))
+
+# Агрегированные таблицы, которые поддерживаются триггерами исходных таблиц
+# (у журнала активности - триггерами каждой секции)
+ROLLUP_SOURCES = {
+    'sales': 'sales_daily',
+    'user_activity': 'activity_daily',
+}
+
+def _rollup_source(table):
+    if table.startswith(ACTIVITY_PARTITION_PREFIX):
+        return ROLLUP_SOURCES['user_activity']
+    return ROLLUP_SOURCES[table]
+
+def _drop_bulk_load_objects(conn, tables=('sales',)):
+    """
+    Снимает индексы и триггеры таблиц на время массовой загрузки. Их определения
+    сохраняются в ingest_dropped_objects в той же транзакции, поэтому после сбоя
+    они будут восстановлены при следующем запуске.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение внутри транзакции записи
+        tables (tuple): Имена таблиц; 'user_activity' означает все действующие секции журнала
+    """
+    if 'user_activity' in tables:
+        tables = [table for table in tables if table != 'user_activity'] + activity_partition_names(conn)
+        # Без секций триггеров нет, но агрегированная таблица все равно будет пересобрана
+        conn.execute("UPDATE rollup_state SET valid = 0 WHERE name = ?", (ROLLUP_SOURCES['user_activity'],))
+    
+    for table in tables:
+        objects = conn.execute(
+            """
+            SELECT type, name, sql FROM sqlite_master
+            WHERE tbl_name = ? AND type IN ('index', 'trigger') AND sql IS NOT NULL
+            """,
+            (table,)
+        ).fetchall()
+        for object_type, name, sql in objects:
+            conn.execute("INSERT OR REPLACE INTO ingest_dropped_objects (name, sql) VALUES (?, ?)", (name, sql))
+            conn.execute(f"DROP {object_type.upper()} IF EXISTS {name}")
+        
+        # Без триггера агрегированная таблица отстает: отчеты читают исходную таблицу
+        conn.execute("UPDATE rollup_state SET valid = 0 WHERE name = ?", (_rollup_source(table),))
+
+def _restore_dropped_objects(conn):
+    """
+    Восстанавливает индексы и триггеры, снятые на время загрузки,
+    и пересобирает отставшие агрегированные таблицы.
+    
+    Args:
+        conn (sqlite3.Connection): Соединение внутри транзакции записи
+        
+    Returns:
+        list: Имена восстановленных объектов
+    """
+    objects = conn.execute("SELECT name, sql FROM ingest_dropped_objects").fetchall()
+    if not objects:
+        return []
+    
+    for name, sql in objects:
+        try:
+            conn.execute(sql)
+        except sqlite3.OperationalError as e:
+            # Секция журнала могла быть сжата, пока ее индексы были сняты
+            logging.warning(f"Объект {name} не восстановлен: {e}")
+    conn.execute("DELETE FROM ingest_dropped_objects")
+    
+    stale = tuple(name for (name,) in conn.execute("SELECT name FROM rollup_state WHERE valid = 0"))
+    if stale:
+        _backfill_rollups(conn, stale)
+    return [name for name, _ in objects]
+
+# Функция для массовой загрузки продаж из файла
+def ingest_sales(path, file_format=None, chunk_rows=INGEST_CHUNK_ROWS, rebuild_indexes=False, resume=True):
+    """
+    Загружает продажи из файла CSV или JSON Lines потоково, частями по chunk_rows строк.
+    
+    Каждая часть проверяется и записывается одной транзакцией (insert_sales_rows)
+    вместе с контрольной точкой, поэтому прерванную загрузку можно продолжить
+    с места остановки. Контрольная точка привязана к размеру и времени изменения
+    файла: измененный файл загружается заново.
+    
+    Args:
+        path (str): Путь к файлу (csv, jsonl, возможно сжатый)
+        file_format (str, optional): 'csv' или 'jsonl'; по умолчанию определяется по расширению
+        chunk_rows (int): Количество строк в одной транзакции
+        rebuild_indexes (bool): Снять индексы и триггеры sales на время загрузки
+            и построить их заново в конце (быстрее для больших файлов)
+        resume (bool): Продолжить с контрольной точки, если она есть
+        
+    Returns:
+        dict: Количество прочитанных, загруженных и отброшенных строк, время и скорость загрузки
+    """
+    file_format = file_format or _detect_ingest_format(path)
+    source = os.path.abspath(path)
+    stat = os.stat(source)
+    fingerprint = f"{stat.st_size}:{stat.st_mtime_ns}"
+    
+    rows_done = inserted = rejected = 0
+    with db_pool.reader() as conn:
+        checkpoint = conn.execute(
+            "SELECT fingerprint, rows_done, inserted, rejected FROM ingest_checkpoints WHERE source = ?",
+            (source,)
+        ).fetchone()
+    if resume and checkpoint is not None and checkpoint[0] == fingerprint:
+        _, rows_done, inserted, rejected = checkpoint
+        logging.info(f"Продолжаем загрузку {path} с контрольной точки: обработано строк {rows_done}")
+    
+    if rebuild_indexes:
+        with db_pool.writer() as conn:
+            _drop_bulk_load_objects(conn, ('sales',))
+    
+    started = time.perf_counter()
+    read_rows = 0
+    try:
+        for chunk in _read_sales_chunks(source, file_format, chunk_rows, rows_done):
+            if chunk.empty:
+                continue
+            rows, chunk_rejected = prepare_sales_chunk(chunk)
+            read_rows += len(chunk)
+            rows_done += len(chunk)
+            inserted += len(rows)
+            rejected += chunk_rejected
+            
+            with db_pool.writer() as conn:
+                insert_sales_rows(conn, rows)
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO ingest_checkpoints (source, fingerprint, rows_done, inserted, rejected, updated_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    (source, fingerprint, rows_done, inserted, rejected,
+                     datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+                )
+                today_counters.record_sales(rows)
+                written = query_cache.record_write(conn, 'sales')
+            
+            query_cache.invalidate('sales', {row[3] for row in rows}, written)
+            
+            elapsed = time.perf_counter() - started
+            logging.info(
+                f"Загрузка {path}: обработано {rows_done} строк, загружено {inserted}, отброшено {rejected}, "
+                f"{read_rows / elapsed:.0f} строк/с"
+            )
+    finally:
+        if rebuild_indexes:
+            rebuild_started = time.perf_counter()
+            with db_pool.writer() as conn:
+                _restore_dropped_objects(conn)
+            logging.info(f"Индексы и агрегированная таблица продаж построены за {time.perf_counter() - rebuild_started:.2f} с")
+    
+    elapsed = time.perf_counter() - started
+    result = {
+        'rows_done': rows_done,
+        'inserted': inserted,
+        'rejected': rejected,
+        'elapsed_s': round(elapsed, 2),
+        'rows_per_sec': round(read_rows / elapsed) if elapsed else 0,
+    }
+    logging.info(f"Загрузка {path} завершена: {result}")
+    return result
+
+# Настройки генератора тестовых данных
+TEST_DATA_SEED = int(os.getenv('TEST_DATA_SEED', '42'))
+TEST_DATA_CHUNK_ROWS = int(os.getenv('TEST_DATA_CHUNK_ROWS', '100000'))
+
+# Тестовые пользователи получают ID из этого диапазона, чтобы не пересекаться с реальными
+TEST_USER_ID_BASE = 9_000_000_000_000
+
+# Продукты для тестовых данных: (ID, название, диапазон цен в гривнах, доля в продажах)
+TEST_PRODUCTS = (
+    (1, "Смартфон", (15000, 40000), 0.35),
+    (2, "Ноутбук", (25000, 85000), 0.20),
+    (3, "Наушники", (1500, 9000), 0.30),
+    (4, "Планшет", (8000, 30000), 0.15),
+)
+
+# Типы действий пользователей и их доли
+TEST_ACTIONS = (
+    ('start', 0.15),
+    ('report', 0.35),
+    ('stats', 0.50),
+)
+
+# Сезонность по дням недели (понедельник - воскресенье)
+TEST_WEEKDAY_FACTORS = (0.9, 0.9, 0.95, 1.0, 1.15, 1.3, 1.2)
+
+def _day_weights(dates):
+    """
+    Возвращает относительную интенсивность продаж по дням: недельная и годовая
+    сезонность (пик в декабре) и небольшой рост со временем.
+    
+    Args:
+        dates (pandas.DatetimeIndex): Дни периода
+        
+    Returns:
+        numpy.ndarray: Вероятности выбора каждого дня (сумма равна 1)
+    """
+    weekly = np.array(TEST_WEEKDAY_FACTORS)[dates.dayofweek.to_numpy()]
+    yearly = 1 + 0.35 * np.cos(2 * np.pi * (dates.dayofyear.to_numpy() - 350) / 365.25)
+    trend = np.linspace(0.8, 1.2, len(dates))
+    weights = weekly * yearly * trend
+    return weights / weights.sum()
+
+def _generate_sales_chunk(rng, size, dates, day_weights, user_ids):
+    """
+    Генерирует часть строк продаж векторными операциями.
+    
+    Returns:
+        list: Кортежи (product_id, product_name, amount, date, user_id)
+    """
+    products = rng.choice(len(TEST_PRODUCTS), size=size, p=[p[3] for p in TEST_PRODUCTS])
+    low = np.array([p[2][0] for p in TEST_PRODUCTS])[products]
+    high = np.array([p[2][1] for p in TEST_PRODUCTS])[products]
+    amounts = np.round(low + rng.random(size) * (high - low), 2)
+    days = rng.choice(len(dates), size=size, p=day_weights)
+    if user_ids is not None:
+        buyers = rng.choice(user_ids, size=size)
+    else:
+        buyers = rng.integers(100000, 1000000, size=size)
+    
+    return list(zip(
+        np.array([p[0] for p in TEST_PRODUCTS])[products].tolist(),
+        np.array([p[1] for p in TEST_PRODUCTS], dtype=object)[products].tolist(),
+        amounts.tolist(),
+        dates.strftime("%Y-%m-%d").to_numpy(dtype=object)[days].tolist(),
+        buyers.tolist(),
+    ))
+
+def _generate_activity_chunk(rng, size, dates, day_weights, user_ids, user_weights):
+    """
+    Генерирует часть журнала активности: небольшая доля пользователей
+    совершает большую часть действий.
+    
+    Returns:
+        list: Кортежи (user_id, action_type, action_date, additional_data)
+    """
+    users = rng.choice(user_ids, size=size, p=user_weights)
+    actions = rng.choice(len(TEST_ACTIONS), size=size, p=[a[1] for a in TEST_ACTIONS])
+    days = rng.choice(len(dates), size=size, p=day_weights)
+    timestamps = dates.to_numpy()[days] + rng.integers(0, 86400, size=size).astype('timedelta64[s]')
+    # Действия сегодняшнего дня не могут быть позже текущего момента
+    timestamps = np.minimum(timestamps, np.datetime64(datetime.datetime.now().replace(microsecond=0)))
+    
+    return list(zip(
+        users.tolist(),
+        np.array([a[0] for a in TEST_ACTIONS], dtype=object)[actions].tolist(),
+        pd.DatetimeIndex(timestamps).strftime("%Y-%m-%d %H:%M:%S").tolist(),
+        [None] * size,
+    ))
+
+def _insert_chunks(insert, generate, total, chunk_rows):
+    inserted = 0
+    while inserted < total:
+        rows = generate(min(chunk_rows, total - inserted))
+        with db_pool.writer() as conn:
+            insert(conn, rows)
+        inserted += len(rows)
+
+# Функция для генерации тестовых данных (для демонстрации и нагрузочных тестов)
+def generate_test_data(sales=300, days=31, users=20, activity=500, seed=TEST_DATA_SEED,
+                       chunk_rows=TEST_DATA_CHUNK_ROWS):
+    """
+    Генерирует тестовые продажи, пользователей и журнал активности за последние days дней.
+    
+    Данные генерируются векторно через NumPy и детерминированы: при одинаковых
+    параметрах и seed получается один и тот же набор. Продажи распределены по дням
+    с учетом недельной и годовой сезонности, товары - в заданных пропорциях.
+    Таблица продаж очищается полностью, пользователи и журнал - только тестовые
+    (ID начиная с TEST_USER_ID_BASE). На время загрузки индексы и триггеры
+    снимаются, агрегированные таблицы пересобираются в конце.
+    
+    Args:
+        sales (int): Количество продаж
+        days (int): Количество дней до сегодняшнего включительно
+        users (int): Количество тестовых пользователей
+        activity (int): Количество действий в журнале (нужны тестовые пользователи)
+        seed (int): Начальное значение генератора случайных чисел
+        chunk_rows (int): Количество строк в одной транзакции
+        
+    Returns:
+        dict: Количество сгенерированных строк, время и скорость генерации
+    """
+    started = time.perf_counter()
+    rng = np.random.default_rng(seed)
+    
+    end_date = pd.Timestamp(datetime.date.today())
+    dates = pd.date_range(end=end_date, periods=days, freq='D')
+    day_weights = _day_weights(dates)
+    
+    user_ids = TEST_USER_ID_BASE + np.arange(users, dtype=np.int64) if users else None
+    
+    with db_pool.writer() as conn:
+        # Секции создаются заранее, чтобы их индексы и триггеры тоже были сняты на время загрузки
+        if users and activity:
+            ensure_activity_partitions(conn, dates.strftime("%Y-%m").unique())
+        _drop_bulk_load_objects(conn, ('sales', 'user_activity'))
+        # Очищаем таблицу продаж и данные прошлых тестовых пользователей
+        conn.execute("DELETE FROM sales")
+        delete_activity_rows(conn, "user_id >= ?", (TEST_USER_ID_BASE,))
+        conn.execute("DELETE FROM activity_daily WHERE user_id >= ?", (TEST_USER_ID_BASE,))
+        conn.execute("DELETE FROM users WHERE user_id >= ?", (TEST_USER_ID_BASE,))
+    
+    try:
+        if users:
+            registered = dates[rng.integers(0, len(dates), size=users)].to_numpy().astype('datetime64[s]').astype(np.int64).tolist()
+            with db_pool.writer() as conn:
+                conn.executemany(
+                    "INSERT INTO users (user_id, username, first_name, last_name, registration_ts, last_activity_ts) VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (user_id, f"test_user_{user_id - TEST_USER_ID_BASE}", "Тест", None, date, date)
+                        for user_id, date in zip(user_ids.tolist(), registered)
+                    ]
+                )
+        
+        _insert_chunks(
+            insert_sales_rows,
+            lambda size: _generate_sales_chunk(rng, size, dates, day_weights, user_ids),
+            sales,
+            chunk_rows
+        )
+        
+        if users and activity:
+            # Закон Ципфа: активность пользователя обратно пропорциональна его рангу
+            user_weights = 1 / np.arange(1, users + 1) ** 0.8
+            user_weights /= user_weights.sum()
+            _insert_chunks(
+                insert_activity_rows,
+                lambda size: _generate_activity_chunk(rng, size, dates, day_weights, user_ids, user_weights),
+                activity,
+                chunk_rows
+            )
+    finally:
+        with db_pool.writer() as conn:
+            _restore_dropped_objects(conn)
+            # Данные заменены целиком: счетчики за сегодня загружаются заново
+            today_counters.rehydrate(conn)
+            written = {kind: query_cache.record_write(conn, kind) for kind in ('sales', 'activity')}
+        
+        query_cache.invalidate('sales', written=written['sales'])
+        query_cache.invalidate('activity', written=written['activity'])
+    
+    elapsed = time.perf_counter() - started
+    total = sales + users + (activity if users else 0)
+    result = {
+        'sales': sales,
+        'users': users,
+        'activity': activity if users else 0,
+        'elapsed_s': round(elapsed, 2),
+        'rows_per_sec': round(total / elapsed) if elapsed else 0,
+    }
+    logging.info(f"Тестовые данные сгенерированы: {result}")
+    return result
+
+# Настройки хранения журнала активности
+ACTIVITY_RETENTION_MONTHS = int(os.getenv('ACTIVITY_RETENTION_MONTHS', '12'))  # 0 - хранить без ограничений
+ACTIVITY_ARCHIVE_DIR = os.getenv('ACTIVITY_ARCHIVE_DIR', 'activity_archive')  # Пустая строка - без архива
+
+def archive_activity_partition(month, archive_dir=ACTIVITY_ARCHIVE_DIR, chunk_rows=EXPORT_CHUNK_ROWS):
+    """
+    Выгружает строки секции журнала активности в архив CSV (gzip).
+    Файл сначала пишется во временный и переименовывается после записи целиком.
+    
+    Args:
+        month (str): Месяц в формате 'YYYY-MM'
+        archive_dir (str): Каталог архива
+        chunk_rows (int): Количество строк в одной порции
+        
+    Returns:
+        tuple: (путь к файлу архива, количество строк)
+    """
+    name = activity_partition_name(month)
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"user_activity_{month}.csv.gz")
+    
+    rows = 0
+    def counted(chunks):
+        nonlocal rows
+        for chunk in chunks:
+            rows += len(chunk)
+            yield chunk
+    
+    with db_pool.reader() as conn:
+        if name not in activity_partition_names(conn):
+            raise ValueError(f"Нет действующей секции журнала активности за {month}")
+        # В архиве - названия типов действий и время в формате 'YYYY-MM-DD HH:MM:SS'
+        chunks = read_frame(
+            conn,
+            f"""
+            SELECT t.id, t.user_id, a.action_type, t.action_ts as action_date, t.additional_data
+            FROM {name} t LEFT JOIN action_types a ON a.action_key = t.action_key
+            ORDER BY t.id
+            """,
+            chunksize=chunk_rows,
+            columns={'action_date': 'second'}
+        )
+        with gzip.open(f"{path}.tmp", 'wb') as archive:
+            _write_csv_chunks(counted(chunks), archive)
+    os.replace(f"{path}.tmp", path)
+    
+    logging.info(f"Секция журнала активности за {month} выгружена в архив {path}: {rows} строк")
+    return path, rows
+
+def compact_activity_partition(month, archive_dir=ACTIVITY_ARCHIVE_DIR):
+    """
+    Сжимает секцию журнала активности: выгружает ее в архив, пересчитывает
+    по ней дневные итоги месяца в activity_daily и удаляет таблицу секции.
+    После сжатия отчеты и статистика за месяц строятся по дневным итогам.
+    
+    Args:
+        month (str): Месяц в формате 'YYYY-MM'
+        archive_dir (str): Каталог архива (пустая строка - без архива)
+        
+    Returns:
+        bool: True, если секция сжата
+    """
+    name = activity_partition_name(month)
+    archive_path, archived_rows = archive_activity_partition(month, archive_dir) if archive_dir else (None, None)
+    
+    with db_pool.writer() as conn:
+        if name not in activity_partition_names(conn):
+            return False
+        row_count = conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+        if archived_rows is not None and archived_rows != row_count:
+            # Секция изменилась после выгрузки - архив неполный, сжатие откладывается
+            logging.warning(f"Секция за {month} изменилась во время выгрузки в архив, сжатие отложено")
+            return False
+        
+        conn.execute("DELETE FROM activity_daily WHERE day >= ? AND day < ?", _month_days(month))
+        conn.execute(f'''
+        INSERT INTO activity_daily (day, user_id, action_key, action_count)
+        SELECT action_ts / 86400, user_id, action_key, COUNT(*)
+        FROM {name}
+        GROUP BY action_ts / 86400, user_id, action_key
+        ''')
+        conn.execute(f"DROP TABLE {name}")
+        conn.execute(
+            '''
+            UPDATE activity_partitions
+            SET state = 'compacted', row_count = ?, compacted_at = ?, archive_path = ?
+            WHERE month = ?
+            ''',
+            (row_count, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), archive_path, month)
+        )
+        _rebuild_activity_view(conn)
+        written = query_cache.record_write(conn, 'activity')
+    
+    query_cache.invalidate('activity', written=written)
+    logging.info(f"Секция журнала активности за {month} сжата: {row_count} строк")
+    return True
+
+def apply_activity_retention(today=None, retention_months=ACTIVITY_RETENTION_MONTHS, archive_dir=ACTIVITY_ARCHIVE_DIR):
+    """
+    Сжимает секции журнала активности старше retention_months полных месяцев.
+    
+    Args:
+        today (datetime.date, optional): Текущая дата
+        retention_months (int): Сколько полных месяцев до текущего хранить детальный журнал
+        archive_dir (str): Каталог архива (пустая строка - без архива)
+        
+    Returns:
+        list: Сжатые месяцы
+    """
+    if retention_months <= 0:
+        return []
+    
+    today = today or datetime.date.today()
+    index = today.year * 12 + today.month - 1 - retention_months
+    cutoff = f"{index // 12:04d}-{index % 12 + 1:02d}"
+    with db_pool.reader() as conn:
+        months = [month for (month,) in conn.execute(
+            "SELECT month FROM activity_partitions WHERE state = 'active' AND month < ? ORDER BY month",
+            (cutoff,)
+        )]
+    
+    compacted = []
+    for month in months:
+        try:
+            if compact_activity_partition(month, archive_dir):
+                compacted.append(month)
+        except Exception as e:
+            logging.error(f"Ошибка при сжатии секции журнала активности за {month}: {e}")
+    return compacted
+
+# Периоды и операции нагрузочного теста
+BENCHMARK_PERIODS = ('day', 'week', 'month', 'year')
+
+def run_benchmark(repeats=3):
+    """
+    Измеряет время основных операций отчетов и статистики на текущих данных.
+    Перед каждым замером кэш запросов очищается.
+    
+    Args:
+        repeats (int): Количество повторов каждого замера (берется лучший результат)
+        
+    Returns:
+        dict: {период: {операция: время в миллисекундах}}
+    """
+    operations = {
+        'sales_data': lambda start, end: get_sales_data(start, end),
+        'sales_stats': lambda start, end: build_sales_stats_text(get_sales_data(start, end), 'период'),
+        'activity_data': lambda start, end: get_user_activity_data(start, end),
+        'activity_stats': lambda start, end: get_activity_summary(start, end, 'период'),
+        'activity_chart_data': lambda start, end: get_activity_chart_data(start, end),
+    }
+    
+    results = {}
+    for period in BENCHMARK_PERIODS:
+        start_date, end_date = get_date_range(period)
+        results[period] = {}
+        for name, operation in operations.items():
+            timings = []
+            for _ in range(repeats):
+                query_cache.invalidate('sales')
+                query_cache.invalidate('activity')
+                started = time.perf_counter()
+                operation(start_date, end_date)
+                timings.append((time.perf_counter() - started) * 1000)
+            results[period][name] = round(min(timings), 2)
+        logging.info(f"Нагрузочный тест, период '{period}': {results[period]}")
+    
+    return results
+
+# Создаем клавиатуры для меню
+def get_main_keyboard():
+    """
+    Создает основную клавиатуру с кнопками команд бота.
+    
+    Returns:
+        ReplyKeyboardMarkup: Объект клавиатуры с кнопками команд
+    """
+    keyboard = ReplyKeyboardMarkup(
+        keyboard=[
+            [KeyboardButton(text="/report"), KeyboardButton(text="/stats")]
+        ],
+        resize_keyboard=True
+    )
+    return keyboard
+
+def get_report_type_keyboard():
+    """
+    Создает клавиатуру для выбора типа отчета.
+    
+    Returns:
+        InlineKeyboardMarkup: Объект инлайн-клавиатуры с типами отчетов
+    """
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="Продажи", callback_data="report_sales")],
+            [InlineKeyboardButton(text="Активность пользователей", callback_data="report_activity")]
+        ]
+    )
+    return keyboard
+
+def get_format_keyboard():
+    """
+    Создает клавиатуру для выбора формата выгрузки отчета.
+    
+    Returns:
+        InlineKeyboardMarkup: Объект инлайн-клавиатуры с доступными форматами
+    """
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=exporter['label'], callback_data=f"format_{name}")]
+            for name, exporter in get_available_exporters().items()
+        ]
+    )
+    return keyboard
+
+def get_period_keyboard():
+    """
+    Создает клавиатуру для выбора периода отчета/статистики.
+    
+    Returns:
+        InlineKeyboardMarkup: Объект инлайн-клавиатуры с периодами
+    """
+    keyboard = InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text="День", callback_data="period_day")],
+            [InlineKeyboardButton(text="Неделя", callback_data="period_week")],
+            [InlineKeyboardButton(text="Месяц", callback_data="period_month")],
+            [InlineKeyboardButton(text="Год", callback_data="period_year")],
+            [InlineKeyboardButton(text="Указать диапазон", callback_data="period_custom")]
+        ]
     )
     return keyboard
 
@@ -477,15 +4866,33 @@ async def cmd_start(message: Message):
     Отправляет приветственное сообщение и регистрирует пользователя.
     """
     user = message.from_user
-    register_user(user.id, user.username, user.first_name, user.last_name)
+    job_executor.cancel_user_jobs(user.id)
+    await job_executor.run_io(register_user, user.id, user.username, user.first_name, user.last_name)
     log_user_activity(user.id, 'start')
     
-    await message.answer(
+    await outbox.send_message(
+        message.chat.id,
         f"Привет, {user.first_name}! Я бот для аналитики данных.\n\n"
         "Я могу помочь тебе собирать и анализировать данные, генерировать отчеты и экспортировать их в CSV.\n\n"
         "Доступные команды:\n"
         "/report - создать отчет\n"
-        "/stats - просмотреть статистику",
+        "/stats - просмотреть статистику\n"
+        "/subscribe - подписаться на регулярные отчеты\n"
+        "/cancel - отменить текущее действие",
+        reply_markup=get_main_keyboard()
+    )
+
+@dp.message(Command("cancel"))
+async def cmd_cancel(message: Message, state: FSMContext):
+    """
+    Обработчик команды /cancel.
+    Сбрасывает состояние и отменяет формирование отчета или статистики.
+    """
+    job_executor.cancel_user_jobs(message.from_user.id)
+    await state.clear()
+    await outbox.send_message(
+        message.chat.id,
+        "Действие отменено.",
         reply_markup=get_main_keyboard()
     )
 
@@ -496,10 +4903,12 @@ async def cmd_report(message: Message, state: FSMContext):
     Инициирует процесс создания отчета.
     """
     user = message.from_user
+    job_executor.cancel_user_jobs(user.id)
     log_user_activity(user.id, 'report')
     
     await state.set_state(ReportStates.waiting_for_report_type)
-    await message.answer(
+    await outbox.send_message(
+        message.chat.id,
         "Какой тип отчета вы хотите создать?",
         reply_markup=get_report_type_keyboard()
     )
@@ -514,10 +4923,31 @@ async def process_report_type(callback: CallbackQuery, state: FSMContext):
     report_type = callback.data.split('_')[1]
     
     await state.update_data(report_type=report_type)
+    await state.set_state(ReportStates.waiting_for_format)
+    
+    await outbox.send_message(
+        callback.message.chat.id,
+        f"Выбран тип отчета: {report_type}\n\nВыберите формат выгрузки:",
+        reply_markup=get_format_keyboard()
+    )
+
+@dp.callback_query(F.data.startswith("format_"), ReportStates.waiting_for_format)
+async def process_report_format(callback: CallbackQuery, state: FSMContext):
+    """
+    Обработчик выбора формата выгрузки отчета.
+    Сохраняет выбранный формат и запрашивает период.
+    """
+    await callback.answer()
+    export_format = callback.data[len("format_"):]
+    if export_format not in get_available_exporters():
+        export_format = 'csv'
+    
+    await state.update_data(export_format=export_format)
     await state.set_state(ReportStates.waiting_for_period)
     
-    await callback.message.answer(
-        f"Выбран тип отчета: {report_type}\n\nВыберите период:",
+    await outbox.send_message(
+        callback.message.chat.id,
+        f"Выбран формат: {EXPORTERS[export_format]['label']}\n\nВыберите период:",
         reply_markup=get_period_keyboard()
     )
 
@@ -532,12 +4962,16 @@ async def process_report_period(callback: CallbackQuery, state: FSMContext):
     
     if period_type == 'custom':
         await state.set_state(ReportStates.waiting_for_date_range)
-        await callback.message.answer(
+        await outbox.send_message(
+            callback.message.chat.id,
             "Введите диапазон дат в формате YYYY-MM-DD - YYYY-MM-DD"
         )
     else:
         start_date, end_date = get_date_range(period_type)
-        await generate_report(callback.from_user.id, state, start_date, end_date, period_type)
+        job_executor.spawn(
+            callback.from_user.id,
+            generate_report(callback.from_user.id, state, start_date, end_date, period_type)
+        )
 
 @dp.message(ReportStates.waiting_for_date_range)
 async def process_report_date_range(message: Message, state: FSMContext):
@@ -554,9 +4988,13 @@ async def process_report_date_range(message: Message, state: FSMContext):
         datetime.datetime.strptime(start_date, "%Y-%m-%d")
         datetime.datetime.strptime(end_date, "%Y-%m-%d")
         
-        await generate_report(message.from_user.id, state, start_date, end_date, 'custom')
+        job_executor.spawn(
+            message.from_user.id,
+            generate_report(message.from_user.id, state, start_date, end_date, 'custom')
+        )
     except (ValueError, IndexError):
-        await message.answer(
+        await outbox.send_message(
+            message.chat.id,
             "Неверный формат дат. Пожалуйста, введите диапазон в формате YYYY-MM-DD - YYYY-MM-DD"
         )
 
@@ -571,124 +5009,77 @@ async def generate_report(user_id, state, start_date, end_date, period_type):
         end_date (str): Конечная дата в формате 'YYYY-MM-DD'
         period_type (str): Тип периода ('day', 'week', 'month', 'year', 'custom')
     """
-    period_names = {
-        'day': 'день',
-        'week': 'неделю',
-        'month': 'месяц',
-        'year': 'год',
-        'custom': f'период {start_date} - {end_date}'
-    }
-    
-    period_name = period_names[period_type]
+    period_name = get_period_name(period_type, start_date, end_date)
     
     data = await state.get_data()
     report_type = data.get('report_type')
+    export_format = data.get('export_format', 'csv')
+    composer = ResponseComposer(user_id)
     
-    try:
-        await send_message_with_retry(
-            user_id,
-            f"Генерирую отчет типа '{report_type}' за {period_name}..."
+    texts = REPORT_TEXTS.get(report_type)
+    if texts is None:
+        # Выбор пользователя потерян (например, состояние FSM очищено)
+        await composer.reply(
+            "Не удалось определить тип отчета. Начните заново: /report",
+            reply_markup=get_main_keyboard()
         )
+        await state.clear()
+        composer.finish()
+        return
+    
+    try:
+        await composer.status(f"Генерирую отчет типа '{report_type}' за {period_name}...")
         
-        if report_type == 'sales':
-            # Получаем данные о продажах
-            df = get_sales_data(start_date, end_date)
-            
-            if df.empty:
-                await send_message_with_retry(
-                    user_id,
-                    f"Нет данных о продажах за {period_name}."
-                )
-                await state.clear()
-                return
-            
-            # Генерируем график
-            chart_path = generate_sales_chart(df, period_name)
-            
-            # Отправляем график с повторными попытками
-            await send_photo_with_retry(
-                user_id,
-                FSInputFile(chart_path),
-                caption=f"График продаж за {period_name}"
-            )
-            
-            # Экспортируем в CSV
-            csv_filename = f"sales_report_{start_date}_to_{end_date}"
-            csv_path = export_to_csv(df, csv_filename)
-            
-            # Отправляем CSV файл с повторными попытками
-            await send_document_with_retry(
-                user_id,
-                FSInputFile(csv_path),
-                caption=f"Отчет о продажах за {period_name} в формате CSV"
-            )
-            
-            # Удаляем временные файлы
-            try:
-                os.remove(csv_path)
-                os.remove(chart_path)
-            except Exception as e:
-                logging.error(f"Ошибка при удалении временных файлов: {e}")
-            
-        elif report_type == 'activity':
-            # Получаем данные об активности пользователей
-            df = get_user_activity_data(start_date, end_date)
-            
-            if df.empty:
-                await send_message_with_retry(
-                    user_id,
-                    f"Нет данных об активности пользователей за {period_name}."
-                )
-                await state.clear()
-                return
-            
-            # Генерируем график
-            chart_path = generate_activity_chart(df, period_name)
-            
-            # Отправляем график с повторными попытками
-            await send_photo_with_retry(
-                user_id,
-                FSInputFile(chart_path),
-                caption=f"График активности пользователей за {period_name}"
-            )
-            
-            # Экспортируем в CSV
-            csv_filename = f"activity_report_{start_date}_to_{end_date}"
-            csv_path = export_to_csv(df, csv_filename)
-            
-            # Отправляем CSV файл с повторными попытками
-            await send_document_with_retry(
-                user_id,
-                FSInputFile(csv_path),
-                caption=f"Отчет об активности пользователей за {period_name} в формате CSV"
-            )
+        # Одинаковые одновременные отчеты загружают данные и строят выгрузку один раз
+        chart_df = await load_shared(REPORT_CHART_LOADERS[report_type], start_date, end_date)
+        # Для продаж данные графика и есть данные выгрузки; для активности детальные
+        # данные загружаются при выгрузке, только если нет готовой выгрузки и отчет небольшой
+        df = chart_df if report_type == 'sales' else None
+        
+        if chart_df.empty:
+            await composer.reply(texts['empty'].format(period=period_name), reply_markup=get_main_keyboard())
+        else:
+            # Генерируем и отправляем график (из кэша, если данные не изменились)
+            # одновременно с построением выгрузки
+            chart_sent = asyncio.ensure_future(composer.chart(
+                report_type,
+                chart_df,
+                period_name,
+                caption=texts['chart'].format(period=period_name)
+            ))
             
-            # Удаляем временные файлы
+            # Экспортируем в выбранном формате: готовая выгрузка, если она построена заранее,
+            # иначе из памяти или потоково из базы для больших отчетов. Буфер общий для
+            # одновременных одинаковых запросов и освобождается после отправки всем
+            export_key = ('export', report_type, start_date, end_date, export_format)
             try:
-                os.remove(csv_path)
-                os.remove(chart_path)
-            except Exception as e:
-                logging.error(f"Ошибка при удалении временных файлов: {e}")
+                async with request_flights.share(
+                    export_key, job_executor.run_io, get_report_export,
+                    report_type, start_date, end_date, export_format, df,
+                    release=SpillBuffer.discard
+                ) as export_buffer:
+                    await chart_sent
+                    
+                    # Отправляем файл отчета вместе с основной клавиатурой
+                    await composer.document(
+                        export_buffer.to_input_file(),
+                        caption=texts['document'].format(period=period_name, label=export_buffer.label),
+                        reply_markup=get_main_keyboard()
+                    )
+            finally:
+                if not chart_sent.done():
+                    chart_sent.cancel()
     
     except Exception as e:
         logging.error(f"Ошибка при генерации отчета: {e}")
         try:
-            await send_message_with_retry(
-                user_id,
-                f"Произошла ошибка при генерации отчета: {str(e)}"
-            )
+            # Сообщение об ошибке заменяет сообщение о загрузке
+            await composer.reply(f"Произошла ошибка при генерации отчета: {str(e)}")
         except Exception as send_error:
             logging.error(f"Не удалось отправить сообщение об ошибке: {send_error}")
     
     await state.clear()
-    try:
-        await send_message_with_retry(
-            user_id,
-            "Отчет сгенерирован успешно!",
-            reply_markup=get_main_keyboard()
-        )
-    except Exception as send_error:
-        logging.error(f"Не удалось отправить финальное сообщение: {send_error}")
+    composer.finish()
 
 @dp.message(Command("stats"))
 async def cmd_stats(message: Message, state: FSMContext):
@@ -697,10 +5088,12 @@ async def cmd_stats(message: Message, state: FSMContext):
     Инициирует процесс просмотра статистики.
     """
     user = message.from_user
+    job_executor.cancel_user_jobs(user.id)
     log_user_activity(user.id, 'stats')
     
     await state.set_state(StatsStates.waiting_for_stats_type)
-    await message.answer(
+    await outbox.send_message(
+        message.chat.id,
         "Какую статистику вы хотите посмотреть?",
         reply_markup=get_report_type_keyboard()
     )
@@ -717,7 +5110,8 @@ async def process_stats_type(callback: CallbackQuery, state: FSMContext):
     await state.update_data(stats_type=stats_type)
     await state.set_state(StatsStates.waiting_for_period)
     
-    await callback.message.answer(
+    await outbox.send_message(
+        callback.message.chat.id,
         f"Выбран тип статистики: {stats_type}\n\nВыберите период:",
         reply_markup=get_period_keyboard()
     )
@@ -733,330 +5127,1598 @@ async def process_stats_period(callback: CallbackQuery, state: FSMContext):
     
     if period_type == 'custom':
         await state.set_state(StatsStates.waiting_for_date_range)
-        await callback.message.answer(
+        await outbox.send_message(
+            callback.message.chat.id,
             "Введите диапазон дат в формате YYYY-MM-DD - YYYY-MM-DD"
         )
     else:
         start_date, end_date = get_date_range(period_type)
-        await show_statistics(callback.from_user.id, state, start_date, end_date, period_type)
+        job_executor.spawn(
+            callback.from_user.id,
+            show_statistics(callback.from_user.id, state, start_date, end_date, period_type)
+        )
+
+@dp.message(StatsStates.waiting_for_date_range)
+async def process_stats_date_range(message: Message, state: FSMContext):
+    """
+    Обработчик ввода диапазона дат для статистики.
+    Парсит введенный диапазон и показывает статистику.
+    """
+    try:
+        date_range = message.text.strip().split(' - ')
+        start_date = date_range[0].strip()
+        end_date = date_range[1].strip()
+        
+        # Проверяем корректность формата дат
+        datetime.datetime.strptime(start_date, "%Y-%m-%d")
+        datetime.datetime.strptime(end_date, "%Y-%m-%d")
+        
+        job_executor.spawn(
+            message.from_user.id,
+            show_statistics(message.from_user.id, state, start_date, end_date, 'custom')
+        )
+    except (ValueError, IndexError):
+        await outbox.send_message(
+            message.chat.id,
+            "Неверный формат дат. Пожалуйста, введите диапазон в формате YYYY-MM-DD - YYYY-MM-DD"
+        )
+
+async def prepare_sales_stats(start_date, end_date, period_name):
+    """
+    Загружает данные о продажах и считает по ним статистику.
+    Статистика за сегодня строится по счетчикам в памяти, без запросов к базе.
+    
+    Args:
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        period_name (str): Название периода
+        
+    Returns:
+        tuple: (DataFrame с данными о продажах, текст статистики или None, если данных нет)
+    """
+    if today_counters.available(start_date, end_date):
+        df = today_counters.sales_frame()
+        if df.empty:
+            return df, None
+        return df, render_sales_stats(today_counters.sales_summary(period_name))
+    
+    df = await load_shared(get_sales_data, start_date, end_date)
+    if df.empty:
+        return df, None
+    return df, await job_executor.run_cpu(build_sales_stats_text, df, period_name)
+
+async def prepare_activity_stats(start_date, end_date, period_name):
+    """
+    Считает статистику активности пользователей и загружает данные для графика.
+    Итоги считаются в базе; детальные строки по пользователям не загружаются.
+    
+    Args:
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        period_name (str): Название периода
+        
+    Returns:
+        tuple: (текст статистики, DataFrame для графика) или (None, None), если данных нет
+    """
+    if today_counters.available(start_date, end_date):
+        summary = await job_executor.run_io(today_counters.activity_summary, period_name)
+        if summary.total_actions == 0:
+            return None, None
+        return render_activity_stats(summary), today_counters.activity_chart_frame()
+    
+    summary = await job_executor.run_io(get_activity_summary, start_date, end_date, period_name)
+    if summary.total_actions == 0:
+        return None, None
+    chart_df = await load_shared(get_activity_chart_data, start_date, end_date)
+    return render_activity_stats(summary), chart_df
+
+async def show_statistics(user_id, state, start_date, end_date, period_type):
+    """
+    Показывает статистику на основе выбранных параметров.
+    
+    Args:
+        user_id (int): ID пользователя в Telegram
+        state (FSMContext): Контекст состояния FSM
+        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
+        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
+        period_type (str): Тип периода ('day', 'week', 'month', 'year', 'custom')
+    """
+    period_name = get_period_name(period_type, start_date, end_date)
+    
+    data = await state.get_data()
+    stats_type = data.get('stats_type')
+    composer = ResponseComposer(user_id)
+    
+    if stats_type not in ('sales', 'activity'):
+        # Выбор пользователя потерян (например, состояние FSM очищено)
+        await composer.reply(
+            "Не удалось определить тип статистики. Начните заново: /stats",
+            reply_markup=get_main_keyboard()
+        )
+        await state.clear()
+        composer.finish()
+        return
+    
+    try:
+        await composer.status(f"Загружаю статистику типа '{stats_type}' за {period_name}...")
+        
+        # Одинаковые одновременные запросы статистики считают ее один раз
+        key = ('stats', stats_type, start_date, end_date, period_name)
+        
+        if stats_type == 'sales':
+            df, stats_text = await request_flights.do(key, prepare_sales_stats, start_date, end_date, period_name)
+            
+            if df.empty:
+                await composer.reply(f"Нет данных о продажах за {period_name}.", reply_markup=get_main_keyboard())
+            else:
+                # Текст статистики и график уходят одним сообщением, если текст помещается в подпись
+                await composer.chart(
+                    'sales',
+                    df,
+                    period_name,
+                    caption=f"График продаж за {period_name}",
+                    text=stats_text,
+                    reply_markup=get_main_keyboard()
+                )
+            
+        elif stats_type == 'activity':
+            stats_text, chart_df = await request_flights.do(
+                key, prepare_activity_stats, start_date, end_date, period_name
+            )
+            
+            if stats_text is None:
+                await composer.reply(f"Нет данных об активности пользователей за {period_name}.", reply_markup=get_main_keyboard())
+            else:
+                # Текст статистики и график уходят одним сообщением, если текст помещается в подпись
+                await composer.chart(
+                    'activity',
+                    chart_df,
+                    period_name,
+                    caption=f"График активности пользователей за {period_name}",
+                    text=stats_text,
+                    reply_markup=get_main_keyboard()
+                )
+    
+    except Exception as e:
+        logging.error(f"Ошибка при показе статистики: {e}")
+        try:
+            # Сообщение об ошибке заменяет сообщение о загрузке
+            await composer.reply(f"Произошла ошибка при загрузке статистики: {str(e)}")
+        except Exception as send_error:
+            logging.error(f"Не удалось отправить сообщение об ошибке: {send_error}")
+    
+    await state.clear()
+    composer.finish()
+
+# Правила подписок: по какой дате период считается завершенным и отчет пора отправлять
+SUBSCRIPTION_DUE = {
+    'day': lambda today: True,
+    'week': lambda today: today.weekday() == 0,
+    'month': lambda today: today.day == 1,
+    'year': lambda today: today.month == 1 and today.day == 1,
+}
+
+def add_subscription(user_id, report_type, period_type, export_format='csv'):
+    """
+    Подписывает пользователя на регулярную доставку отчета.
+    Повторная подписка на тот же отчет и период меняет формат выгрузки.
+    
+    Args:
+        user_id (int): ID пользователя в Telegram
+        report_type (str): Тип отчета ('sales' или 'activity')
+        period_type (str): Период ('day', 'week', 'month', 'year')
+        export_format (str): Имя формата из EXPORTERS
+    """
+    with db_pool.writer() as conn:
+        conn.execute(
+            '''
+            INSERT INTO subscriptions (user_id, report_type, period_type, export_format, created_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (user_id, report_type, period_type) DO UPDATE SET
+                export_format = excluded.export_format
+            ''',
+            (user_id, report_type, period_type, export_format,
+             datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        )
+
+def remove_subscriptions(user_id, report_type=None, period_type=None):
+    """
+    Отменяет подписки пользователя: все или только на указанный отчет и период.
+    
+    Args:
+        user_id (int): ID пользователя в Telegram
+        report_type (str, optional): Тип отчета
+        period_type (str, optional): Период
+        
+    Returns:
+        int: Количество отмененных подписок
+    """
+    query = "DELETE FROM subscriptions WHERE user_id = ?"
+    params = [user_id]
+    if report_type is not None:
+        query += " AND report_type = ?"
+        params.append(report_type)
+    if period_type is not None:
+        query += " AND period_type = ?"
+        params.append(period_type)
+    
+    with db_pool.writer() as conn:
+        return conn.execute(query, params).rowcount
+
+def get_user_subscriptions(user_id):
+    """
+    Возвращает подписки пользователя.
+    
+    Args:
+        user_id (int): ID пользователя в Telegram
+        
+    Returns:
+        list: Список кортежей (тип отчета, период, формат выгрузки)
+    """
+    with db_pool.reader() as conn:
+        return conn.execute(
+            "SELECT report_type, period_type, export_format FROM subscriptions WHERE user_id = ? ORDER BY report_type, period_type",
+            (user_id,)
+        ).fetchall()
+
+def get_due_subscriptions(today):
+    """
+    Возвращает подписки, отчеты по которым нужно отправить в указанную дату.
+    
+    Args:
+        today (datetime.date): Дата доставки
+        
+    Returns:
+        list: Список кортежей (ID пользователя, тип отчета, период, формат выгрузки)
+    """
+    periods = [period_type for period_type, is_due in SUBSCRIPTION_DUE.items() if is_due(today)]
+    placeholders = ', '.join('?' * len(periods))
+    with db_pool.reader() as conn:
+        return conn.execute(
+            f"SELECT user_id, report_type, period_type, export_format FROM subscriptions "
+            f"WHERE period_type IN ({placeholders}) ORDER BY report_type, period_type, export_format",
+            periods
+        ).fetchall()
+
+def format_subscriptions(subscriptions=None):
+    """
+    Формирует текст со списком подписок и подсказкой по командам.
+    
+    Args:
+        subscriptions (list, optional): Список кортежей (тип отчета, период, формат выгрузки);
+            если не передан, выводится только подсказка
+        
+    Returns:
+        str: Текст сообщения
+    """
+    lines = []
+    if subscriptions:
+        lines.append("Ваши подписки:")
+        for report_type, period_type, export_format in subscriptions:
+            label = EXPORTERS[export_format]['label'] if export_format in EXPORTERS else export_format
+            lines.append(f"• {report_type} {period_type} ({label})")
+        lines.append("")
+    elif subscriptions is not None:
+        lines.append("У вас нет подписок.")
+        lines.append("")
+    
+    lines.append("Подписаться: /subscribe <sales|activity> <day|week|month|year> [формат]")
+    lines.append(f"Форматы: {', '.join(get_available_exporters())}")
+    lines.append("Отменить: /unsubscribe [sales|activity] [day|week|month|year]")
+    lines.append(
+        f"Отчет за завершившийся период приходит в {DELIVERY_HOUR:02d}:00: ежедневный - каждый день, "
+        "недельный - по понедельникам, месячный - 1-го числа, годовой - 1 января."
+    )
+    return "\n".join(lines)
+
+@dp.message(Command("subscribe"))
+async def cmd_subscribe(message: Message, command: CommandObject):
+    """
+    Обработчик команды /subscribe.
+    Без аргументов показывает подписки пользователя, с аргументами - оформляет подписку.
+    """
+    user = message.from_user
+    log_user_activity(user.id, 'subscribe')
+    args = (command.args or '').lower().split()
+    
+    if len(args) < 2:
+        subscriptions = await job_executor.run_io(get_user_subscriptions, user.id)
+        await outbox.send_message(message.chat.id, format_subscriptions(subscriptions))
+        return
+    
+    report_type, period_type = args[0], args[1]
+    export_format = args[2] if len(args) > 2 else 'csv'
+    if report_type not in REPORT_TEXTS or period_type not in SUBSCRIPTION_DUE \
+            or export_format not in get_available_exporters():
+        await outbox.send_message(message.chat.id, "Неверные параметры подписки.\n\n" + format_subscriptions())
+        return
+    
+    await job_executor.run_io(add_subscription, user.id, report_type, period_type, export_format)
+    await outbox.send_message(
+        message.chat.id,
+        f"Подписка оформлена: отчет {report_type} за {PERIOD_NAMES[period_type]} "
+        f"в формате {EXPORTERS[export_format]['label']}.",
+        reply_markup=get_main_keyboard()
+    )
+
+@dp.message(Command("unsubscribe"))
+async def cmd_unsubscribe(message: Message, command: CommandObject):
+    """
+    Обработчик команды /unsubscribe.
+    Без аргументов отменяет все подписки пользователя, с аргументами - только указанные.
+    """
+    user = message.from_user
+    log_user_activity(user.id, 'unsubscribe')
+    args = (command.args or '').lower().split()
+    report_type = args[0] if len(args) > 0 else None
+    period_type = args[1] if len(args) > 1 else None
+    
+    removed = await job_executor.run_io(remove_subscriptions, user.id, report_type, period_type)
+    await outbox.send_message(
+        message.chat.id,
+        f"Отменено подписок: {removed}." if removed else "Подходящих подписок не найдено.",
+        reply_markup=get_main_keyboard()
+    )
 
-@dp.message(StatsStates.waiting_for_date_range)
-async def process_stats_date_range(message: Message, state: FSMContext):
+# Настройки очереди исходящих запросов к Telegram
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+OUTBOX_WORKERS = int(os.getenv('OUTBOX_WORKERS', '8'))
+OUTBOX_MAX_RETRIES = int(os.getenv('OUTBOX_MAX_RETRIES', '5'))
+
+# Приоритеты очереди: ответы пользователю раньше массовых отправок документов
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+# Ошибки, после которых имеет смысл повторить запрос
+RETRYABLE_ERRORS = (TelegramNetworkError, TelegramServerError, aiohttp.ClientError, asyncio.TimeoutError)
+
+# Ограничитель частоты запросов
+class TokenBucket:
     """
-    Обработчик ввода диапазона дат для статистики.
-    Парсит введенный диапазон и показывает статистику.
+    Маркерная корзина: пополняется со скоростью rate маркеров в секунду,
+    вмещает не более capacity маркеров.
     """
-    try:
-        date_range = message.text.strip().split(' - ')
-        start_date = date_range[0].strip()
-        end_date = date_range[1].strip()
-        
-        # Проверяем корректность формата дат
-        datetime.datetime.strptime(start_date, "%Y-%m-%d")
-        datetime.datetime.strptime(end_date, "%Y-%m-%d")
+    
+    def __init__(self, rate, capacity):
+        """
+        Args:
+            rate (float): Скорость пополнения в маркерах в секунду
+            capacity (int): Вместимость корзины
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    @property
+    def idle(self):
+        self._refill()
+        return self.tokens >= self.capacity
+    
+    def reserve(self):
+        """
+        Забирает один маркер, если он есть.
         
-        await show_statistics(message.from_user.id, state, start_date, end_date, 'custom')
-    except (ValueError, IndexError):
-        await message.answer(
-            "Неверный формат дат. Пожалуйста, введите диапазон в формате YYYY-MM-DD - YYYY-MM-DD"
-        )
+        Returns:
+            float: 0, если маркер получен, иначе время до появления маркера в секундах
+        """
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+    
+    async def acquire(self):
+        """
+        Ожидает и забирает один маркер.
+        """
+        while True:
+            wait = self.reserve()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
 
-async def show_statistics(user_id, state, start_date, end_date, period_type):
+# Центральная очередь исходящих запросов к Telegram
+class TelegramOutbox:
     """
-    Показывает статистику на основе выбранных параметров.
+    Единая очередь отправки сообщений, фото и документов.
     
-    Args:
-        user_id (int): ID пользователя в Telegram
-        state (FSMContext): Контекст состояния FSM
-        start_date (str): Начальная дата в формате 'YYYY-MM-DD'
-        end_date (str): Конечная дата в формате 'YYYY-MM-DD'
-        period_type (str): Тип периода ('day', 'week', 'month', 'year', 'custom')
+    Запросы выполняются пулом обработчиков в порядке приоритета с соблюдением
+    общего лимита и лимита на чат (маркерные корзины). В один чат запросы
+    отправляются по одному и по порядку: пока запрос чата выполняется или ждет
+    маркер, следующие запросы этого чата ждут в его очереди, не занимая
+    обработчики, которые тем временем отправляют в другие чаты. При TelegramRetryAfter
+    приостанавливается вся очередь, а не отдельная корутина; сетевые ошибки
+    повторяются с экспоненциальной задержкой и случайным разбросом.
     """
-    period_names = {
-        'day': 'день',
-        'week': 'неделю',
-        'month': 'месяц',
-        'year': 'год',
-        'custom': f'период {start_date} - {end_date}'
-    }
     
-    period_name = period_names[period_type]
+    def __init__(self, workers=OUTBOX_WORKERS, global_rate=TELEGRAM_GLOBAL_RATE,
+                 chat_rate=TELEGRAM_CHAT_RATE, chat_burst=TELEGRAM_CHAT_BURST,
+                 max_retries=OUTBOX_MAX_RETRIES):
+        """
+        Args:
+            workers (int): Количество обработчиков очереди
+            global_rate (float): Общий лимит запросов в секунду
+            chat_rate (float): Лимит запросов в секунду на один чат
+            chat_burst (int): Допустимая пачка запросов в один чат
+            max_retries (int): Количество попыток по умолчанию
+        """
+        self.workers = workers
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._queue = None
+        self._tasks = []
+        self._global_bucket = None
+        self._chat_buckets = {}
+        # Запросы чатов, в которые идет отправка: первый выполняется, остальные ждут
+        self._chat_jobs = {}
+        self._resume_event = None
+        self._paused_until = 0.0
+        self._sequence = 0
+        
+        # Метрики
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self.flood_pauses = 0
+        self.total_latency = 0.0
     
-    data = await state.get_data()
-    stats_type = data.get('stats_type')
+    @property
+    def running(self):
+        return bool(self._tasks)
     
-    try:
-        await send_message_with_retry(
-            user_id,
-            f"Загружаю статистику типа '{stats_type}' за {period_name}..."
-        )
+    def start(self):
+        """
+        Запускает обработчики очереди в текущем цикле событий.
+        """
+        if self.running:
+            return
+        self._queue = asyncio.PriorityQueue()
+        self._global_bucket = TokenBucket(self.global_rate, max(1, int(self.global_rate)))
+        self._resume_event = asyncio.Event()
+        self._resume_event.set()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        """
+        Останавливает обработчики; неотправленные запросы отменяются.
+        """
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
         
-        if stats_type == 'sales':
-            # Получаем данные о продажах
-            df = get_sales_data(start_date, end_date)
-            
-            if df.empty:
-                await send_message_with_retry(
-                    user_id,
-                    f"Нет данных о продажах за {period_name}."
-                )
-                await state.clear()
-                return
-            
-            # Анализируем данные
-            total_sales = df['total_amount'].sum()
-            product_sales = df.groupby('product_name')['total_amount'].sum().sort_values(ascending=False)
-            
-            # Формируем текстовый отчет
-            stats_text = f"📊 Статистика продаж за {period_name}:\n\n"
-            stats_text += f"📈 Общая сумма продаж: {total_sales:.2f} грн\n\n"
-            stats_text += "🏆 Продажи по товарам:\n"
+        pending = [job for jobs in self._chat_jobs.values() for job in jobs]
+        self._chat_jobs = {}
+        while self._queue is not None and not self._queue.empty():
+            pending.append(self._queue.get_nowait()[2])
+        for job in pending:
+            if not job['future'].done():
+                job['future'].cancel()
+        
+        logging.info(f"Очередь отправки остановлена: {self.metrics()}")
+    
+    async def submit(self, chat_id, call, priority=PRIORITY_INTERACTIVE, max_retries=None):
+        """
+        Ставит запрос в очередь и ожидает его результата.
+        
+        Args:
+            chat_id (int): ID чата назначения
+            call (callable): Функция без аргументов, возвращающая корутину запроса к Bot API
+            priority (int): Приоритет (PRIORITY_INTERACTIVE или PRIORITY_BULK)
+            max_retries (int, optional): Максимальное количество попыток
             
-            for product, amount in product_sales.items():
-                stats_text += f"- {product}: {amount:.2f} грн ({(amount/total_sales*100):.1f}%)\n"
+        Returns:
+            Результат запроса (обычно Message)
+        """
+        self.start()
+        job = {
+            'chat_id': chat_id,
+            'call': call,
+            'priority': priority,
+            'attempt': 0,
+            'max_retries': max_retries or self.max_retries,
+            'delay': 1.0,
+            'created': time.monotonic(),
+            'future': asyncio.get_running_loop().create_future(),
+        }
+        self._enqueue(job)
+        return await job['future']
+    
+    def _enqueue(self, job):
+        self._sequence += 1
+        self._queue.put_nowait((job['priority'], self._sequence, job))
+    
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # Периодически убираем корзины чатов, в которые давно ничего не отправлялось
+            if len(self._chat_buckets) > 10000:
+                for idle_chat in [c for c, b in self._chat_buckets.items() if b.idle and c not in self._chat_jobs]:
+                    del self._chat_buckets[idle_chat]
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+    
+    def _next_in_chat(self, chat_id):
+        # Запрос чата завершен: в очередь ставится следующий запрос этого чата
+        jobs = self._chat_jobs[chat_id]
+        jobs.popleft()
+        if jobs:
+            self._enqueue(jobs[0])
+        else:
+            del self._chat_jobs[chat_id]
+    
+    def _pause(self, seconds):
+        loop = asyncio.get_running_loop()
+        until = loop.time() + seconds
+        if until <= self._paused_until:
+            return
+        self._paused_until = until
+        self.flood_pauses += 1
+        self._resume_event.clear()
+        loop.call_at(until, self._resume, until)
+    
+    def _resume(self, until):
+        if until == self._paused_until:
+            self._resume_event.set()
+    
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            _, _, job = await self._queue.get()
+            chat_id = job['chat_id']
+            jobs = self._chat_jobs.get(chat_id)
+            if jobs is None:
+                self._chat_jobs[chat_id] = deque([job])
+            elif jobs[0] is not job:
+                # В чат уже идет отправка: запрос ждет своей очереди, не занимая обработчик
+                jobs.append(job)
+                continue
             
-            await send_message_with_retry(user_id, stats_text)
+            future = job['future']
+            if future.done():
+                self._next_in_chat(chat_id)
+                continue
             
-            # Генерируем график
-            chart_path = generate_sales_chart(df, period_name)
+            # Маркер чата резервируется до ожидания общего лимита; если его нет,
+            # запрос возвращается в очередь, когда маркер появится
+            wait = self._chat_bucket(chat_id).reserve()
+            if wait:
+                loop.call_later(wait, self._enqueue, job)
+                continue
             
-            # Отправляем график с повторными попытками
-            await send_photo_with_retry(
-                user_id,
-                FSInputFile(chart_path),
-                caption=f"График продаж за {period_name}"
-            )
+            await self._resume_event.wait()
+            await self._global_bucket.acquire()
+            await self._resume_event.wait()
             
-            # Удаляем временный файл
+            job['attempt'] += 1
             try:
-                os.remove(chart_path)
+                result = await job['call']()
+            except TelegramRetryAfter as e:
+                # Флуд-контроль касается всего бота: приостанавливаем всю очередь
+                logging.warning(f"Telegram просит подождать {e.retry_after} секунд. Очередь отправки приостановлена")
+                self._pause(e.retry_after)
+                self._retry(job, e, delay=0)
+            except RETRYABLE_ERRORS as e:
+                logging.error(f"Ошибка соединения при отправке (попытка {job['attempt']}/{job['max_retries']}): {e}")
+                self._retry(job, e, delay=job['delay'] * random.uniform(0.5, 1.5))
+                job['delay'] *= 2  # Экспоненциальное увеличение задержки
             except Exception as e:
-                logging.error(f"Ошибка при удалении временного файла: {e}")
-            
-        elif stats_type == 'activity':
-            # Получаем данные об активности пользователей
-            df = get_user_activity_data(start_date, end_date)
-            
-            if df.empty:
-                await send_message_with_retry(
-                    user_id,
-                    f"Нет данных об активности пользователей за {period_name}."
-                )
-                await state.clear()
-                return
+                logging.error(f"Ошибка при отправке в чат {chat_id}: {e}")
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+                self._next_in_chat(chat_id)
+            else:
+                self.sent += 1
+                self.total_latency += time.monotonic() - job['created']
+                if not future.done():
+                    future.set_result(result)
+                self._next_in_chat(chat_id)
+    
+    def _retry(self, job, error, delay):
+        # Повторяемый запрос остается первым в очереди своего чата
+        future = job['future']
+        if job['attempt'] >= job['max_retries']:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(error)
+            self._next_in_chat(job['chat_id'])
+            return
+        
+        self.retries += 1
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self._enqueue, job)
+        else:
+            self._enqueue(job)
+    
+    async def send_message(self, chat_id, text, reply_markup=None, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """
+        Отправляет сообщение через очередь.
+        
+        Args:
+            chat_id (int): ID чата назначения
+            text (str): Текст сообщения
+            reply_markup: Опциональная клавиатура
+            priority (int): Приоритет отправки
             
-            # Анализируем данные
-            total_actions = df['action_count'].sum()
-            action_types = df.groupby('action_type')['action_count'].sum().sort_values(ascending=False)
-            active_users = df.groupby('username')['action_count'].sum().sort_values(ascending=False).head(5)
+        Returns:
+            Message: Отправленное сообщение
+        """
+        call = functools.partial(bot.send_message, chat_id, text, reply_markup=reply_markup)
+        return await self.submit(chat_id, call, priority, **kwargs)
+    
+    async def send_photo(self, chat_id, photo, caption=None, reply_markup=None, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """
+        Отправляет фото через очередь.
+        
+        Args:
+            chat_id (int): ID чата назначения
+            photo: Файл или ID фото
+            caption (str): Подпись к фото
+            reply_markup: Опциональная клавиатура
+            priority (int): Приоритет отправки
             
-            # Формируем текстовый отчет
-            stats_text = f"📊 Статистика активности за {period_name}:\n\n"
-            stats_text += f"📈 Общее количество действий: {total_actions}\n\n"
-            stats_text += "🔍 Распределение по типам действий:\n"
+        Returns:
+            Message: Отправленное сообщение
+        """
+        call = functools.partial(bot.send_photo, chat_id, photo, caption=caption, reply_markup=reply_markup)
+        return await self.submit(chat_id, call, priority, **kwargs)
+    
+    async def send_document(self, chat_id, document, caption=None, reply_markup=None, priority=PRIORITY_BULK, **kwargs):
+        """
+        Отправляет документ через очередь (по умолчанию с низким приоритетом).
+        
+        Args:
+            chat_id (int): ID чата назначения
+            document: Файл или ID документа
+            caption (str): Подпись к документу
+            reply_markup: Опциональная клавиатура
+            priority (int): Приоритет отправки
             
-            for action, count in action_types.items():
-                stats_text += f"- {action}: {count} ({(count/total_actions*100):.1f}%)\n"
+        Returns:
+            Message: Отправленное сообщение
+        """
+        call = functools.partial(bot.send_document, chat_id, document, caption=caption, reply_markup=reply_markup)
+        return await self.submit(chat_id, call, priority, **kwargs)
+    
+    async def edit_message_text(self, chat_id, message_id, text, priority=PRIORITY_INTERACTIVE, **kwargs):
+        """
+        Редактирует текст ранее отправленного сообщения через очередь.
+        
+        Args:
+            chat_id (int): ID чата
+            message_id (int): ID редактируемого сообщения
+            text (str): Новый текст сообщения
+            priority (int): Приоритет отправки
             
-            stats_text += "\n👥 Самые активные пользователи:\n"
+        Returns:
+            Message: Отредактированное сообщение
+        """
+        call = functools.partial(bot.edit_message_text, text, chat_id=chat_id, message_id=message_id)
+        return await self.submit(chat_id, call, priority, **kwargs)
+    
+    def metrics(self):
+        """
+        Возвращает метрики очереди отправки.
+        
+        Returns:
+            dict: Глубина очереди, количество отправок, ошибок, повторов и пауз
+        """
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retries': self.retries,
+            'flood_pauses': self.flood_pauses,
+            'avg_latency_ms': round(self.total_latency / self.sent * 1000, 1) if self.sent else 0.0,
+        }
+
+outbox = TelegramOutbox()
+
+# Максимальная длина подписи к фото или документу (в единицах UTF-16)
+TELEGRAM_CAPTION_LIMIT = 1024
+
+def telegram_length(text):
+    """
+    Возвращает длину текста так, как ее считает Telegram (в единицах UTF-16).
+    
+    Args:
+        text (str): Текст
+        
+    Returns:
+        int: Длина текста
+    """
+    return len(text.encode('utf-16-le')) // 2
+
+# Сборщик ответа пользователю
+class ResponseComposer:
+    """
+    Собирает ответ на одну команду в минимальное число запросов к Bot API.
+    
+    Сообщение о загрузке отправляется один раз и затем редактируется на месте
+    (итоговым текстом или сообщением об ошибке), короткий текст статистики
+    становится подписью к графику, а клавиатура прикрепляется к последнему
+    фото или документу вместо отдельного сообщения "готово".
+    """
+    
+    def __init__(self, chat_id):
+        """
+        Args:
+            chat_id (int): ID чата назначения
+        """
+        self.chat_id = chat_id
+        self.status_message = None
+        self.status_text = None
+        self.calls = 0
+        self.started = time.monotonic()
+    
+    async def status(self, text):
+        """
+        Показывает промежуточное состояние: первое сообщение отправляется,
+        последующие заменяют его текст.
+        
+        Args:
+            text (str): Текст состояния
+        """
+        await self.reply(text)
+    
+    async def reply(self, text, reply_markup=None):
+        """
+        Отправляет текстовый ответ, по возможности редактируя сообщение о загрузке.
+        
+        Args:
+            text (str): Текст ответа
+            reply_markup: Опциональная клавиатура (редактирование ее не поддерживает,
+                поэтому с клавиатурой всегда отправляется новое сообщение)
             
-            for user, count in active_users.items():
-                stats_text += f"- {user}: {count} действий\n"
+        Returns:
+            Message: Отправленное или отредактированное сообщение
+        """
+        if self.status_message is not None and reply_markup is None:
+            if text == self.status_text:
+                return self.status_message
+            try:
+                self.calls += 1
+                message = await outbox.edit_message_text(self.chat_id, self.status_message.message_id, text)
+                self.status_text = text
+                return message
+            except Exception as e:
+                logging.warning(f"Не удалось отредактировать сообщение, отправляем новое: {e}")
+        
+        self.calls += 1
+        message = await outbox.send_message(self.chat_id, text, reply_markup=reply_markup)
+        if reply_markup is None:
+            self.status_message = message
+            self.status_text = text
+        return message
+    
+    async def chart(self, kind, df, period_name, caption, text=None, reply_markup=None):
+        """
+        Отправляет график. Текст, помещающийся в подпись, отправляется вместе с ним,
+        иначе он заменяет сообщение о загрузке.
+        
+        Args:
+            kind (str): Вид графика ('sales' или 'activity')
+            df (pandas.DataFrame): Данные графика
+            period_name (str): Название периода для заголовка графика
+            caption (str): Подпись к графику
+            text (str, optional): Текст, который нужно показать вместе с графиком
+            reply_markup: Опциональная клавиатура
             
-            await send_message_with_retry(user_id, stats_text)
+        Returns:
+            Message: Отправленное сообщение
+        """
+        if text is not None:
+            combined = f"{text}\n{caption}"
+            if telegram_length(combined) <= TELEGRAM_CAPTION_LIMIT:
+                caption = combined
+            else:
+                await self.reply(text)
+        
+        self.calls += 1
+        return await send_chart(self.chat_id, kind, df, period_name, caption, reply_markup=reply_markup)
+    
+    async def document(self, document, caption, reply_markup=None):
+        """
+        Отправляет документ.
+        
+        Args:
+            document: Файл или ID документа
+            caption (str): Подпись к документу
+            reply_markup: Опциональная клавиатура
             
-            # Генерируем график
-            chart_path = generate_activity_chart(df, period_name)
+        Returns:
+            Message: Отправленное сообщение
+        """
+        self.calls += 1
+        return await outbox.send_document(self.chat_id, document, caption=caption, reply_markup=reply_markup)
+    
+    def finish(self):
+        """
+        Записывает в журнал количество запросов к API и время ответа.
+        """
+        elapsed_ms = (time.monotonic() - self.started) * 1000
+        logging.info(f"Ответ в чат {self.chat_id}: {self.calls} запросов к API за {elapsed_ms:.0f} мс")
+
+# Настройки планировщика отчетов (часы по местному времени сервера)
+PRECOMPUTE_HOUR = int(os.getenv('PRECOMPUTE_HOUR', '4'))
+PRECOMPUTE_WINDOW_HOURS = int(os.getenv('PRECOMPUTE_WINDOW_HOURS', '3'))
+PRECOMPUTE_FORMATS = tuple(name for name in os.getenv('PRECOMPUTE_FORMATS', 'csv').split(',') if name)
+DELIVERY_HOUR = int(os.getenv('DELIVERY_HOUR', '8'))
+DELIVERY_BATCH = int(os.getenv('DELIVERY_BATCH', '100'))
+SCHEDULER_TICK_SECONDS = float(os.getenv('SCHEDULER_TICK_SECONDS', '60'))
+
+# Планировщик отчетов
+class ReportScheduler:
+    """
+    Выполняет ежедневные задания отчетов:
+    
+    - precompute: в часы низкой нагрузки заранее рассчитывает отчеты за текущие
+      и только что завершившиеся стандартные периоды - загружает данные в кэш
+      запросов, отрисовывает графики в кэш графиков и сохраняет готовые выгрузки
+      в базе данных;
+    - delivery: рассылает отчеты подписчикам через очередь исходящих запросов
+      с низким приоритетом, загружая каждый график и файл в Telegram один раз;
+    - retention: в то же окно низкой нагрузки сжимает секции журнала активности
+      старше срока хранения.
+    
+    Отметка о запуске задания за дату ставится в базе данных, поэтому при
+    нескольких процессах каждое задание выполняет только один из них. Если
+    задание завершилось ошибкой, отметка снимается и задание повторяется.
+    """
+    
+    def __init__(self, clock=None, precompute_hour=PRECOMPUTE_HOUR, precompute_window=PRECOMPUTE_WINDOW_HOURS,
+                 delivery_hour=DELIVERY_HOUR, export_formats=PRECOMPUTE_FORMATS, tick_seconds=SCHEDULER_TICK_SECONDS):
+        """
+        Args:
+            clock (callable, optional): Функция текущего времени (по умолчанию datetime.datetime.now)
+            precompute_hour (int): Час начала предварительного расчета
+            precompute_window (int): Длительность окна предварительного расчета в часах
+            delivery_hour (int): Час рассылки подписчикам
+            export_formats (tuple): Форматы выгрузки, которые строятся заранее
+            tick_seconds (float): Интервал проверки заданий в секундах
+        """
+        self.clock = clock or datetime.datetime.now
+        self.precompute_hour = precompute_hour
+        self.precompute_window = precompute_window
+        self.delivery_hour = delivery_hour
+        self.export_formats = export_formats
+        self.tick_seconds = tick_seconds
+        self._task = None
+        self.last_runs = {}
+        self.precomputed = 0
+        self.artifacts = 0
+        self.compacted = 0
+        self.delivered = 0
+        self.failed = 0
+    
+    @staticmethod
+    def _claim(job, date):
+        """
+        Отмечает запуск задания за дату.
+        
+        Args:
+            job (str): Имя задания
+            date (str): Дата в формате 'YYYY-MM-DD'
             
-            # Отправляем график с повторными попытками
-            await send_photo_with_retry(
-                user_id,
-                FSInputFile(chart_path),
-                caption=f"График активности пользователей за {period_name}"
+        Returns:
+            bool: True, если за эту дату задание еще не запускалось
+        """
+        with db_pool.writer() as conn:
+            cursor = conn.execute(
+                '''
+                INSERT INTO scheduler_runs (job, last_run) VALUES (?, ?)
+                ON CONFLICT (job) DO UPDATE SET last_run = excluded.last_run
+                WHERE last_run < excluded.last_run
+                ''',
+                (job, date)
             )
+            return cursor.rowcount > 0
+    
+    @staticmethod
+    def _release(job, date):
+        """
+        Снимает отметку о запуске задания за дату, чтобы задание выполнилось
+        при следующей проверке.
+        
+        Args:
+            job (str): Имя задания
+            date (str): Дата в формате 'YYYY-MM-DD'
+        """
+        with db_pool.writer() as conn:
+            conn.execute("DELETE FROM scheduler_runs WHERE job = ? AND last_run = ?", (job, date))
+    
+    def _is_due(self, job, now):
+        if job in ('precompute', 'retention'):
+            return self.precompute_hour <= now.hour < self.precompute_hour + self.precompute_window
+        # Пропущенная рассылка выполняется при первой возможности в тот же день
+        return now.hour >= self.delivery_hour
+    
+    async def tick(self):
+        """
+        Выполняет задания, время которых наступило и которые сегодня еще не выполнялись.
+        
+        Returns:
+            list: Имена выполненных заданий
+        """
+        now = self.clock()
+        today = now.date()
+        ran = []
+        for job, run in (('precompute', self.precompute), ('retention', self.retention), ('delivery', self.deliver)):
+            if not self._is_due(job, now):
+                continue
+            date = today.strftime("%Y-%m-%d")
+            if not await job_executor.run_io(self._claim, job, date):
+                continue
             
-            # Удаляем временный файл
+            started = time.monotonic()
             try:
-                os.remove(chart_path)
+                await run(today)
             except Exception as e:
-                logging.error(f"Ошибка при удалении временного файла: {e}")
+                # Задание не выполнено: отметка снимается, и оно повторится при следующей проверке
+                await job_executor.run_io(self._release, job, date)
+                logging.error(f"Ошибка в задании планировщика {job}: {e}")
+                continue
+            self.last_runs[job] = date
+            logging.info(f"Задание планировщика {job} выполнено за {time.monotonic() - started:.1f} с")
+            ran.append(job)
+        return ran
     
-    except Exception as e:
-        logging.error(f"Ошибка при показе статистики: {e}")
-        try:
-            await send_message_with_retry(
-                user_id,
-                f"Произошла ошибка при загрузке статистики: {str(e)}"
-            )
-        except Exception as send_error:
-            logging.error(f"Не удалось отправить сообщение об ошибке: {send_error}")
+    async def precompute(self, today):
+        """
+        Заранее рассчитывает отчеты за текущие и только что завершившиеся периоды.
+        
+        Args:
+            today (datetime.date): Текущая дата
+        """
+        await job_executor.run_io(prune_report_artifacts)
+        
+        # Завершившиеся периоды нужны для рассылки, текущие - для запросов пользователей
+        yesterday = today - datetime.timedelta(days=1)
+        periods = {}
+        for period_type in SUBSCRIPTION_DUE:
+            start_date, end_date = get_date_range(period_type, yesterday)
+            periods[(start_date, end_date)] = get_period_name('custom', start_date, end_date)
+        for period_type in SUBSCRIPTION_DUE:
+            start_date, end_date = get_date_range(period_type, today)
+            periods.setdefault((start_date, end_date), get_period_name(period_type, start_date, end_date))
+        
+        for report_type in REPORT_TEXTS:
+            for (start_date, end_date), period_name in periods.items():
+                try:
+                    await self._precompute_report(report_type, start_date, end_date, period_name)
+                except Exception as e:
+                    logging.error(f"Ошибка при предварительном расчете отчета {report_type} {start_date} - {end_date}: {e}")
     
-    await state.clear()
-    try:
-        await send_message_with_retry(
-            user_id,
-            "Статистика загружена успешно!",
-            reply_markup=get_main_keyboard()
-        )
-    except Exception as send_error:
-        logging.error(f"Не удалось отправить финальное сообщение: {send_error}")
-
-# Вспомогательная функция для отправки сообщений с повторными попытками
-async def send_message_with_retry(chat_id, text, reply_markup=None, max_retries=5, initial_delay=1):
-    """
-    Отправляет сообщение с механизмом повторных попыток в случае ошибок соединения.
+    async def _precompute_report(self, report_type, start_date, end_date, period_name):
+        chart_df = await load_shared(REPORT_CHART_LOADERS[report_type], start_date, end_date)
+        if chart_df.empty:
+            return
+        
+        await render_chart_cached(report_type, chart_df, period_name)
+        for export_format in self.export_formats:
+            if export_format not in get_available_exporters():
+                continue
+            if await job_executor.run_io(precompute_report_export, report_type, start_date, end_date, export_format):
+                self.artifacts += 1
+        self.precomputed += 1
     
-    Args:
-        chat_id (int): ID чата назначения
-        text (str): Текст сообщения
-        reply_markup: Опциональная клавиатура
-        max_retries (int): Максимальное количество повторных попыток
-        initial_delay (float): Начальная задержка между попытками в секундах
+    async def retention(self, today):
+        """
+        Сжимает секции журнала активности старше срока хранения.
+        
+        Args:
+            today (datetime.date): Текущая дата
+        """
+        # Выгрузка месяца в архив может идти дольше обычного таймаута задачи
+        compacted = await job_executor.run_io(apply_activity_retention, today, timeout=24 * 3600)
+        self.compacted += len(compacted)
     
-    Returns:
-        Message: Объект сообщения в случае успеха
-    """
-    delay = initial_delay
-    last_exception = None
+    async def deliver(self, today):
+        """
+        Рассылает отчеты за завершившиеся периоды подписчикам.
+        
+        Args:
+            today (datetime.date): Дата доставки
+        """
+        groups = {}
+        for user_id, report_type, period_type, export_format in await job_executor.run_io(get_due_subscriptions, today):
+            groups.setdefault((report_type, period_type, export_format), []).append(user_id)
+        
+        for (report_type, period_type, export_format), user_ids in groups.items():
+            try:
+                await self._deliver_group(report_type, period_type, export_format, user_ids, today)
+            except Exception as e:
+                self.failed += len(user_ids)
+                logging.error(f"Ошибка при рассылке отчета {report_type} за {period_type}: {e}")
     
-    for attempt in range(max_retries):
+    async def _deliver_group(self, report_type, period_type, export_format, user_ids, today):
+        # Отчет за период, завершившийся вчера
+        start_date, end_date = get_date_range(period_type, today - datetime.timedelta(days=1))
+        period_name = get_period_name('custom', start_date, end_date)
+        texts = REPORT_TEXTS[report_type]
+        
+        chart_df = await job_executor.run_io(REPORT_CHART_LOADERS[report_type], start_date, end_date)
+        if chart_df.empty:
+            text = texts['empty'].format(period=period_name)
+            await self._fan_out(user_ids, lambda user_id: outbox.send_message(user_id, text, priority=PRIORITY_BULK))
+            return
+        
+        if export_format not in get_available_exporters():
+            export_format = 'csv'
+        buffer = await job_executor.run_io(get_report_export, report_type, start_date, end_date, export_format)
         try:
-            return await bot.send_message(chat_id, text, reply_markup=reply_markup)
-        except TelegramRetryAfter as e:
-            # Если Telegram просит подождать
-            logging.warning(f"Telegram просит подождать {e.retry_after} секунд. Ждем...")
-            await asyncio.sleep(e.retry_after)
-        except (TelegramNetworkError, aiohttp.ClientError) as e:
-            last_exception = e
-            logging.error(f"Ошибка соединения при отправке сообщения (попытка {attempt+1}/{max_retries}): {e}")
-            await asyncio.sleep(delay)
-            delay *= 2  # Экспоненциальное увеличение задержки
-        except Exception as e:
-            last_exception = e
-            logging.error(f"Неизвестная ошибка при отправке сообщения: {e}")
-            await asyncio.sleep(delay)
-            delay *= 2
+            # После первой загрузки файл отправляется остальным подписчикам по file_id
+            document = {'file': buffer.to_input_file()}
+            document_caption = texts['document'].format(period=period_name, label=buffer.label)
+            
+            async def deliver_one(user_id):
+                await send_chart(
+                    user_id, report_type, chart_df, period_name,
+                    caption=texts['chart'].format(period=period_name),
+                    priority=PRIORITY_BULK
+                )
+                message = await outbox.send_document(user_id, document['file'], caption=document_caption)
+                if message.document and not isinstance(document['file'], str):
+                    document['file'] = message.document.file_id
+            
+            await self._fan_out(user_ids[:1], deliver_one)
+            await self._fan_out(user_ids[1:], deliver_one)
+        finally:
+            buffer.discard()
     
-    # Если все попытки исчерпаны
-    raise last_exception if last_exception else Exception("Не удалось отправить сообщение после нескольких попыток")
-
-# Вспомогательная функция для отправки фото с повторными попытками
-async def send_photo_with_retry(chat_id, photo, caption=None, max_retries=5, initial_delay=1):
-    """
-    Отправляет фото с механизмом повторных попыток в случае ошибок соединения.
+    async def _fan_out(self, user_ids, send):
+        # Отправки ставятся в очередь порциями; частоту запросов ограничивает outbox
+        for offset in range(0, len(user_ids), DELIVERY_BATCH):
+            batch = user_ids[offset:offset + DELIVERY_BATCH]
+            results = await asyncio.gather(*(send(user_id) for user_id in batch), return_exceptions=True)
+            for user_id, result in zip(batch, results):
+                if not isinstance(result, Exception):
+                    self.delivered += 1
+                    continue
+                
+                self.failed += 1
+                logging.error(f"Не удалось доставить отчет пользователю {user_id}: {result}")
+                if isinstance(result, TelegramForbiddenError):
+                    # Пользователь заблокировал бота - подписки больше не нужны
+                    await job_executor.run_io(remove_subscriptions, user_id)
     
-    Args:
-        chat_id (int): ID чата назначения
-        photo: Файл или ID фото
-        caption (str): Подпись к фото
-        max_retries (int): Максимальное количество повторных попыток
-        initial_delay (float): Начальная задержка между попытками в секундах
+    def start(self):
+        """
+        Запускает периодическую проверку заданий в текущем цикле событий.
+        """
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
     
-    Returns:
-        Message: Объект сообщения в случае успеха
-    """
-    delay = initial_delay
-    last_exception = None
+    async def _run(self):
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                logging.error(f"Ошибка в планировщике отчетов: {e}")
+            await asyncio.sleep(self.tick_seconds)
     
-    for attempt in range(max_retries):
-        try:
-            return await bot.send_photo(chat_id, photo, caption=caption)
-        except TelegramRetryAfter as e:
-            # Если Telegram просит подождать
-            logging.warning(f"Telegram просит подождать {e.retry_after} секунд. Ждем...")
-            await asyncio.sleep(e.retry_after)
-        except (TelegramNetworkError, aiohttp.ClientError) as e:
-            last_exception = e
-            logging.error(f"Ошибка соединения при отправке фото (попытка {attempt+1}/{max_retries}): {e}")
-            await asyncio.sleep(delay)
-            delay *= 2  # Экспоненциальное увеличение задержки
-        except Exception as e:
-            last_exception = e
-            logging.error(f"Неизвестная ошибка при отправке фото: {e}")
-            await asyncio.sleep(delay)
-            delay *= 2
+    async def stop(self):
+        """
+        Останавливает планировщик.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
     
-    # Если все попытки исчерпаны
-    raise last_exception if last_exception else Exception("Не удалось отправить фото после нескольких попыток")
+    def metrics(self):
+        """
+        Возвращает метрики планировщика.
+        
+        Returns:
+            dict: Даты последних запусков, количество рассчитанных отчетов и выгрузок,
+                сжатых секций журнала, доставок и ошибок
+        """
+        return {
+            'last_runs': dict(self.last_runs),
+            'precomputed': self.precomputed,
+            'artifacts': self.artifacts,
+            'compacted': self.compacted,
+            'delivered': self.delivered,
+            'failed': self.failed,
+        }
+
+report_scheduler = ReportScheduler()
+
+# Настройки режима работы бота: 'polling' (long polling) или 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
 
-# Вспомогательная функция для отправки документа с повторными попытками
-async def send_document_with_retry(chat_id, document, caption=None, max_retries=5, initial_delay=1):
+# Настройки вебхука
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')  # Публичный адрес сервера, например https://example.com
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_QUEUE_SIZE = int(os.getenv('WEBHOOK_QUEUE_SIZE', '1000'))
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '16'))
+
+# Сервер для приема обновлений через вебхук
+class WebhookServer:
     """
-    Отправляет документ с механизмом повторных попыток в случае ошибок соединения.
-    
-    Args:
-        chat_id (int): ID чата назначения
-        document: Файл или ID документа
-        caption (str): Подпись к документу
-        max_retries (int): Максимальное количество повторных попыток
-        initial_delay (float): Начальная задержка между попытками в секундах
+    HTTP-сервер aiohttp, принимающий обновления от Telegram.
     
-    Returns:
-        Message: Объект сообщения в случае успеха
+    Запрос проверяется по секретному токену и подтверждается сразу, а само
+    обновление кладется в ограниченную очередь, из которой его забирают
+    обработчики и передают в диспетчер. При переполнении очереди сервер
+    отвечает 503, и Telegram повторит доставку позже.
     """
-    delay = initial_delay
-    last_exception = None
     
-    for attempt in range(max_retries):
+    def __init__(self, dispatcher, bot, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                 queue_size=WEBHOOK_QUEUE_SIZE, workers=WEBHOOK_WORKERS):
+        """
+        Args:
+            dispatcher (Dispatcher): Диспетчер, обрабатывающий обновления
+            bot (Bot): Экземпляр бота
+            path (str): Путь, на который Telegram отправляет обновления
+            secret (str): Секретный токен; если не задан, генерируется случайный
+            queue_size (int): Максимальная длина очереди обновлений
+            workers (int): Количество обработчиков очереди
+        """
+        self.dispatcher = dispatcher
+        self.bot = bot
+        self.path = path
+        self.secret = secret or secrets.token_urlsafe(32)
+        self.queue_size = queue_size
+        self.workers = workers
+        self._queue = None
+        self._tasks = []
+        self._runner = None
+        self._started = None
+        
+        # Метрики
+        self.received = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+    
+    def build_app(self):
+        """
+        Создает приложение aiohttp с обработчиком вебхука.
+        
+        Returns:
+            aiohttp.web.Application: Приложение
+        """
+        app = web.Application()
+        app.router.add_post(self.path, self.handle)
+        return app
+    
+    def start_workers(self):
+        """
+        Создает очередь и запускает обработчики в текущем цикле событий.
+        """
+        if self._tasks:
+            return
+        self._queue = asyncio.Queue(maxsize=self.queue_size)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._started = time.monotonic()
+    
+    async def handle(self, request):
+        """
+        Принимает обновление: проверяет токен, ставит обновление в очередь и сразу отвечает.
+        
+        Args:
+            request (aiohttp.web.Request): Входящий запрос
+            
+        Returns:
+            aiohttp.web.Response: Ответ для Telegram
+        """
+        token = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+        if not hmac.compare_digest(token, self.secret):
+            self.rejected += 1
+            return web.Response(status=401, text="Unauthorized")
+        
         try:
-            return await bot.send_document(chat_id, document, caption=caption)
-        except TelegramRetryAfter as e:
-            # Если Telegram просит подождать
-            logging.warning(f"Telegram просит подождать {e.retry_after} секунд. Ждем...")
-            await asyncio.sleep(e.retry_after)
-        except (TelegramNetworkError, aiohttp.ClientError) as e:
-            last_exception = e
-            logging.error(f"Ошибка соединения при отправке документа (попытка {attempt+1}/{max_retries}): {e}")
-            await asyncio.sleep(delay)
-            delay *= 2  # Экспоненциальное увеличение задержки
-        except Exception as e:
-            last_exception = e
-            logging.error(f"Неизвестная ошибка при отправке документа: {e}")
-            await asyncio.sleep(delay)
-            delay *= 2
+            data = await request.json()
+        except ValueError:
+            self.rejected += 1
+            return web.Response(status=400, text="Bad Request")
+        
+        try:
+            self._queue.put_nowait(data)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            logging.warning("Очередь обновлений вебхука переполнена")
+            return web.Response(status=503, text="Service Unavailable")
+        
+        self.received += 1
+        return web.Response()
     
-    # Если все попытки исчерпаны
-    raise last_exception if last_exception else Exception("Не удалось отправить документ после нескольких попыток")
-
-# Очистка временных файлов
-def cleanup_temp_files(directory='temp_charts'):
-    """
-    Удаляет временные файлы из указанной директории.
+    async def _worker(self):
+        while True:
+            data = await self._queue.get()
+            try:
+                update = Update.model_validate(data, context={"bot": self.bot})
+                await self.dispatcher.feed_update(self.bot, update)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Ошибка при обработке обновления из вебхука: {e}")
+            finally:
+                self._queue.task_done()
     
-    Args:
-        directory (str): Путь к директории с временными файлами
-    """
-    if os.path.exists(directory):
-        for file in os.listdir(directory):
-            file_path = os.path.join(directory, file)
+    async def start(self, host=WEBHOOK_HOST, port=WEBHOOK_PORT, url=WEBHOOK_URL):
+        """
+        Запускает обработчики и HTTP-сервер и регистрирует вебхук в Telegram.
+        
+        Args:
+            host (str): Адрес, на котором слушает сервер
+            port (int): Порт сервера
+            url (str): Публичный адрес сервера; если не задан, вебхук не регистрируется
+        """
+        self.start_workers()
+        self._runner = web.AppRunner(self.build_app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, port).start()
+        logging.info(f"Сервер вебхука запущен на {host}:{port}{self.path}")
+        
+        if url:
+            await self.bot.set_webhook(
+                url.rstrip('/') + self.path,
+                secret_token=self.secret,
+                allowed_updates=self.dispatcher.resolve_used_update_types()
+            )
+            logging.info(f"Вебхук зарегистрирован: {url.rstrip('/')}{self.path}")
+    
+    async def stop(self, delete_webhook=True, drain_timeout=10):
+        """
+        Останавливает сервер, дожидается обработки принятых обновлений и снимает вебхук.
+        
+        Args:
+            delete_webhook (bool): Удалить вебхук в Telegram
+            drain_timeout (float): Сколько секунд ждать обработки очереди
+        """
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+        
+        if delete_webhook:
             try:
-                if os.path.isfile(file_path):
-                    os.unlink(file_path)
+                await self.bot.delete_webhook()
             except Exception as e:
-                logging.error(f"Ошибка при удалении файла {file_path}: {e}")
+                logging.error(f"Не удалось удалить вебхук: {e}")
+        
+        if self._queue is not None:
+            try:
+                await asyncio.wait_for(self._queue.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Не обработано обновлений из вебхука: {self._queue.qsize()}")
+        
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        
+        logging.info(f"Сервер вебхука остановлен: {self.metrics()}")
+    
+    def metrics(self):
+        """
+        Возвращает метрики сервера вебхука.
+        
+        Returns:
+            dict: Количество принятых, отклоненных, обработанных обновлений и скорость обработки
+        """
+        elapsed = time.monotonic() - self._started if self._started else 0.0
+        return {
+            'queue_depth': self._queue.qsize() if self._queue is not None else 0,
+            'received': self.received,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+            'updates_per_sec': round(self.processed / elapsed, 1) if elapsed else 0.0,
+        }
+
+webhook_server = WebhookServer(dp, bot)
 
 # Запуск бота
-async def main():
+async def main(mode=BOT_MODE, webhook_port=WEBHOOK_PORT, fsm_storage=FSM_STORAGE):
+    """
+    Запускает бота.
+    
+    Args:
+        mode (str): Режим получения обновлений: 'polling' или 'webhook'
+        webhook_port (int): Порт сервера вебхука
+        fsm_storage (str): Тип хранилища состояний FSM
+    """
     try:
         # Инициализация базы данных
         init_db()
-        # Для тестирования генерируем тестовые данные
-        generate_test_data()
+        configure_fsm_storage(fsm_storage)
+        today_counters.rehydrate()
         
-        # Очистка временных файлов перед запуском
-        cleanup_temp_files()
+        # Запуск пулов для блокирующих операций и записи журнала активности
+        job_executor.start()
+        activity_writer.start()
+        today_counters.start()
+        outbox.start()
+        report_scheduler.start()
         
         # Запуск бота
-        await dp.start_polling(bot)
+        if mode == 'webhook':
+            await webhook_server.start(port=webhook_port)
+            await asyncio.Event().wait()
+        else:
+            await dp.start_polling(bot)
     except Exception as e:
         logging.error(f"Критическая ошибка при запуске бота: {e}")
     finally:
-        # Очистка временных файлов при завершении
-        cleanup_temp_files()
+        # Остановка приема обновлений, запись накопленного журнала,
+        # остановка фоновых задач и закрытие соединений с базой данных
+        if mode == 'webhook':
+            await webhook_server.stop(delete_webhook=bool(WEBHOOK_URL))
+        await report_scheduler.stop()
+        await activity_writer.stop()
+        await today_counters.stop()
+        logging.info(f"Объединение одинаковых запросов: {request_flights.metrics()}")
+        job_executor.shutdown()
+        await outbox.stop()
+        db_pool.close_all()
+
+# Настройки запуска в нескольких рабочих процессах
+BOT_WORKERS = int(os.getenv('BOT_WORKERS', '1'))
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', '1000'))
+
+def update_shard_key(update):
+    """
+    Возвращает ключ распределения обновления по процессам: ID чата,
+    а если чата нет - ID пользователя. Все обновления одного чата
+    попадают в один процесс и обрабатываются по порядку.
+    
+    Args:
+        update (Update): Обновление Telegram
+        
+    Returns:
+        int: Ключ распределения
+    """
+    event = update.event
+    chat = getattr(event, 'chat', None) or getattr(getattr(event, 'message', None), 'chat', None)
+    if chat is not None:
+        return chat.id
+    user = getattr(event, 'from_user', None)
+    if user is not None:
+        return user.id
+    return update.update_id
+
+def _worker_process(index, queue):
+    """
+    Точка входа рабочего процесса.
+    
+    Args:
+        index (int): Номер процесса
+        queue (multiprocessing.Queue): Очередь обновлений этого процесса
+    """
+    try:
+        asyncio.run(_worker_loop(index, queue))
+    except KeyboardInterrupt:
+        pass
+
+async def _worker_loop(index, queue):
+    # Состояние FSM должно быть общим для всех процессов, а счетчики за сегодня
+    # видели бы только записи своего процесса, поэтому отключаются
+    configure_fsm_storage('sqlite')
+    today_counters.enabled = False
+    job_executor.start()
+    activity_writer.start()
+    outbox.start()
+    # Задания планировщика выполняет тот процесс, который первым отметит запуск в базе
+    report_scheduler.start()
+    logging.info(f"Рабочий процесс {index} запущен")
+    
+    loop = asyncio.get_running_loop()
+    processed = 0
+    try:
+        while True:
+            data = await loop.run_in_executor(None, queue.get)
+            if data is None:
+                break
+            
+            # Обновления одного чата обрабатываются строго по очереди;
+            # долгие отчеты все равно выполняются в фоне через job_executor
+            try:
+                update = Update.model_validate(data, context={"bot": bot})
+                await dp.feed_update(bot, update)
+                processed += 1
+            except Exception as e:
+                logging.error(f"Ошибка при обработке обновления в процессе {index}: {e}")
+    finally:
+        await report_scheduler.stop()
+        await activity_writer.stop()
+        job_executor.shutdown()
+        await outbox.stop()
+        await bot.session.close()
+        db_pool.close_all()
+        logging.info(f"Рабочий процесс {index} остановлен, обработано обновлений: {processed}")
+
+async def run_workers(workers=BOT_WORKERS, fetch_updates=None):
+    """
+    Запускает бота в нескольких процессах. Родительский процесс получает
+    обновления и распределяет их по рабочим процессам по ID чата, рабочие
+    процессы обрабатывают их с общим хранилищем состояний FSM в SQLite.
+    
+    Args:
+        workers (int): Количество рабочих процессов
+        fetch_updates (callable, optional): Корутинная функция fetch_updates(offset),
+            возвращающая список обновлений или None для завершения;
+            по умолчанию - long polling через getUpdates
+    """
+    init_db()
+    db_pool.close_all()
+    
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(WORKER_QUEUE_SIZE) for _ in range(workers)]
+    processes = [
+        context.Process(target=_worker_process, args=(index, queue), name=f"bot-worker-{index}")
+        for index, queue in enumerate(queues)
+    ]
+    for process in processes:
+        process.start()
+    
+    if fetch_updates is None:
+        allowed_updates = dp.resolve_used_update_types()
+        
+        async def fetch_updates(offset):
+            return await bot.get_updates(offset=offset, timeout=30, allowed_updates=allowed_updates)
+    
+    loop = asyncio.get_running_loop()
+    offset = None
+    distributed = 0
+    try:
+        while True:
+            try:
+                updates = await fetch_updates(offset)
+            except Exception as e:
+                logging.error(f"Ошибка при получении обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+            
+            if updates is None:
+                break
+            
+            for update in updates:
+                queue = queues[update_shard_key(update) % workers]
+                data = update.model_dump(mode='json', by_alias=True, exclude_none=True)
+                # Если процесс не успевает, ожидание места в очереди притормаживает получение обновлений
+                await loop.run_in_executor(None, queue.put, data)
+                offset = update.update_id + 1
+                distributed += 1
+    finally:
+        for queue in queues:
+            queue.put(None)
+        for process in processes:
+            await loop.run_in_executor(None, process.join)
+        await bot.session.close()
+        logging.info(f"Рабочие процессы остановлены, распределено обновлений: {distributed}")
+
+# Разбор аргументов командной строки
+def parse_args(argv=None):
+    """
+    Разбирает аргументы командной строки.
+    
+    Args:
+        argv (list, optional): Список аргументов, по умолчанию sys.argv
+        
+    Returns:
+        argparse.Namespace: Разобранные аргументы
+    """
+    parser = argparse.ArgumentParser(description="Telegram-бот для аналитики продаж и отчетов")
+    parser.add_argument(
+        '--rebuild-rollups',
+        action='store_true',
+        help="пересобрать агрегированные по дням таблицы и завершить работу"
+    )
+    parser.add_argument(
+        '--generate-test-data',
+        action='store_true',
+        help="заполнить базу тестовыми данными и завершить работу"
+    )
+    parser.add_argument('--sales-rows', type=int, default=300, help="количество тестовых продаж")
+    parser.add_argument('--days', type=int, default=31, help="количество дней тестовых данных")
+    parser.add_argument('--users', type=int, default=20, help="количество тестовых пользователей")
+    parser.add_argument('--activity-rows', type=int, default=500, help="количество тестовых действий")
+    parser.add_argument('--seed', type=int, default=TEST_DATA_SEED, help="начальное значение генератора")
+    parser.add_argument(
+        '--benchmark',
+        action='store_true',
+        help="измерить время отчетных запросов на текущих данных и завершить работу"
+    )
+    parser.add_argument(
+        '--ingest-sales',
+        metavar='PATH',
+        help="загрузить продажи из файла CSV или JSON Lines и завершить работу"
+    )
+    parser.add_argument(
+        '--ingest-format',
+        choices=sorted(INGEST_FORMATS),
+        help="формат файла продаж (по умолчанию определяется по расширению)"
+    )
+    parser.add_argument(
+        '--rebuild-indexes',
+        action='store_true',
+        help="снять индексы таблицы продаж на время загрузки и построить их заново"
+    )
+    parser.add_argument(
+        '--apply-retention',
+        action='store_true',
+        help="сжать секции журнала активности старше срока хранения и завершить работу"
+    )
+    parser.add_argument(
+        '--archive-activity',
+        metavar='YYYY-MM',
+        help="выгрузить журнал активности за месяц в архив CSV (gzip) и завершить работу"
+    )
+    parser.add_argument(
+        '--mode',
+        choices=['polling', 'webhook'],
+        default=BOT_MODE,
+        help="способ получения обновлений (по умолчанию из BOT_MODE)"
+    )
+    parser.add_argument(
+        '--webhook-port',
+        type=int,
+        default=WEBHOOK_PORT,
+        help="порт сервера вебхука (по умолчанию из WEBHOOK_PORT)"
+    )
+    parser.add_argument(
+        '--fsm-storage',
+        choices=sorted(FSM_STORAGES),
+        default=FSM_STORAGE,
+        help="хранилище состояний FSM (по умолчанию из FSM_STORAGE)"
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=BOT_WORKERS,
+        help="количество рабочих процессов; больше одного - только в режиме polling"
+    )
+    args = parser.parse_args(argv)
+    if args.workers > 1 and args.mode == 'webhook':
+        parser.error("несколько рабочих процессов поддерживаются только в режиме polling")
+    return args
 
 if __name__ == '__main__':
+    args = parse_args()
     try:
-        asyncio.run(main())
+        if args.rebuild_rollups:
+            init_db()
+            rebuild_rollups()
+            db_pool.close_all()
+        elif args.generate_test_data or args.benchmark:
+            init_db()
+            if args.generate_test_data:
+                generate_test_data(args.sales_rows, args.days, args.users, args.activity_rows, args.seed)
+            if args.benchmark:
+                run_benchmark()
+            db_pool.close_all()
+        elif args.ingest_sales:
+            init_db()
+            ingest_sales(args.ingest_sales, args.ingest_format, rebuild_indexes=args.rebuild_indexes)
+            db_pool.close_all()
+        elif args.apply_retention or args.archive_activity:
+            init_db()
+            if args.archive_activity:
+                archive_activity_partition(args.archive_activity)
+            if args.apply_retention:
+                apply_activity_retention()
+            db_pool.close_all()
+        elif args.workers > 1:
+            asyncio.run(run_workers(args.workers))
+        else:
+            asyncio.run(main(args.mode, args.webhook_port, args.fsm_storage))
     except (KeyboardInterrupt, SystemExit):
         logging.info("Бот остановлен")
     except Exception as e:
@@ -0,0 +1,44 @@
+import os
+import sys
+
+import pytest
+
+# Бот создается при импорте модуля: токен должен иметь правильный формат
+os.environ.setdefault('API_TOKEN', '123456789:TEST-TOKEN')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from fakes import FakeBotAPI  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """
+    Временная база данных со всеми миграциями вместо analytics.db. Кэши
+    запросов, известных пользователей и справочников и пул фоновых задач
+    подменяются новыми, чтобы тесты не влияли друг на друга; счетчики
+    за сегодня отключены.
+    """
+    pool = main.DatabasePool(str(tmp_path / 'analytics.db'))
+    monkeypatch.setattr(main, 'db_pool', pool)
+    monkeypatch.setattr(main, 'query_cache', main.QueryResultCache())
+    monkeypatch.setattr(main, 'known_users', main.KnownUsers())
+    monkeypatch.setattr(main, 'job_executor', main.JobExecutor(cpu_workers=0))
+    monkeypatch.setattr(main, 'today_counters', main.TodayCounters(enabled=False))
+    # Ключи справочников относятся к конкретной базе
+    for dimension in (main.products, main.action_types):
+        dimension.reset()
+        pool.rollback_callbacks.append(dimension.reset)
+
+    main.init_db()
+    yield pool
+
+    main.job_executor.shutdown()
+    pool.close_all()
+    for dimension in (main.products, main.action_types):
+        dimension.reset()
+
+
+@pytest.fixture
+def fake_bot_api():
+    return FakeBotAPI()
@@ -0,0 +1,115 @@
+"""
+Поддельный сервер Bot API и построение обновлений Telegram для тестов
+и нагрузочных тестов.
+"""
+import asyncio
+import datetime
+import os
+import time
+
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import CallbackQuery, Chat, Message, Update, User
+from aiohttp import web
+
+
+class FakeBotAPI:
+    """
+    Сервер, отвечающий на запросы Bot API вместо Telegram. Запросы записываются
+    в calls, время их получения - в received_at; handlers позволяет задать ответ
+    для метода (например, ошибку 429), delay - задержку каждого ответа.
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = []
+        self.received_at = []
+        self.handlers = {}
+        self.url = None
+        self._runner = None
+
+    async def start(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = self._runner.addresses[0][1]
+        self.url = f'http://127.0.0.1:{port}'
+        return self
+
+    async def stop(self):
+        await self._runner.cleanup()
+
+    def bot(self):
+        session = AiohttpSession(api=TelegramAPIServer.from_base(self.url))
+        return Bot(token=os.environ['API_TOKEN'], session=session)
+
+    def sent(self, method='sendMessage'):
+        return [data for name, data in self.calls if name == method]
+
+    def methods(self):
+        return [name for name, _ in self.calls]
+
+    async def _handle(self, request):
+        method = request.match_info['method']
+        data = dict(await request.post())
+        self.calls.append((method, data))
+        self.received_at.append(time.monotonic())
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        handler = self.handlers.get(method)
+        if handler is not None:
+            response = handler(data)
+            if response is not None:
+                return web.json_response(response)
+        return web.json_response({'ok': True, 'result': self._result(method, data)})
+
+    def _result(self, method, data):
+        if method == 'getMe':
+            return {'id': int(os.environ['API_TOKEN'].split(':')[0]), 'is_bot': True, 'first_name': 'Бот'}
+        if method == 'getUpdates':
+            return []
+        if not (method.startswith('send') or method.startswith('edit')) or method == 'sendChatAction':
+            return True
+        number = len(self.calls)
+        result = {
+            'message_id': int(data.get('message_id', number)),
+            'date': 0,
+            'chat': {'id': int(data['chat_id']), 'type': 'private'},
+        }
+        if 'text' in data:
+            result['text'] = data['text']
+        if 'caption' in data:
+            result['caption'] = data['caption']
+        if method == 'sendPhoto':
+            result['photo'] = [{'file_id': f'photo-{number}', 'file_unique_id': f'u{number}', 'width': 1, 'height': 1}]
+        if method == 'sendDocument':
+            result['document'] = {'file_id': f'document-{number}', 'file_unique_id': f'u{number}'}
+        return result
+
+
+def user(user_id):
+    return User(id=user_id, is_bot=False, first_name=f'Пользователь {user_id}')
+
+
+def message(update_id, chat_id, text):
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id,
+        date=datetime.datetime.now(),
+        chat=Chat(id=chat_id, type='private'),
+        from_user=user(chat_id),
+        text=text,
+    ))
+
+
+def callback(update_id, chat_id, data):
+    return Update(update_id=update_id, callback_query=CallbackQuery(
+        id=str(update_id),
+        from_user=user(chat_id),
+        chat_instance=str(chat_id),
+        data=data,
+        message=Message(message_id=update_id, date=datetime.datetime.now(), chat=Chat(id=chat_id, type='private')),
+    ))
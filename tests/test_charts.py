@@ -0,0 +1,91 @@
+import asyncio
+
+import main
+from fakes import callback, message
+
+
+def request_month_stats(fake_bot_api, monkeypatch, chats):
+    """
+    Проходит сценарий /stats -> продажи -> месяц в каждом из чатов по очереди.
+    """
+    async def scenario():
+        await fake_bot_api.start()
+        bot = fake_bot_api.bot()
+        monkeypatch.setattr(main, 'bot', bot)
+        monkeypatch.setattr(main, 'outbox', main.TelegramOutbox())
+        update_id = 0
+        try:
+            for chat_id in chats:
+                for update in (message, callback, callback):
+                    update_id += 1
+                    text = {message: '/stats', callback: 'report_sales' if update_id % 3 == 2 else 'period_month'}
+                    await main.dp.feed_update(bot, update(update_id, chat_id, text[update]))
+                # Ответ отправляется в фоне: ждем его перед следующим чатом
+                while chat_id not in [int(data['chat_id']) for data in fake_bot_api.sent('sendPhoto')]:
+                    await asyncio.sleep(0.01)
+        finally:
+            await main.outbox.stop()
+            await bot.session.close()
+            await fake_bot_api.stop()
+
+    asyncio.run(asyncio.wait_for(scenario(), timeout=60))
+
+
+def test_repeated_stats_reuse_uploaded_chart(db, fake_bot_api, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    cache = main.ChartCache(disk_dir=str(tmp_path / 'charts'))
+    monkeypatch.setattr(main, 'chart_cache', cache)
+    start_date, _ = main.get_date_range('month')
+    with db.writer() as conn:
+        main.insert_sales_rows(conn, [(1, 'Смартфон', 100.0, start_date, 1), (2, 'Ноутбук', 250.0, start_date, 2)])
+
+    request_month_stats(fake_bot_api, monkeypatch, [1, 2, 3])
+
+    photos = fake_bot_api.sent('sendPhoto')
+    assert [int(data['chat_id']) for data in photos] == [1, 2, 3]
+    # График загружается один раз, затем отправляется по file_id из ответа Telegram
+    assert photos[0]['photo'].startswith('attach://')
+    assert photos[1]['photo'] == photos[2]['photo'] and photos[1]['photo'].startswith('photo-')
+
+    metrics = cache.metrics()
+    assert metrics['misses'] == 1 and metrics['file_id_hits'] == 2
+    assert metrics['hit_rate'] == round(2 / 3, 3)
+    assert len(list((tmp_path / 'charts').iterdir())) == 1
+
+
+def test_chart_cache_evicts_by_size_and_falls_back_to_disk(tmp_path):
+    cache = main.ChartCache(max_bytes=250, disk_dir=str(tmp_path))
+    for index in range(3):
+        cache.put(f'chart{index}', bytes([index]) * 100)
+
+    metrics = cache.metrics()
+    assert metrics['entries'] == 2 and metrics['bytes'] == 200 and metrics['evictions'] == 1
+
+    # Вытесненный из памяти график читается с диска и снова попадает в память
+    assert cache.get('chart0') == bytes([0]) * 100
+    assert cache.get('chart2') == bytes([2]) * 100
+    assert cache.get('missing') is None
+    metrics = cache.metrics()
+    assert (metrics['disk_hits'], metrics['memory_hits'], metrics['misses']) == (1, 1, 1)
+    assert metrics['entries'] == 2
+
+
+def png_size(png):
+    assert png.startswith(b'\x89PNG\r\n\x1a\n')
+    return int.from_bytes(png[16:20], 'big'), int.from_bytes(png[20:24], 'big')
+
+
+def test_chart_templates_are_reused_per_profile(db):
+    start_date, end_date = main.get_date_range('month')
+    with db.writer() as conn:
+        main.insert_sales_rows(conn, [(1, 'Смартфон', 100.0, start_date, 1), (2, 'Ноутбук', 250.0, end_date, 2)])
+    df = main.get_sales_data(start_date, end_date)
+
+    assert png_size(main.generate_sales_chart(df, 'месяц', 'default')) == (1000, 600)
+    figure, axes, _ = main._get_chart_template('default')
+    assert png_size(main.generate_sales_chart(df, 'месяц', 'compact')) == (640, 384)
+
+    # Повторная отрисовка очищает те же оси: линии прошлого графика не остаются
+    main.generate_sales_chart(df[df['product_name'] == 'Смартфон'], 'месяц', 'default')
+    assert main._get_chart_template('default')[:2] == (figure, axes)
+    assert [line.get_label() for line in axes.get_lines()] == ['Смартфон']
@@ -0,0 +1,115 @@
+import asyncio
+
+import main
+from fakes import callback, message
+
+
+def with_fake_telegram(fake_bot_api, monkeypatch, scenario):
+    """
+    Выполняет сценарий scenario(bot) с ботом и очередью отправки, направленными
+    в поддельный Bot API.
+    """
+    async def run():
+        await fake_bot_api.start()
+        bot = fake_bot_api.bot()
+        monkeypatch.setattr(main, 'bot', bot)
+        monkeypatch.setattr(main, 'outbox', main.TelegramOutbox(chat_rate=1000, chat_burst=1000))
+        try:
+            return await asyncio.wait_for(scenario(bot), timeout=30)
+        finally:
+            await main.outbox.stop()
+            await bot.session.close()
+            await fake_bot_api.stop()
+
+    return asyncio.run(run())
+
+
+def has_main_keyboard(data):
+    return 'keyboard' in data.get('reply_markup', '')
+
+
+async def run_flow(fake_bot_api, bot, chat_id, texts):
+    """
+    Отправляет команду и нажатия кнопок и ждет итогового ответа с основной клавиатурой.
+
+    Returns:
+        list: Методы Bot API, вызванные после последнего нажатия
+    """
+    for update_id, text in enumerate(texts, start=chat_id * 100):
+        mark = len(fake_bot_api.calls)
+        update = message if text.startswith('/') else callback
+        await main.dp.feed_update(bot, update(update_id, chat_id, text))
+    while not any(has_main_keyboard(data) for _, data in fake_bot_api.calls[mark:]):
+        await asyncio.sleep(0.01)
+    return [method for method, _ in fake_bot_api.calls[mark:] if method != 'answerCallbackQuery']
+
+
+def add_month_sales(db):
+    start_date, end_date = main.get_date_range('month')
+    with db.writer() as conn:
+        main.insert_sales_rows(conn, [(1, 'Смартфон', 100.0, start_date, 1), (2, 'Ноутбук', 250.0, end_date, 2)])
+
+
+def test_stats_reply_is_status_and_captioned_chart(db, fake_bot_api, monkeypatch):
+    add_month_sales(db)
+
+    async def scenario(bot):
+        return await run_flow(fake_bot_api, bot, 1, ['/stats', 'report_sales', 'period_month'])
+
+    methods = with_fake_telegram(fake_bot_api, monkeypatch, scenario)
+    # Сообщение о загрузке и график, подпись которого содержит текст статистики
+    assert methods == ['sendMessage', 'sendPhoto']
+    photo = fake_bot_api.sent('sendPhoto')[0]
+    assert 'Общая сумма продаж' in photo['caption'] and has_main_keyboard(photo)
+
+
+def test_report_reply_is_status_chart_and_document(db, fake_bot_api, monkeypatch):
+    add_month_sales(db)
+
+    async def scenario(bot):
+        return await run_flow(fake_bot_api, bot, 1, ['/report', 'report_sales', 'format_csv', 'period_month'])
+
+    methods = with_fake_telegram(fake_bot_api, monkeypatch, scenario)
+    assert methods == ['sendMessage', 'sendPhoto', 'sendDocument']
+    assert has_main_keyboard(fake_bot_api.sent('sendDocument')[0])
+
+
+def test_composer_edits_status_message(fake_bot_api, monkeypatch):
+    async def scenario(bot):
+        composer = main.ResponseComposer(1)
+        await composer.status("Загрузка...")
+        await composer.status("Загрузка...")
+        await composer.status("Почти готово...")
+        await composer.reply("Ошибка")
+        await composer.reply("Готово", reply_markup=main.get_main_keyboard())
+        return composer.calls
+
+    calls = with_fake_telegram(fake_bot_api, monkeypatch, scenario)
+    assert calls == 4
+    assert fake_bot_api.methods() == ['sendMessage', 'editMessageText', 'editMessageText', 'sendMessage']
+    edited = fake_bot_api.sent('editMessageText')
+    assert [data['text'] for data in edited] == ["Почти готово...", "Ошибка"]
+    # Поддельный сервер выдает сообщениям номер запроса: сообщение о загрузке - первое
+    assert {data['message_id'] for data in edited} == {'1'}
+
+
+def test_empty_stats_and_lost_choice_keep_main_keyboard(db, fake_bot_api, monkeypatch):
+    async def scenario(bot):
+        empty = await run_flow(fake_bot_api, bot, 1, ['/stats', 'report_sales', 'period_month'])
+        empty_report = await run_flow(fake_bot_api, bot, 2, ['/report', 'report_sales', 'format_csv', 'period_month'])
+
+        # Состояние выбора периода без сохраненного типа отчета
+        for chat_id, state in ((3, main.StatsStates.waiting_for_period), (4, main.ReportStates.waiting_for_period)):
+            await main.dp.fsm.get_context(bot, chat_id, chat_id).set_state(state)
+        lost = [await run_flow(fake_bot_api, bot, chat_id, ['period_month']) for chat_id in (3, 4)]
+        return empty, empty_report, lost
+
+    empty, empty_report, lost = with_fake_telegram(fake_bot_api, monkeypatch, scenario)
+    assert empty == empty_report == ['sendMessage', 'sendMessage']
+    assert lost == [['sendMessage'], ['sendMessage']]
+
+    replies = {int(data['chat_id']): data['text'] for data in fake_bot_api.sent() if has_main_keyboard(data)}
+    assert replies[1].startswith("Нет данных о продажах")
+    assert replies[2].startswith("Нет данных о продажах")
+    assert replies[3].endswith("Начните заново: /stats")
+    assert replies[4].endswith("Начните заново: /report")
@@ -0,0 +1,55 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+import main
+
+DATES = ['1969-12-31', '1970-01-01', '2000-02-29', '2024-01-31', '2024-12-31', '2038-01-19']
+TIMES = ['1970-01-01 00:00:00', '2000-02-29 23:59:59', '2024-03-31 01:30:00', '2038-01-19 03:14:08']
+
+
+def test_epoch_day_and_seconds_round_trip():
+    for date in DATES:
+        day = main.epoch_day(date)
+        assert day == np.datetime64(date, 'D').astype(np.int64)
+        assert str(pd.to_datetime(day, unit='D').date()) == date
+        assert main.epoch_day(datetime.date.fromisoformat(date)) == day
+        assert main.epoch_day(f"{date} 23:59:59") == day
+
+    for value in TIMES:
+        seconds = main.epoch_seconds(value)
+        assert seconds == np.datetime64(value.replace(' ', 'T'), 's').astype(np.int64)
+        assert str(pd.to_datetime(seconds, unit='s')) == value
+        assert main.epoch_day(value) == seconds // main.SECONDS_PER_DAY
+
+    assert main.period_seconds('2024-01-01', '2024-01-01') == (
+        main.epoch_seconds('2024-01-01 00:00:00'), main.epoch_seconds('2024-01-01 23:59:59')
+    )
+
+
+def test_stored_dates_and_names_decode_to_typed_columns(db):
+    sales = [(1, 'Смартфон', 100.0, date, 1) for date in DATES] + [(2, 'Ноутбук', 50.0, DATES[-1], 2)]
+    activity = [(1, 'start', value, None) for value in TIMES] + [(2, 'report', TIMES[-1], None)]
+    with db.writer() as conn:
+        main.insert_sales_rows(conn, sales)
+    main.write_activity_batch(activity)
+
+    with db.reader() as conn:
+        assert conn.execute("SELECT typeof(day), typeof(product_key) FROM sales LIMIT 1").fetchone() == ('integer', 'integer')
+        sales_df = main.read_frame(conn, "SELECT product_key AS product_name, day AS date FROM sales ORDER BY id")
+        activity_query = "SELECT action_key AS action_type, action_ts AS action_date FROM user_activity {} ORDER BY action_ts, user_id"
+        columns = {'action_type': 'action_type', 'action_date': 'second'}
+        activity_df = main.read_frame(conn, activity_query.format(''), columns=columns)
+        starts = main.read_frame(conn, activity_query.format("WHERE user_id = 1"), columns=columns)
+
+    assert pd.api.types.is_datetime64_dtype(sales_df['date'])
+    assert sales_df['date'].dt.strftime('%Y-%m-%d').tolist() == [row[3] for row in sales]
+    assert isinstance(sales_df['product_name'].dtype, pd.CategoricalDtype)
+    assert sales_df['product_name'].tolist() == [row[1] for row in sales]
+
+    assert activity_df['action_date'].dt.strftime('%Y-%m-%d %H:%M:%S').tolist() == [row[2] for row in activity]
+    assert activity_df['action_type'].tolist() == [row[1] for row in activity]
+    # Категории - весь справочник, а не только встретившиеся значения
+    assert set(starts['action_type']) == {'start'}
+    assert set(starts['action_type'].cat.categories) == {'start', 'report'}
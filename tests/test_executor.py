@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+import pytest
+
+import main
+
+
+def test_blocking_work_does_not_stall_event_loop():
+    executor = main.JobExecutor(io_workers=2, cpu_workers=0)
+
+    async def scenario():
+        lags = []
+
+        async def ticker():
+            for _ in range(20):
+                started = time.perf_counter()
+                await asyncio.sleep(0.01)
+                lags.append(time.perf_counter() - started - 0.01)
+
+        await asyncio.gather(executor.run_io(time.sleep, 0.2), executor.run_cpu(time.sleep, 0.2), ticker())
+        return lags
+
+    try:
+        lags = asyncio.run(scenario())
+    finally:
+        executor.shutdown()
+    assert max(lags) < 0.1
+
+
+def test_job_timeout_and_cancellation(monkeypatch):
+    executor = main.JobExecutor(io_workers=2, cpu_workers=0, max_jobs=1, job_timeout=0.1)
+    notices = []
+
+    async def send_message(chat_id, text, **kwargs):
+        notices.append((chat_id, text))
+
+    monkeypatch.setattr(main.outbox, 'send_message', send_message)
+
+    async def scenario():
+        with pytest.raises(asyncio.TimeoutError):
+            await executor.run_io(time.sleep, 0.5, timeout=0.05)
+
+        # Задача, превысившая таймаут, сообщает пользователю об этом
+        await executor.spawn(1, asyncio.sleep(1))
+        assert notices and notices[0][0] == 1
+
+        # Новая задача пользователя отменяет предыдущую, сброс состояния - текущую
+        first = executor.spawn(2, asyncio.sleep(1))
+        second = executor.spawn(2, asyncio.sleep(1))
+        await asyncio.sleep(0)
+        assert executor.cancel_user_jobs(2)
+        results = await asyncio.gather(first, second, return_exceptions=True)
+        assert all(isinstance(result, asyncio.CancelledError) for result in results)
+        assert not executor.cancel_user_jobs(2)
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        executor.shutdown()
+
+
+def test_concurrent_jobs_are_limited():
+    executor = main.JobExecutor(io_workers=2, cpu_workers=0, max_jobs=2, job_timeout=5)
+    running = []
+    peak = []
+
+    async def job():
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.02)
+        running.pop()
+
+    async def scenario():
+        await asyncio.gather(*(executor.spawn(user_id, job()) for user_id in range(10)))
+
+    try:
+        asyncio.run(scenario())
+    finally:
+        executor.shutdown()
+    assert len(peak) == 10
+    assert max(peak) == 2
@@ -0,0 +1,117 @@
+import datetime
+import gzip
+import io
+import os
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+ACTIONS = 100000
+
+
+def buffer_bytes(buffer):
+    input_file = buffer.to_input_file()
+    if buffer.spilled:
+        with open(buffer.path, 'rb') as f:
+            return f.read()
+    return input_file.data
+
+
+def read_export(buffer):
+    data = io.BytesIO(buffer_bytes(buffer))
+    extension = buffer.filename.split('.', 1)[1]
+    if extension == 'parquet':
+        return pd.read_parquet(data)
+    if extension == 'feather':
+        return pd.read_feather(data)
+    compression = {'csv': None, 'csv.gz': 'gzip', 'csv.zst': 'zstd'}[extension]
+    return pd.read_csv(data, compression=compression)
+
+
+def plain(df):
+    # Названия из справочников загружаются категориями, а даты - типом datetime;
+    # из CSV они читаются строками, поэтому сравниваются в текстовом виде
+    df = df.astype({column: object for column in df.select_dtypes(['category', 'string']).columns})
+    for column in df.select_dtypes('datetime').columns:
+        df[column] = df[column].dt.strftime('%Y-%m-%d').astype(object)
+    return df
+
+
+@pytest.mark.parametrize('export_format', sorted(main.EXPORTERS))
+def test_exporters_round_trip(db, export_format):
+    if not main.EXPORTERS[export_format]['available']:
+        pytest.skip(f"{export_format}: не установлены нужные библиотеки")
+    rng = np.random.default_rng(5)
+    dates = [f'2024-01-{day:02d}' for day in rng.integers(1, 29, 50)]
+    names = np.array(['Смартфон', 'Ноутбук', 'Наушники'])[rng.integers(0, 3, 50)]
+    with db.writer() as conn:
+        main.insert_sales_rows(conn, [
+            (1, name, amount, date, 1)
+            for name, amount, date in zip(names.tolist(), (rng.random(50) * 1000).round(2).tolist(), dates)
+        ])
+    df = main.get_sales_data('2024-01-01', '2024-01-31')
+
+    # Выгрузка из DataFrame и потоковая выгрузка мелкими порциями читаются обратно без потерь
+    loaded = main.export_report(df, 'sales', export_format)
+    streamed = main.stream_report('sales', '2024-01-01', '2024-01-31', 'sales', export_format, chunk_rows=7)
+    try:
+        assert loaded.filename == f"sales.{main.EXPORTERS[export_format]['extension']}"
+        pd.testing.assert_frame_equal(plain(read_export(loaded)), plain(df))
+        pd.testing.assert_frame_equal(plain(read_export(streamed)), plain(df))
+    finally:
+        loaded.discard()
+        streamed.discard()
+
+
+def test_spill_buffer_moves_to_disk_after_threshold():
+    buffer = main.SpillBuffer('report.csv', threshold=10)
+    buffer.write(b'12345')
+    assert not buffer.spilled and isinstance(buffer.to_input_file(), main.BufferedInputFile)
+
+    buffer.write(b'67890abc')
+    assert buffer.spilled and buffer.size == 13
+    assert isinstance(buffer.to_input_file(), main.FSInputFile)
+    assert buffer_bytes(buffer) == b'1234567890abc'
+
+    path = buffer.path
+    buffer.discard()
+    assert not os.path.exists(path)
+
+
+def peak_memory(func, *args, **kwargs):
+    tracemalloc.start()
+    try:
+        result = func(*args, **kwargs)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def export_loaded(start_date, end_date):
+    return main.export_report(main.get_user_activity_data(start_date, end_date), 'activity', 'csv_gz')
+
+
+def test_streaming_export_memory_is_bounded(db, monkeypatch):
+    monkeypatch.setattr(main, 'SPILL_TO_DISK_BYTES', 256 * 1024)
+    main.generate_test_data(sales=0, days=365, users=1000, activity=ACTIONS)
+    today = datetime.date.today()
+    start_date, end_date = str(today - datetime.timedelta(days=400)), str(today)
+
+    streamed, streamed_peak = peak_memory(main.stream_report, 'activity', start_date, end_date, 'activity', 'csv', 5000)
+    loaded, loaded_peak = peak_memory(export_loaded, start_date, end_date)
+    try:
+        assert streamed.filename == 'activity.csv.gz' and streamed.spilled
+        lines = gzip.decompress(buffer_bytes(streamed)).decode('utf-8').splitlines()
+        assert len(lines) > ACTIONS // 2
+        assert lines == gzip.decompress(buffer_bytes(loaded)).decode('utf-8').splitlines()
+
+        # Память потоковой выгрузки определяется порцией и порогом буфера, а не размером отчета
+        assert streamed_peak < loaded_peak / 4
+        assert streamed_peak < 8 * 1024 * 1024
+    finally:
+        streamed.discard()
+        loaded.discard()
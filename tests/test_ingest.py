@@ -0,0 +1,87 @@
+import main
+
+
+def write_csv(path, lines):
+    path.write_text("product_name,amount,date,user_id\n" + "".join(line + "\n" for line in lines), encoding='utf-8')
+    return str(path)
+
+
+def sales_rows():
+    with main.db_pool.reader() as conn:
+        return conn.execute('''
+            SELECT p.product_name, s.amount, DATE(s.day * 86400, 'unixepoch'), s.user_id
+            FROM sales s JOIN products p ON p.product_key = s.product_key ORDER BY s.id
+        ''').fetchall()
+
+
+def sales_objects():
+    with main.db_pool.reader() as conn:
+        return sorted(conn.execute(
+            "SELECT type, name FROM sqlite_master WHERE tbl_name = 'sales' AND type IN ('index', 'trigger')"
+        ).fetchall())
+
+
+def test_ingest_skips_invalid_rows_and_resumes(db, tmp_path):
+    path = write_csv(tmp_path / 'sales.csv', [
+        "Смартфон,100,2024-01-10,1",
+        ",20,2024-01-10,2",
+        "Наушники,-5,2024-01-11,2",
+        "Ноутбук,250.5,2024-01-12,3",
+        "Планшет,abc,2024-01-12,4",
+        "Часы,80,не дата,5",
+        "Наушники,30,2024-01-13,",
+    ])
+
+    result = main.ingest_sales(path, chunk_rows=2)
+    assert (result['rows_done'], result['inserted'], result['rejected']) == (7, 3, 4)
+    assert sales_rows() == [
+        ('Смартфон', 100.0, '2024-01-10', 1),
+        ('Ноутбук', 250.5, '2024-01-12', 3),
+        ('Наушники', 30.0, '2024-01-13', None),
+    ]
+
+    # Повторный запуск продолжает с контрольной точки и не дублирует строки
+    result = main.ingest_sales(path, chunk_rows=2)
+    assert (result['rows_done'], result['inserted'], result['rejected']) == (7, 3, 4)
+    assert len(sales_rows()) == 3
+
+
+def test_ingest_with_rebuild_indexes_restores_indexes_and_rollup(db, tmp_path):
+    path = write_csv(tmp_path / 'sales.csv', [f"Смартфон,{10 + day},2024-01-{day:02d},{day}" for day in range(1, 11)])
+    objects = sales_objects()
+
+    result = main.ingest_sales(path, chunk_rows=4, rebuild_indexes=True)
+    assert result['inserted'] == 10
+    assert sales_objects() == objects
+
+    with main.db_pool.reader() as conn:
+        assert main.rollup_is_valid(conn, 'sales_daily')
+        assert conn.execute("SELECT COUNT(*) FROM ingest_dropped_objects").fetchone()[0] == 0
+    df = main.get_sales_data('2024-01-01', '2024-01-31')
+    assert df['total_amount'].sum() == sum(10 + day for day in range(1, 11))
+
+
+def test_ingest_invalidates_cache_of_other_process(db, monkeypatch, tmp_path):
+    path = tmp_path / 'sales.csv'
+    path.write_text(
+        "product_name,amount,date,user_id\n"
+        "Смартфон,100,2024-01-10,1\n"
+        "Наушники,-5,2024-01-11,2\n"
+        "Ноутбук,250.5,2024-01-12,3\n",
+        encoding='utf-8'
+    )
+
+    # Кэш бота уже содержит отчет за январь
+    bot_cache = main.QueryResultCache()
+    monkeypatch.setattr(main, 'query_cache', bot_cache)
+    assert main.get_sales_data('2024-01-01', '2024-01-31').empty
+
+    # Загрузка из командной строки работает в другом процессе со своим кэшем
+    monkeypatch.setattr(main, 'query_cache', main.QueryResultCache())
+    result = main.ingest_sales(str(path))
+    assert (result['inserted'], result['rejected']) == (2, 1)
+
+    monkeypatch.setattr(main, 'query_cache', bot_cache)
+    df = main.get_sales_data('2024-01-01', '2024-01-31')
+    assert sorted(df['product_name'].astype(str)) == ['Ноутбук', 'Смартфон']
+    assert df['total_amount'].sum() == 350.5
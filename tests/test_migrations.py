@@ -0,0 +1,71 @@
+import main
+
+ORIGINAL_MIGRATIONS = list(main.MIGRATIONS)
+
+
+def migrate(pool, monkeypatch, last_version):
+    monkeypatch.setattr(main, 'MIGRATIONS', [m for m in ORIGINAL_MIGRATIONS if m[0] <= last_version])
+    with pool.writer() as conn:
+        return [version for version, _ in main.run_migrations(conn)]
+
+
+def test_old_migrations_keep_their_steps():
+    steps = {version: step for version, _, step in main.MIGRATIONS}
+    assert steps[3] is main._create_rollups
+    assert steps[7] is main._partition_user_activity
+
+
+def test_upgrade_from_version_2(tmp_path, monkeypatch):
+    pool = main.DatabasePool(str(tmp_path / 'analytics.db'))
+    monkeypatch.setattr(main, 'db_pool', pool)
+    assert migrate(pool, monkeypatch, 2) == [1, 2]
+
+    with pool.writer() as conn:
+        conn.executemany(
+            "INSERT INTO sales (product_id, product_name, amount, date, user_id) VALUES (?, ?, ?, ?, ?)",
+            [(1, 'Смартфон', 100.0, '2024-01-31', 1), (1, 'Смартфон', 50.0, '2024-01-31', 2),
+             (2, 'Наушники', 30.0, '2024-02-01', 1)]
+        )
+        conn.executemany(
+            "INSERT INTO user_activity (user_id, action_type, action_date) VALUES (?, ?, ?)",
+            [(1, 'start', '2024-01-31 10:00:00'), (1, 'stats', '2024-01-31 11:00:00'),
+             (2, 'start', '2024-02-01 09:00:00')]
+        )
+
+    # Миграции 3 и 7 строят агрегированные таблицы и секции в прежней схеме
+    assert migrate(pool, monkeypatch, 7) == [3, 4, 5, 6, 7]
+    with pool.reader() as conn:
+        assert conn.execute(
+            "SELECT date, product_name, total_amount, sales_count FROM sales_daily ORDER BY date"
+        ).fetchall() == [('2024-01-31', 'Смартфон', 150.0, 2), ('2024-02-01', 'Наушники', 30.0, 1)]
+        assert conn.execute("SELECT name FROM activity_partitions ORDER BY month").fetchall() == [
+            ('user_activity_202401',), ('user_activity_202402',)]
+        assert conn.execute("SELECT COUNT(*) FROM user_activity").fetchone()[0] == 3
+
+    # Миграция 8 переводит получившуюся схему в текущую
+    assert migrate(pool, monkeypatch, 8) == [8]
+    with pool.reader() as conn:
+        assert conn.execute('''
+            SELECT s.day, p.product_name, s.total_amount, s.sales_count
+            FROM sales_daily s JOIN products p ON p.product_key = s.product_key ORDER BY s.day
+        ''').fetchall() == [
+            (main.epoch_day('2024-01-31'), 'Смартфон', 150.0, 2),
+            (main.epoch_day('2024-02-01'), 'Наушники', 30.0, 1),
+        ]
+        assert conn.execute('''
+            SELECT u.day, u.user_id, a.action_type, u.action_count
+            FROM activity_daily u JOIN action_types a ON a.action_key = u.action_key ORDER BY 1, 2, 3
+        ''').fetchall() == [
+            (main.epoch_day('2024-01-31'), 1, 'start', 1),
+            (main.epoch_day('2024-01-31'), 1, 'stats', 1),
+            (main.epoch_day('2024-02-01'), 2, 'start', 1),
+        ]
+        assert conn.execute("SELECT COUNT(*) FROM user_activity").fetchone()[0] == 3
+    pool.close_all()
+
+
+def test_fresh_database_reaches_current_version(db):
+    with db.reader() as conn:
+        versions = [version for (version,) in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+        assert versions == [version for version, _, _ in main.MIGRATIONS]
+        assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'user_activity'").fetchone() == ('user_activity',)
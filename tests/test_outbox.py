@@ -0,0 +1,85 @@
+import asyncio
+import time
+
+import main
+
+
+def run_outbox(fake_bot_api, monkeypatch, sends, **settings):
+    """
+    Отправляет сообщения через новую очередь отправки в поддельный Bot API.
+    sends - список пар (чат, текст); возвращает очередь после остановки.
+    """
+    async def scenario():
+        await fake_bot_api.start()
+        bot = fake_bot_api.bot()
+        monkeypatch.setattr(main, 'bot', bot)
+        outbox = main.TelegramOutbox(**settings)
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(outbox.send_message(chat_id, text) for chat_id, text in sends)),
+                timeout=20
+            )
+        finally:
+            await outbox.stop()
+            await bot.session.close()
+            await fake_bot_api.stop()
+        return outbox
+
+    return asyncio.run(scenario())
+
+
+def sent_by_chat(fake_bot_api):
+    result = {}
+    for (method, data), received_at in zip(fake_bot_api.calls, fake_bot_api.received_at):
+        if method == 'sendMessage':
+            result.setdefault(int(data['chat_id']), []).append((data['text'], received_at))
+    return result
+
+
+def test_retry_after_pauses_whole_queue(fake_bot_api, monkeypatch):
+    flooded = []
+
+    def send_message(data):
+        if data['text'] == 'a1' and not flooded:
+            flooded.append(time.monotonic())
+            return {
+                'ok': False,
+                'error_code': 429,
+                'description': 'Too Many Requests: retry after 1',
+                'parameters': {'retry_after': 1},
+            }
+        return None
+
+    fake_bot_api.handlers['sendMessage'] = send_message
+    sends = [(1, f'a{i}') for i in range(1, 4)] + [(2, f'b{i}') for i in range(1, 4)]
+    outbox = run_outbox(fake_bot_api, monkeypatch, sends, workers=4, global_rate=100, chat_rate=100, chat_burst=10)
+
+    assert outbox.metrics()['flood_pauses'] == 1
+    assert outbox.sent == 6 and outbox.retries == 1 and outbox.failed == 0
+
+    chats = sent_by_chat(fake_bot_api)
+    # Повтор остается первым в своем чате: порядок сообщений не меняется
+    assert [text for text, _ in chats[1]] == ['a1', 'a1', 'a2', 'a3']
+    assert [text for text, _ in chats[2]] == ['b1', 'b2', 'b3']
+
+    # Пока действует пауза, в Telegram не уходит ничего, в том числе в другие чаты
+    # (кроме запросов, которые уже выполнялись одновременно с получившим 429)
+    during_pause = [
+        received_at for messages in chats.values() for _, received_at in messages
+        if flooded[0] + 0.1 < received_at < flooded[0] + 0.9
+    ]
+    assert during_pause == []
+
+
+def test_slow_chat_does_not_block_other_chats(fake_bot_api, monkeypatch):
+    # Чат 1 ограничен одним сообщением в секунду; обработчиков меньше, чем его сообщений
+    sends = [(1, f'a{i}') for i in range(1, 4)] + [(chat_id, 'hello') for chat_id in range(2, 12)]
+    outbox = run_outbox(fake_bot_api, monkeypatch, sends, workers=2, global_rate=1000, chat_rate=1, chat_burst=1)
+
+    assert outbox.sent == len(sends)
+    chats = sent_by_chat(fake_bot_api)
+    assert [text for text, _ in chats[1]] == ['a1', 'a2', 'a3']
+
+    # Сообщения в остальные чаты уходят, пока чат 1 ждет маркеры
+    second_message_at = chats[1][1][1]
+    assert all(messages[0][1] < second_message_at for chat_id, messages in chats.items() if chat_id != 1)
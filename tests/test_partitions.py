@@ -0,0 +1,79 @@
+import csv
+import datetime
+import gzip
+
+import pandas as pd
+
+import main
+
+
+def activity_rows(month, count):
+    return [
+        (user_id % 3 + 1, ('start', 'report', 'stats')[user_id % 3], f"{month}-{day:02d} {hour:02d}:30:00", None)
+        for user_id, (day, hour) in enumerate((index % 28 + 1, index % 24) for index in range(count))
+    ]
+
+
+def table_count(conn, name):
+    return conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+
+
+def read_january():
+    main.query_cache.invalidate('activity')
+    df = main.get_user_activity_data('2024-01-01', '2024-01-31')
+    return df.sort_values(['action_date', 'user_id', 'action_type']).reset_index(drop=True)
+
+
+def test_activity_rows_are_routed_to_monthly_partitions(db):
+    main.write_activity_batch(activity_rows('2024-01', 30) + activity_rows('2024-02', 20) + activity_rows('2024-03', 10))
+
+    with db.reader() as conn:
+        assert main.activity_partition_names(conn) == [
+            'user_activity_202401', 'user_activity_202402', 'user_activity_202403'
+        ]
+        counts = [table_count(conn, name) for name in main.activity_partition_names(conn)]
+        assert counts == [30, 20, 10]
+        assert table_count(conn, 'user_activity') == 60
+
+        # Запрос за период читает только секции нужных месяцев
+        assert main.activity_source(conn, '2024-02-01', '2024-02-29') == 'user_activity_202402'
+        source = main.activity_source(conn, '2024-01-15', '2024-02-10')
+        assert 'user_activity_202401' in source and 'user_activity_202402' in source
+        assert 'user_activity_202403' not in source
+
+
+def test_retention_compacts_archives_and_keeps_reports(db, tmp_path):
+    for user_id in range(1, 4):
+        main.register_user(user_id, f'user{user_id}', 'Имя', None)
+    january = activity_rows('2024-01', 50)
+    main.write_activity_batch(january + activity_rows('2024-02', 20) + activity_rows('2024-03', 10))
+    before = read_january()
+
+    # Хранятся два полных месяца до текущего: январь сжимается, февраль остается
+    compacted = main.apply_activity_retention(
+        today=datetime.date(2024, 4, 15), retention_months=2, archive_dir=str(tmp_path)
+    )
+    assert compacted == ['2024-01']
+
+    with db.reader() as conn:
+        assert main.activity_partition_names(conn) == ['user_activity_202402', 'user_activity_202403']
+        state = conn.execute(
+            "SELECT state, row_count, archive_path FROM activity_partitions WHERE month = '2024-01'"
+        ).fetchone()
+        assert table_count(conn, 'user_activity') == 30
+    assert state[:2] == ('compacted', 50)
+
+    with gzip.open(state[2], 'rt', encoding='utf-8', newline='') as archive:
+        archived = list(csv.DictReader(archive))
+    assert [(int(row['user_id']), row['action_type'], row['action_date']) for row in archived] == [
+        (user_id, action_type, action_date) for user_id, action_type, action_date, _ in january
+    ]
+
+    # Отчеты за сжатый месяц строятся по дневным итогам и не меняются
+    pd.testing.assert_frame_equal(read_january(), before, check_categorical=False)
+
+    # Поздние действия за сжатый месяц попадают только в дневные итоги
+    main.write_activity_batch([(1, 'start', '2024-01-01 12:00:00', None)])
+    after = read_january()
+    assert after['action_count'].sum() == before['action_count'].sum() + 1
+    assert main.apply_activity_retention(today=datetime.date(2024, 4, 15), retention_months=2) == []
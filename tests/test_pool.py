@@ -0,0 +1,75 @@
+import threading
+
+import pytest
+
+import main
+
+THREADS = 8
+BATCHES = 30
+EVENTS = 20
+
+
+def test_connections_are_reused(db):
+    with db.reader() as first, db.reader() as nested:
+        assert first is nested
+    with db.reader() as again:
+        assert again is first
+    with db.writer() as writer, db.writer() as nested_writer:
+        assert writer is nested_writer
+    assert first.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+
+
+def test_writer_rolls_back_on_error(db):
+    with pytest.raises(RuntimeError):
+        with db.writer() as conn:
+            main.insert_sales_rows(conn, [(1, 'Смартфон', 100.0, '2024-01-01', 1)])
+            # Вложенная запись относится к той же транзакции и откатывается вместе с ней
+            with db.writer() as nested:
+                main.insert_sales_rows(nested, [(2, 'Ноутбук', 200.0, '2024-01-01', 1)])
+            raise RuntimeError
+
+    with db.writer() as conn:
+        main.insert_sales_rows(conn, [(3, 'Наушники', 30.0, '2024-01-02', 1)])
+    assert main.get_sales_data('2024-01-01', '2024-01-31')['product_name'].tolist() == ['Наушники']
+
+
+def test_writer_pool_under_concurrent_load(db):
+    errors = []
+    start = threading.Barrier(THREADS + 2)
+
+    def writer(index):
+        try:
+            start.wait()
+            for batch in range(BATCHES):
+                user_id = index * 1000 + batch
+                main.register_user(user_id, f'user{user_id}', 'Имя', None)
+                main.register_user(user_id, f'user{user_id}', 'Имя', None)
+                for _ in range(EVENTS):
+                    main.log_user_activity(user_id, 'stats')
+        except Exception as e:
+            errors.append(e)
+
+    def reader():
+        try:
+            start.wait()
+            for _ in range(BATCHES):
+                main.get_user_activity_data('2000-01-01', '2100-12-31')
+                main.get_sales_data('2000-01-01', '2100-12-31')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(index,)) for index in range(THREADS)]
+    threads += [threading.Thread(target=reader) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    with db.reader() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM users").fetchone()[0] == THREADS * BATCHES
+        assert conn.execute("SELECT COUNT(*) FROM user_activity").fetchone()[0] == THREADS * BATCHES * EVENTS
+
+    # Повторная регистрация с тем же профилем не пишет в базу; счетчики не теряют обновлений
+    metrics = main.known_users.metrics()
+    assert metrics['writes'] == THREADS * BATCHES and metrics['skipped_writes'] == THREADS * BATCHES
@@ -0,0 +1,103 @@
+import datetime
+
+import pandas as pd
+
+import main
+
+
+def frame(rows):
+    return pd.DataFrame({'value': range(rows)})
+
+
+def insert_sale(pool, date, amount):
+    with pool.writer() as conn:
+        main.insert_sales_rows(conn, [(1, 'Смартфон', amount, date, 1)])
+
+
+def test_repeated_report_is_served_from_cache(db):
+    insert_sale(db, '2024-01-10', 100.0)
+
+    first = main.get_sales_data('2024-01-01', '2024-01-31')
+    # Изменение возвращенной копии не портит закэшированный результат
+    first['total_amount'] = 0
+    second = main.get_sales_data('2024-01-01', '2024-01-31')
+
+    assert second['total_amount'].tolist() == [100.0]
+    assert main.query_cache.metrics()['misses'] == 1
+    assert main.query_cache.metrics()['hits'] == 1
+
+    # Пересоздание тестовых данных сбрасывает все результаты по продажам
+    main.generate_test_data()
+    assert main.query_cache.metrics()['entries'] == 0
+
+
+def test_activity_write_drops_only_ranges_with_its_dates(db):
+    main.register_user(1, 'alice', 'Алиса', None)
+    main.write_activity_batch([(1, 'start', '2024-01-10 10:00:00', None)])
+    assert len(main.get_user_activity_data('2024-01-01', '2024-01-31')) == 1
+    assert len(main.get_user_activity_data('2024-03-01', '2024-03-31')) == 0
+
+    # Запись вне закэшированного января не трогает его
+    main.write_activity_batch([(1, 'stats', '2024-02-15 10:00:00', None)])
+    assert main.query_cache.metrics()['invalidations'] == 0
+    assert len(main.get_user_activity_data('2024-01-01', '2024-01-31')) == 1
+    assert main.query_cache.metrics()['hits'] == 1
+
+    # Запись внутри диапазона удаляет только его
+    main.write_activity_batch([(1, 'report', '2024-01-20 10:00:00', None)])
+    metrics = main.query_cache.metrics()
+    assert (metrics['invalidations'], metrics['entries']) == (1, 1)
+    assert len(main.get_user_activity_data('2024-01-01', '2024-01-31')) == 2
+    assert main.query_cache.metrics()['misses'] == 3
+
+    # Смена имени пользователя меняет отчеты за все периоды
+    main.register_user(1, 'alice_new', 'Алиса', None)
+    assert main.query_cache.metrics()['entries'] == 0
+
+
+def test_stale_result_is_not_cached():
+    cache = main.QueryResultCache()
+    generation = cache.generation('sales')
+    cache.invalidate('sales', ['2024-01-05'])
+
+    cache.put(('sales', '2024-01-01', '2024-01-31'), frame(3), generation)
+    assert cache.get(('sales', '2024-01-01', '2024-01-31')) is None
+
+
+def test_least_recently_used_entries_are_evicted():
+    size = int(frame(100).memory_usage(deep=True).sum())
+    cache = main.QueryResultCache(max_bytes=size * 2)
+    keys = [('sales', f'2024-0{month}-01', f'2024-0{month}-28') for month in range(1, 4)]
+
+    cache.put(keys[0], frame(100), 0)
+    cache.put(keys[1], frame(100), 0)
+    assert cache.get(keys[0]) is not None
+    cache.put(keys[2], frame(100), 0)
+
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None and cache.get(keys[2]) is not None
+    metrics = cache.metrics()
+    assert (metrics['entries'], metrics['bytes'], metrics['evictions']) == (2, size * 2, 1)
+
+    # Результат больше всего бюджета не сохраняется
+    cache.put(('sales', '2023-01-01', '2023-12-31'), frame(1000), 0)
+    assert cache.metrics()['entries'] == 2
+
+
+def test_only_open_ranges_expire(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(main.time, 'monotonic', lambda: now[0])
+    cache = main.QueryResultCache(open_ttl=30)
+    today = datetime.date.today()
+    open_key = ('activity', (today - datetime.timedelta(days=7)).isoformat(), today.isoformat())
+    closed_key = ('activity', '2024-01-01', '2024-01-31')
+    cache.put(open_key, frame(3), 0)
+    cache.put(closed_key, frame(3), 0)
+
+    now[0] += 29
+    assert cache.get(open_key) is not None
+
+    now[0] += 2
+    assert cache.get(open_key) is None
+    now[0] += 365 * 86400
+    assert cache.get(closed_key) is not None
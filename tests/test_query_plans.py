@@ -0,0 +1,43 @@
+import pytest
+
+import main
+
+
+def query_plan(conn, query, start_date, end_date):
+    if '{activity}' in query:
+        query = query.format(activity=main.activity_source(conn, start_date, end_date))
+    # Журнал активности фильтруется по секундам, остальные таблицы - по номерам дней
+    period = main.period_seconds if 'action_ts' in query else main.period_days
+    params = period(start_date, end_date)
+    return [row[-1] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}", params)]
+
+
+@pytest.mark.parametrize('months', [['2024-01'], ['2023-12', '2024-01', '2024-02']])
+def test_report_queries_do_not_scan_tables(db, months):
+    with db.writer() as conn:
+        main.ensure_activity_partitions(conn, months)
+
+    with db.reader() as conn:
+        for name, (query, _) in main.REPORT_QUERIES.items():
+            plan = query_plan(conn, query, f"{months[0]}-01", f"{months[-1]}-28")
+            scans = [step for step in plan if step.startswith(('SCAN sales', 'SCAN user_activity'))]
+            assert not scans, f"{name}: {plan}"
+
+    assert main.check_query_plans() == []
+
+
+def test_check_query_plans_reports_missing_index(db):
+    with db.writer() as conn:
+        conn.execute("DROP INDEX idx_sales_day_product_amount")
+    # Закэшированные выражения EXPLAIN не перестраиваются после изменения схемы
+    db.close_all()
+
+    problems = main.check_query_plans()
+    assert problems and all(problem.startswith('sales: SCAN') for problem in problems)
+
+
+def test_migrations_are_applied_once(db):
+    with db.writer() as conn:
+        assert main.run_migrations(conn) == []
+        versions = [row[0] for row in conn.execute("SELECT version FROM schema_version ORDER BY version")]
+    assert versions == [version for version, _, _ in main.MIGRATIONS]
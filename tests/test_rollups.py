@@ -0,0 +1,123 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+
+def sales_rollup(conn):
+    return conn.execute(
+        "SELECT day, product_key, total_amount, sales_count FROM sales_daily ORDER BY day, product_key"
+    ).fetchall()
+
+
+def sales_grouped(conn):
+    return conn.execute('''
+        SELECT day, product_key, SUM(amount), COUNT(*) FROM sales
+        GROUP BY day, product_key ORDER BY day, product_key
+    ''').fetchall()
+
+
+def activity_rollup(conn):
+    return conn.execute(
+        "SELECT day, user_id, action_key, action_count FROM activity_daily ORDER BY day, user_id, action_key"
+    ).fetchall()
+
+
+def activity_grouped(conn):
+    return conn.execute('''
+        SELECT action_ts / 86400, user_id, action_key, COUNT(*) FROM user_activity
+        GROUP BY action_ts / 86400, user_id, action_key ORDER BY 1, 2, 3
+    ''').fetchall()
+
+
+def assert_rollups_consistent(pool):
+    with pool.reader() as conn:
+        rollup, grouped = sales_rollup(conn), sales_grouped(conn)
+        assert [row[:2] + row[3:] for row in rollup] == [row[:2] + row[3:] for row in grouped]
+        assert [row[2] for row in rollup] == pytest.approx([row[2] for row in grouped])
+        assert activity_rollup(conn) == activity_grouped(conn)
+
+
+def random_rows(rng, size, start):
+    dates = [(start + datetime.timedelta(days=int(d))).strftime('%Y-%m-%d') for d in rng.integers(0, 40, size)]
+    names = np.array(['Смартфон', 'Ноутбук', 'Наушники'])[rng.integers(0, 3, size)]
+    sales = [(1, str(name), round(float(amount), 2), date, int(user))
+             for name, amount, date, user in zip(names, rng.random(size) * 1000, dates, rng.integers(1, 6, size))]
+    actions = np.array(['start', 'report', 'stats'])[rng.integers(0, 3, size)]
+    activity = [(int(user), str(action), f"{date} {int(hour):02d}:15:00", None)
+                for user, action, date, hour in zip(rng.integers(1, 6, size), actions, dates, rng.integers(0, 24, size))]
+    return sales, activity
+
+
+def test_rollups_match_raw_tables(db):
+    rng = np.random.default_rng(7)
+    sales, activity = random_rows(rng, 300, datetime.date(2024, 3, 1))
+    with db.writer() as conn:
+        main.insert_sales_rows(conn, sales)
+    main.write_activity_batch(activity)
+    assert_rollups_consistent(db)
+
+    # Задним числом: строки за уже прошедшие дни и за более ранние месяцы
+    backdated_sales, backdated_activity = random_rows(rng, 100, datetime.date(2024, 1, 10))
+    with db.writer() as conn:
+        main.insert_sales_rows(conn, backdated_sales)
+    main.write_activity_batch(backdated_activity)
+    assert_rollups_consistent(db)
+
+    # Удаление части строк, в том числе всех строк за отдельные дни
+    first_day = main.epoch_day('2024-03-01')
+    with db.writer() as conn:
+        conn.execute("DELETE FROM sales WHERE id % 3 = 0 OR day = ?", (first_day,))
+        main.delete_activity_rows(conn, "id % 4 = 0 OR action_ts / 86400 = ?", (first_day,))
+    assert_rollups_consistent(db)
+
+    with db.reader() as conn:
+        assert all(row[0] != first_day for row in sales_rollup(conn))
+        assert all(row[0] != first_day for row in activity_rollup(conn))
+        before = sales_rollup(conn), activity_rollup(conn)
+
+    main.rebuild_rollups()
+    with db.reader() as conn:
+        assert activity_rollup(conn) == before[1]
+        assert [row[3] for row in sales_rollup(conn)] == [row[3] for row in before[0]]
+
+
+def read_reports():
+    main.query_cache.invalidate('sales')
+    main.query_cache.invalidate('activity')
+    sales = main.get_sales_data('2024-01-01', '2024-12-31')
+    activity = main.get_user_activity_data('2024-01-01', '2024-12-31')
+    summary = main.get_activity_summary('2024-01-01', '2024-12-31', 'год')
+    return (
+        sales.sort_values(['date', 'product_name']).reset_index(drop=True),
+        activity.sort_values(['action_date', 'user_id', 'action_type']).reset_index(drop=True),
+        summary,
+    )
+
+
+def test_reports_read_rollups_transparently(db):
+    rng = np.random.default_rng(11)
+    sales, activity = random_rows(rng, 500, datetime.date(2024, 2, 1))
+    for user_id in range(1, 6):
+        main.register_user(user_id, f'user{user_id}', 'Имя', None)
+    with db.writer() as conn:
+        main.insert_sales_rows(conn, sales)
+    main.write_activity_batch(activity)
+
+    with db.reader() as conn:
+        assert main.select_report_query(conn, 'sales', '2024-01-01', '2024-12-31')[0] is main.SALES_ROLLUP_QUERY
+        assert main.select_report_query(conn, 'activity', '2024-01-01', '2024-12-31')[0] is main.USER_ACTIVITY_ROLLUP_QUERY
+    from_rollups = read_reports()
+
+    with db.writer() as conn:
+        conn.execute("UPDATE rollup_state SET valid = 0")
+    with db.reader() as conn:
+        assert main.select_report_query(conn, 'sales', '2024-01-01', '2024-12-31')[0] is main.SALES_DATA_QUERY
+    from_raw = read_reports()
+
+    pd.testing.assert_frame_equal(from_rollups[0], from_raw[0], check_categorical=False)
+    pd.testing.assert_frame_equal(from_rollups[1], from_raw[1], check_categorical=False)
+    assert from_rollups[2] == from_raw[2]
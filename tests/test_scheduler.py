@@ -0,0 +1,171 @@
+import asyncio
+import datetime
+
+import pytest
+
+import main
+
+
+class FakeClock:
+    """
+    Часы планировщика: сегодняшняя дата (тестовые данные строятся от нее)
+    со сдвигом на days дней и заданным временем.
+    """
+
+    def __init__(self):
+        self.now = None
+
+    def at(self, hour, minute=0, days=0):
+        date = datetime.date.today() + datetime.timedelta(days=days)
+        self.now = datetime.datetime.combine(date, datetime.time(hour, minute))
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(db, monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, 'chart_cache', main.ChartCache(disk_dir=str(tmp_path / 'charts')))
+    main.generate_test_data(sales=300, days=10, users=5, activity=100)
+    return FakeClock()
+
+
+def run_scheduler(fake_bot_api, monkeypatch, scenario):
+    """
+    Выполняет сценарий scenario() с ботом и очередью отправки, направленными
+    в поддельный Bot API.
+    """
+    async def run():
+        await fake_bot_api.start()
+        bot = fake_bot_api.bot()
+        monkeypatch.setattr(main, 'bot', bot)
+        monkeypatch.setattr(main, 'outbox', main.TelegramOutbox(chat_rate=1000, chat_burst=1000))
+        try:
+            return await asyncio.wait_for(scenario(), timeout=60)
+        finally:
+            await main.outbox.stop()
+            await bot.session.close()
+            await fake_bot_api.stop()
+
+    return asyncio.run(run())
+
+
+def artifact_dates():
+    with main.db_pool.reader() as conn:
+        return [row[0] for row in conn.execute("SELECT created_at FROM report_artifacts ORDER BY created_at")]
+
+
+def insert_stale_artifact():
+    with main.db_pool.writer() as conn:
+        conn.execute(
+            '''
+            INSERT INTO report_artifacts (report_type, start_date, end_date, export_format, fingerprint, created_at)
+            VALUES ('sales', '2000-01-01', '2000-01-01', 'csv', '', '2000-01-01 00:00:00')
+            '''
+        )
+
+
+def test_precompute_and_retention_run_only_in_window(clock, fake_bot_api, monkeypatch):
+    insert_stale_artifact()
+    scheduler = main.ReportScheduler(clock=clock, export_formats=('csv',))
+
+    async def scenario():
+        ran = []
+        for hour, minute, days in ((3, 59, 0), (4, 30, 0), (6, 59, 0), (3, 0, 1), (4, 0, 1)):
+            clock.at(hour, minute, days)
+            ran.append(await scheduler.tick())
+            if (hour, minute, days) == (3, 59, 0):
+                assert artifact_dates() == ['2000-01-01 00:00:00']
+        return ran
+
+    ran = run_scheduler(fake_bot_api, monkeypatch, scenario)
+    assert ran == [[], ['precompute', 'retention'], [], [], ['precompute', 'retention']]
+
+    # Устаревшая выгрузка удалена, отчеты за стандартные периоды построены заранее
+    dates = artifact_dates()
+    assert dates and '2000-01-01 00:00:00' not in dates
+    assert scheduler.artifacts >= len(dates) and scheduler.precomputed > 0
+    assert fake_bot_api.calls == []
+
+
+def test_missed_delivery_runs_later_the_same_day(clock, fake_bot_api, monkeypatch):
+    main.add_subscription(1, 'sales', 'day')
+    scheduler = main.ReportScheduler(clock=clock)
+
+    async def scenario():
+        ran = []
+        # Бот не работал в 8:00 и запустился только в 15:00
+        for hour, days in ((7, 0), (15, 0), (23, 0), (7, 1), (8, 1)):
+            clock.at(hour, 0, days)
+            ran.append(await scheduler.tick())
+        return ran
+
+    ran = run_scheduler(fake_bot_api, monkeypatch, scenario)
+    assert ran == [[], ['delivery'], [], [], ['delivery']]
+    assert [int(data['chat_id']) for data in fake_bot_api.sent('sendDocument')] == [1, 1]
+    assert scheduler.delivered == 2 and scheduler.failed == 0
+
+
+def test_each_job_runs_once_per_date_across_instances(clock, fake_bot_api, monkeypatch):
+    main.add_subscription(1, 'sales', 'day')
+    # Процессы-обработчики работают с одной базой и проверяют задания одновременно
+    schedulers = [main.ReportScheduler(clock=clock, export_formats=('csv',)) for _ in range(2)]
+
+    async def scenario():
+        ran = []
+        for hour in (4, 5, 8, 9):
+            clock.at(hour)
+            results = await asyncio.gather(*(scheduler.tick() for scheduler in schedulers))
+            ran.append(sorted(job for jobs in results for job in jobs))
+        return ran
+
+    ran = run_scheduler(fake_bot_api, monkeypatch, scenario)
+    assert ran == [['precompute', 'retention'], [], ['delivery'], []]
+    assert len(fake_bot_api.sent('sendDocument')) == 1
+
+
+def test_delivery_uploads_each_file_once(clock, fake_bot_api, monkeypatch):
+    for user_id in (1, 2, 3):
+        main.add_subscription(user_id, 'sales', 'day')
+    scheduler = main.ReportScheduler(clock=clock)
+
+    async def scenario():
+        clock.at(8)
+        return await scheduler.tick()
+
+    assert run_scheduler(fake_bot_api, monkeypatch, scenario) == ['delivery']
+
+    # Первая отправка загружает файл, остальные подписчики получают его по file_id
+    for method, field, prefix in (('sendPhoto', 'photo', 'photo-'), ('sendDocument', 'document', 'document-')):
+        sent = fake_bot_api.sent(method)
+        assert sorted(int(data['chat_id']) for data in sent) == [1, 2, 3]
+        assert sent[0][field].startswith('attach://')
+        assert sent[1][field] == sent[2][field] and sent[1][field].startswith(prefix)
+    assert scheduler.delivered == 3
+
+
+def test_failed_job_is_retried_at_next_tick(clock, fake_bot_api, monkeypatch):
+    main.add_subscription(1, 'sales', 'day')
+    scheduler = main.ReportScheduler(clock=clock)
+    get_due_subscriptions = main.get_due_subscriptions
+    failures = [RuntimeError('база недоступна')]
+
+    def flaky_get_due_subscriptions(today):
+        if failures:
+            raise failures.pop()
+        return get_due_subscriptions(today)
+
+    monkeypatch.setattr(main, 'get_due_subscriptions', flaky_get_due_subscriptions)
+
+    async def scenario():
+        ran = []
+        for minute in (0, 1, 2):
+            clock.at(8, minute)
+            ran.append(await scheduler.tick())
+        return ran
+
+    # Отметка о запуске снимается после ошибки, и рассылка выполняется при следующей проверке
+    assert run_scheduler(fake_bot_api, monkeypatch, scenario) == [[], ['delivery'], []]
+    assert [int(data['chat_id']) for data in fake_bot_api.sent('sendDocument')] == [1]
+    assert scheduler.metrics()['last_runs'] == {'delivery': datetime.date.today().strftime("%Y-%m-%d")}
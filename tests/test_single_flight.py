@@ -0,0 +1,155 @@
+import asyncio
+import threading
+
+import pandas as pd
+
+import main
+
+REQUESTS = 20
+
+
+async def gather_same(flights, key, func, *args):
+    return await asyncio.gather(
+        *(flights.do(key, func, *args) for _ in range(REQUESTS)),
+        return_exceptions=True
+    )
+
+
+def test_identical_requests_compute_once():
+    flights = main.SingleFlight()
+    calls = []
+
+    async def compute(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return {'value': value}
+
+    results = asyncio.run(gather_same(flights, ('report', 'sales'), compute, 42))
+
+    assert calls == [42]
+    assert all(result is results[0] for result in results)
+    assert flights.metrics()['by_kind'] == {'report': {'calls': REQUESTS, 'shared': REQUESTS - 1}}
+    assert flights.metrics()['in_flight'] == 0
+
+
+def test_error_reaches_every_waiter():
+    flights = main.SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        raise RuntimeError('база недоступна')
+
+    results = asyncio.run(gather_same(flights, ('stats', 'sales'), compute))
+
+    assert len(calls) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flights.metrics()['in_flight'] == 0
+
+
+def test_cancelled_waiter_does_not_cancel_others():
+    flights = main.SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.02)
+        return 'готово'
+
+    async def scenario():
+        waiters = [asyncio.ensure_future(flights.do(('report',), compute)) for _ in range(3)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()
+        return await asyncio.gather(*waiters, return_exceptions=True)
+
+    results = asyncio.run(scenario())
+    assert isinstance(results[0], asyncio.CancelledError)
+    assert results[1:] == ['готово', 'готово']
+
+
+def test_shared_result_released_once_after_last_user():
+    flights = main.SingleFlight()
+    released = []
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        return 'буфер'
+
+    async def use():
+        async with flights.share(('export',), compute, release=released.append) as value:
+            await asyncio.sleep(0.01)
+            assert released == []
+            return value
+
+    async def scenario():
+        return await asyncio.gather(*(use() for _ in range(5)))
+
+    results = asyncio.run(scenario())
+    assert results == ['буфер'] * 5
+    assert released == ['буфер']
+
+
+def test_concurrent_sales_stats_load_data_once(db, monkeypatch):
+    monkeypatch.setattr(main, 'request_flights', main.SingleFlight())
+    loads = []
+    lock = threading.Lock()
+
+    def get_sales_data(start_date, end_date):
+        with lock:
+            loads.append((start_date, end_date))
+        return pd.DataFrame({
+            'product_name': pd.Categorical(['Смартфон', 'Наушники']),
+            'total_amount': [100.0, 30.0],
+            'sales_count': [1, 2],
+            'date': pd.to_datetime(['2024-01-01', '2024-01-02']),
+        })
+
+    monkeypatch.setattr(main, 'get_sales_data', get_sales_data)
+    key = ('stats', 'sales', '2024-01-01', '2024-01-31', 'январь')
+    results = asyncio.run(gather_same(
+        main.request_flights, key, main.prepare_sales_stats, '2024-01-01', '2024-01-31', 'январь'
+    ))
+
+    assert loads == [('2024-01-01', '2024-01-31')]
+    assert all(result is results[0] for result in results)
+    assert results[0][1] is not None
+
+
+def test_concurrent_report_loads_share_one_query(db, monkeypatch):
+    monkeypatch.setattr(main, 'request_flights', main.SingleFlight())
+    loads = []
+    gate = threading.Event()
+
+    def get_sales_data(start_date, end_date):
+        loads.append(start_date)
+        gate.wait(5)
+        return pd.DataFrame({'total_amount': [1.0]})
+
+    async def scenario():
+        waiters = asyncio.gather(*(
+            main.load_shared(get_sales_data, '2024-01-01', '2024-01-31') for _ in range(REQUESTS)
+        ))
+        await asyncio.sleep(0.05)
+        gate.set()
+        return await waiters
+
+    results = asyncio.run(scenario())
+    assert loads == ['2024-01-01']
+    assert all(result is results[0] for result in results)
+
+
+def test_different_keys_compute_separately():
+    keys = [('report', 'sales'), ('report', 'activity')]
+    flights = main.SingleFlight()
+    calls = []
+
+    async def compute(key):
+        calls.append(key)
+        await asyncio.sleep(0.01)
+        return key
+
+    async def scenario():
+        return await asyncio.gather(*(flights.do(key, compute, key) for key in keys for _ in range(3)))
+
+    results = asyncio.run(scenario())
+    assert sorted(calls) == sorted(keys)
+    assert results == [key for key in keys for _ in range(3)]
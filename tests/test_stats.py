@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import main
+
+
+def sales_frame(rows):
+    df = pd.DataFrame(rows, columns=['product_name', 'total_amount', 'sales_count', 'date'])
+    df['date'] = pd.to_datetime(df['date'])
+    df['product_name'] = pd.Categorical(df['product_name'], categories=['Наушники', 'Смартфон'])
+    return df
+
+
+def test_grouped_sums_skips_null_keys():
+    keys = pd.Series(['b', None, 'a', 'b'])
+    uniques, sums = main._grouped_sums(keys, np.array([1.0, 100.0, 2.0, 3.0]))
+    assert list(uniques) == ['a', 'b']
+    assert sums.tolist() == [2.0, 4.0]
+
+
+def test_summarize_sales_with_null_product():
+    # Продажа без товара в первый день давала индекс -1 и ошибку bincount
+    df = sales_frame([
+        (None, 50.0, 1, '2024-01-01'),
+        ('Смартфон', 100.0, 1, '2024-01-01'),
+        ('Наушники', 30.0, 2, '2024-01-02'),
+        (None, 20.0, 1, '2024-01-02'),
+    ])
+    summary = main.summarize_sales(df, 'период')
+
+    assert summary.total_amount == pytest.approx(200.0)
+    assert summary.sales_count == 5
+    assert summary.days == 2
+    assert summary.best_day == ('2024-01-01', pytest.approx(150.0))
+    assert [(name, amount) for name, amount, _ in summary.products] == [('Смартфон', 100.0), ('Наушники', 30.0)]
+
+
+def test_summarize_sales_matches_groupby():
+    rng = np.random.default_rng(1)
+    names = np.array(['Наушники', 'Смартфон', None], dtype=object)
+    df = sales_frame(list(zip(
+        names[rng.integers(0, 3, 200)],
+        rng.random(200) * 100,
+        rng.integers(1, 5, 200),
+        pd.date_range('2024-01-01', periods=10).strftime('%Y-%m-%d')[rng.integers(0, 10, 200)],
+    )))
+    summary = main.summarize_sales(df, 'период')
+
+    expected = df.groupby('product_name', observed=True)['total_amount'].sum().sort_values(ascending=False)
+    assert [name for name, _, _ in summary.products] == list(expected.index)
+    assert [amount for _, amount, _ in summary.products] == pytest.approx(expected.tolist())
+    assert summary.total_amount == pytest.approx(df['total_amount'].sum())
+
+
+@pytest.mark.parametrize('use_rollup', [True, False])
+def test_activity_summary_groups_by_user_id(db, use_rollup):
+    main.register_user(1, 'alice', 'Алиса', None)
+    main.register_user(2, None, 'Без имени', None)
+    main.register_user(3, 'bob', 'Боб', None)
+    main.write_activity_batch(
+        [(1, 'start', '2024-01-01 10:00:00', None), (1, 'stats', '2024-01-02 10:00:00', None),
+         (1, 'stats', '2024-01-02 11:00:00', None), (3, 'report', '2024-01-02 12:00:00', None),
+         (3, 'start', '2024-01-02 13:00:00', None)]
+        + [(2, 'stats', f'2024-01-01 0{hour}:00:00', None) for hour in range(5)]
+    )
+    if not use_rollup:
+        with db.writer() as conn:
+            conn.execute("UPDATE rollup_state SET valid = 0 WHERE name = 'activity_daily'")
+
+    summary = main.get_activity_summary('2024-01-01', '2024-01-31', 'период')
+
+    assert summary.total_actions == 10
+    assert summary.active_users == 3
+    assert summary.top_users == [('2', 5), ('alice', 3), ('bob', 2)]
+    assert [(action, count) for action, count, _ in summary.action_types] == [('stats', 7), ('start', 2), ('report', 1)]
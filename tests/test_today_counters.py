@@ -0,0 +1,137 @@
+import datetime
+
+import pytest
+
+import main
+
+
+@pytest.fixture
+def counters(db, monkeypatch):
+    counters = main.TodayCounters(enabled=True, resync_seconds=0)
+    monkeypatch.setattr(main, 'today_counters', counters)
+    counters.rehydrate()
+    return counters
+
+
+def today():
+    return datetime.date.today().strftime("%Y-%m-%d")
+
+
+def yesterday():
+    return (datetime.date.today() - datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def write_sales(rows):
+    # Запись продаж так, как ее делает бот: счетчики обновляются под блокировкой записи
+    with main.db_pool.writer() as conn:
+        main.insert_sales_rows(conn, rows)
+        main.today_counters.record_sales(rows)
+    main.query_cache.invalidate('sales', {row[3] for row in rows})
+
+
+def write_activity():
+    for user_id, username in ((1, 'alice'), (2, 'bob'), (3, None)):
+        main.register_user(user_id, username, 'Имя', 'Фамилия')
+    # У каждого пользователя и типа действия свое количество, чтобы порядок рейтингов был однозначным
+    events = (
+        [(1, 'stats', f"{today()} 10:00:00", None)] * 4
+        + [(2, 'report', f"{today()} 11:00:00", None)] * 2
+        + [(3, 'start', f"{today()} 12:00:00", None)]
+        + [(1, 'start', f"{yesterday()} 12:00:00", None)] * 5
+    )
+    main.write_activity_batch(events[:5])
+    main.write_activity_batch(events[5:])
+    main.log_user_activity(2, 'report')
+
+
+def test_counters_match_sql_after_writes(counters):
+    write_activity()
+    write_sales([
+        (1, 'Смартфон', 300.0, today(), 1),
+        (2, 'Наушники', 50.0, today(), 2),
+        (2, 'Наушники', 25.0, today(), 3),
+        (1, 'Смартфон', 999.0, yesterday(), 1),
+    ])
+
+    assert counters.check_consistency() == []
+    assert counters.available(today(), today())
+
+    sales = counters.sales_summary('день')
+    expected_sales = main.summarize_sales(main.get_sales_data(today(), today()), 'день')
+    assert sales.total_amount == pytest.approx(expected_sales.total_amount)
+    assert sales.sales_count == expected_sales.sales_count
+    assert sales.products == pytest.approx(expected_sales.products)
+
+    activity = counters.activity_summary('день')
+    expected_activity = main.get_activity_summary(today(), today(), 'день')
+    assert activity.total_actions == expected_activity.total_actions == 8
+    assert activity.active_users == expected_activity.active_users
+    assert activity.action_types == pytest.approx(expected_activity.action_types)
+    assert activity.top_users == expected_activity.top_users == [('alice', 4), ('bob', 3), ('3', 1)]
+
+
+def test_check_consistency_reports_out_of_band_changes(counters):
+    write_activity()
+    with main.db_pool.writer() as conn:
+        main.delete_activity_rows(conn, "user_id = 3")
+
+    assert counters.check_consistency() == [
+        "действия 'start': в базе 0, в счетчиках 1",
+        "пользователь '3': в базе 0, в счетчиках 1",
+    ]
+    counters.rehydrate()
+    assert counters.check_consistency() == []
+
+
+def test_counters_match_sql_after_ingest(counters, tmp_path):
+    path = tmp_path / 'sales.csv'
+    path.write_text(
+        "product_name,amount,date,user_id\n"
+        f"Смартфон,300,{today()},1\n"
+        f"Наушники,50,{today()},2\n"
+        f"Наушники,-5,{today()},2\n"
+        f"Смартфон,999,{yesterday()},1\n",
+        encoding='utf-8'
+    )
+    main.ingest_sales(str(path), chunk_rows=2)
+
+    assert counters.check_consistency() == []
+    sales = counters.sales_summary('день')
+    expected = main.summarize_sales(main.get_sales_data(today(), today()), 'день')
+    assert (sales.total_amount, sales.sales_count) == (expected.total_amount, expected.sales_count) == (350.0, 2)
+    assert sales.products == pytest.approx(expected.products)
+
+
+def test_rolled_back_write_does_not_change_counters(counters):
+    write_activity()
+    write_sales([(1, 'Смартфон', 300.0, today(), 1)])
+
+    # Запись внутри транзакции, которая затем откатывается
+    with pytest.raises(RuntimeError):
+        with main.db_pool.writer() as conn:
+            main.insert_sales_rows(conn, [(2, 'Наушники', 50.0, today(), 2)])
+            main.today_counters.record_sales([(2, 'Наушники', 50.0, today(), 2)])
+            main.write_activity_batch([(1, 'stats', f"{today()} 13:00:00", None)])
+            raise RuntimeError('ошибка записи')
+
+    # Счетчики не используются, пока не загружены заново, и новые записи их не меняют
+    assert not counters.available(today(), today())
+    write_sales([(3, 'Ноутбук', 100.0, today(), 1)])
+    assert not counters.available(today(), today())
+
+    counters.rehydrate()
+    assert counters.check_consistency() == []
+    assert counters.sales_summary('день').sales_count == 2
+    assert counters.activity_summary('день').total_actions == 8
+
+
+def test_future_dates_do_not_move_counter_date(counters):
+    tomorrow = (datetime.date.today() + datetime.timedelta(days=1)).strftime("%Y-%m-%d")
+    write_sales([(1, 'Смартфон', 300.0, today(), 1), (2, 'Наушники', 50.0, tomorrow, 2)])
+    main.write_activity_batch([(1, 'stats', f"{tomorrow} 10:00:00", None)])
+
+    assert counters.date == today()
+    assert counters.available(today(), today())
+    assert counters.check_consistency() == []
+    assert counters.sales_summary('день').total_amount == 300.0
+    assert counters.activity_summary('день').total_actions == 0
@@ -0,0 +1,86 @@
+import asyncio
+import json
+
+from aiohttp.test_utils import TestClient, TestServer
+
+import main
+from fakes import message
+
+SECRET = 'test-secret'
+
+
+def recorded(update):
+    # Обновление в том виде, в каком его присылает Telegram
+    return json.loads(update.model_dump_json(exclude_none=True))
+
+
+def run_webhook(fake_bot_api, monkeypatch, scenario, drain_timeout=10, **settings):
+    """
+    Выполняет сценарий scenario(client, server) с клиентом сервера вебхука.
+    Бот и очередь отправки направлены в поддельный Bot API.
+    """
+    async def run():
+        await fake_bot_api.start()
+        bot = fake_bot_api.bot()
+        monkeypatch.setattr(main, 'bot', bot)
+        monkeypatch.setattr(main, 'outbox', main.TelegramOutbox())
+        server = main.WebhookServer(main.dp, bot, secret=SECRET, **settings)
+        client = TestClient(TestServer(server.build_app()))
+        await client.start_server()
+        try:
+            return await asyncio.wait_for(scenario(client, server), timeout=30)
+        finally:
+            await client.close()
+            await server.stop(delete_webhook=False, drain_timeout=drain_timeout)
+            await main.outbox.stop()
+            await bot.session.close()
+            await fake_bot_api.stop()
+
+    return asyncio.run(run())
+
+
+def post(client, data, secret=SECRET):
+    body = data if isinstance(data, str) else json.dumps(data)
+    return client.post('/webhook', data=body, headers={
+        'Content-Type': 'application/json',
+        'X-Telegram-Bot-Api-Secret-Token': secret,
+    })
+
+
+def test_webhook_checks_secret_and_rejects_when_queue_is_full(db, fake_bot_api, monkeypatch):
+    async def scenario(client, server):
+        # Без обработчиков очередь только наполняется
+        server.start_workers()
+        statuses = [
+            (await post(client, recorded(message(1, 1, '/start')), secret='wrong')).status,
+            (await post(client, '{not json')).status,
+        ]
+        for update_id in range(1, 4):
+            statuses.append((await post(client, recorded(message(update_id, 1, '/start')))).status)
+        return statuses, server.metrics()
+
+    statuses, metrics = run_webhook(fake_bot_api, monkeypatch, scenario, drain_timeout=0.1, queue_size=2, workers=0)
+    assert statuses == [401, 400, 200, 200, 503]
+    assert metrics['received'] == 2 and metrics['rejected'] == 3 and metrics['queue_depth'] == 2
+
+
+def test_webhook_feeds_recorded_updates_to_dispatcher(db, fake_bot_api, monkeypatch):
+    chats = range(1, 21)
+
+    async def scenario(client, server):
+        server.start_workers()
+        statuses = [
+            (await post(client, recorded(message(chat_id, chat_id, '/start')))).status
+            for chat_id in chats
+        ]
+        await server._queue.join()
+        return statuses, server.metrics()
+
+    statuses, metrics = run_webhook(fake_bot_api, monkeypatch, scenario, workers=4)
+    assert statuses == [200] * len(chats)
+    assert metrics['processed'] == len(chats) and metrics['failed'] == 0
+
+    # Ответы отправляются в фоне, очередь отправки дожидается их при остановке
+    replies = {int(data['chat_id']): data['text'] for data in fake_bot_api.sent()}
+    assert sorted(replies) == list(chats)
+    assert all(text.startswith('Привет, Пользователь') for text in replies.values())
@@ -0,0 +1,105 @@
+import asyncio
+import logging
+
+import main
+from fakes import callback, message
+
+CHATS = 30
+MIN_UPDATES_PER_SEC = 10
+
+
+def batches_source(batches):
+    batches = list(batches)
+    offsets = []
+
+    async def fetch_updates(offset):
+        offsets.append(offset)
+        return batches.pop(0) if batches else None
+
+    return fetch_updates, offsets
+
+
+def test_workers_share_state_between_runs(tmp_path, monkeypatch, fake_bot_api):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, 'db_pool', main.DatabasePool(main.DB_PATH))
+
+    async def run(workers, batches):
+        fetch_updates, offsets = batches_source(batches)
+        await main.run_workers(workers, fetch_updates=fetch_updates)
+        return offsets
+
+    async def scenario():
+        await fake_bot_api.start()
+        monkeypatch.setenv('TELEGRAM_API_URL', fake_bot_api.url)
+        try:
+            # Первый запуск: каждый чат начинает формировать отчет
+            updates = []
+            for chat_id in range(1, CHATS + 1):
+                updates.append(message(len(updates) + 1, chat_id, '/start'))
+                updates.append(message(len(updates) + 1, chat_id, '/report'))
+            first = await run(2, [updates[:CHATS], updates[CHATS:]])
+
+            # Второй запуск с другим числом процессов: чаты попадают в другие процессы,
+            # но продолжают с сохраненного в базе состояния
+            choices = [callback(len(updates) + i, chat_id, 'report_sales') for i, chat_id in enumerate(range(1, CHATS + 1))]
+            second = await run(3, [choices])
+            return updates, first, second
+        finally:
+            await fake_bot_api.stop()
+
+    updates, offsets, _ = asyncio.run(scenario())
+    assert offsets == [None, CHATS + 1, 2 * CHATS + 1]
+
+    # Пропускная способность без учета запуска процессов: от первого ответа до последнего
+    first_run = fake_bot_api.received_at[:len(updates)]
+    rate = len(updates) / (first_run[-1] - first_run[0])
+    logging.info(f"Рабочие процессы: {rate:.0f} обновлений/с")
+    assert rate > MIN_UPDATES_PER_SEC
+
+    replies = {}
+    for data in fake_bot_api.sent():
+        replies.setdefault(int(data['chat_id']), []).append(data['text'])
+    assert sorted(replies) == list(range(1, CHATS + 1))
+    for chat_id, texts in replies.items():
+        # Обновления одного чата обрабатываются по порядку
+        assert texts[0].startswith('Привет, Пользователь')
+        assert texts[1] == "Какой тип отчета вы хотите создать?"
+        assert texts[2].startswith("Выбран тип отчета: sales")
+        assert len(texts) == 3
+    assert len(fake_bot_api.sent('answerCallbackQuery')) == CHATS
+
+    with main.db_pool.reader() as conn:
+        states = conn.execute("SELECT state, COUNT(*) FROM fsm_storage WHERE state IS NOT NULL GROUP BY state").fetchall()
+        registered = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        logged = conn.execute("SELECT COUNT(*) FROM user_activity").fetchone()[0]
+    main.db_pool.close_all()
+    assert states == [(main.ReportStates.waiting_for_format.state, CHATS)]
+    assert registered == CHATS
+    assert logged == 2 * CHATS
+
+
+def test_query_cache_sees_writes_of_other_processes(db, monkeypatch):
+    # Два кэша с одной базой - как в двух рабочих процессах
+    first, second = main.QueryResultCache(), main.QueryResultCache()
+    with db.writer() as conn:
+        main.insert_sales_rows(conn, [(1, 'Смартфон', 100.0, '2024-01-10', 1)])
+
+    monkeypatch.setattr(main, 'query_cache', first)
+    assert main.get_sales_data('2024-01-01', '2024-01-31')['total_amount'].sum() == 100.0
+
+    # Запись другого процесса: его кэш сбрасывается по датам, а поколение в базе растет
+    monkeypatch.setattr(main, 'query_cache', second)
+    assert main.get_sales_data('2024-02-01', '2024-02-29').empty
+    with db.writer() as conn:
+        main.insert_sales_rows(conn, [(1, 'Смартфон', 50.0, '2024-01-11', 2)])
+        written = second.record_write(conn, 'sales')
+    second.invalidate('sales', {'2024-01-11'}, written)
+    assert second.metrics()['entries'] == 1
+
+    monkeypatch.setattr(main, 'query_cache', first)
+    assert main.get_sales_data('2024-01-01', '2024-01-31')['total_amount'].sum() == 150.0
+
+    # Собственная запись не сбрасывает записи за другие даты
+    monkeypatch.setattr(main, 'query_cache', second)
+    assert main.get_sales_data('2024-02-01', '2024-02-29').empty
+    assert second.metrics()['hits'] == 1